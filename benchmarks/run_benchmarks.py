@@ -0,0 +1,358 @@
+"""
+Benchmarks the hot paths of network_health: parsing ping and iperf output, encoding series, submitting them to a
+local fake Datadog and rendering the Prometheus exposition. Every benchmark also checks its result, so a parser
+regression fails the run instead of just getting faster.
+
+    python3 benchmarks/run_benchmarks.py --output results.json
+    python3 benchmarks/run_benchmarks.py --quick --compare results.json
+"""
+import argparse
+import fnmatch
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from lib import datadog, iperf, ping, prometheus, spool  # noqa: E402
+from lib.results import PingResult  # noqa: E402
+from lib.stats import RttSamples  # noqa: E402
+
+import fake_datadog  # noqa: E402
+import transcripts  # noqa: E402
+
+SCHEMA_VERSION = 1
+SIZES = {
+    "ping_packets": [100, 10_000, 100_000],
+    "iperf_intervals": [10, 3_600],
+    "targets": [100, 1_000, 10_000]
+}
+QUICK_SIZES = {
+    "ping_packets": [100, 10_000],
+    "iperf_intervals": [10],
+    "targets": [100, 1_000]
+}
+
+
+class Benchmark:
+    """One measured case: run is timed, check validates what the last run returned."""
+
+    def __init__(self, name: str, params: dict, run, items: int, unit: str, check=None, teardown=None):
+        self.name = name
+        self.params = params
+        self.run = run
+        self.items = items
+        self.unit = unit
+        self.check = check
+        self.teardown = teardown
+
+    @property
+    def label(self):
+        return f"{self.name}[{','.join(f'{key}={value}' for key, value in self.params.items())}]"
+
+
+@contextmanager
+def replaced(module, **attributes):
+    # Swaps module attributes for the length of a run, e.g. the process runner for a transcript
+    originals = {name: getattr(module, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(module, name, value)
+
+
+def fleet_results(number_of_targets: int, packets: int = 20):
+    """
+    The fleet_results function builds realistic ping results for many targets.
+
+    :param number_of_targets: int: The number of targets
+    :param packets: int: The replies behind each result
+    :return: A dictionary of target to PingResult
+    """
+    results = {}
+    for index in range(number_of_targets):
+        samples = RttSamples(packets)
+        for sequence, rtt in enumerate(transcripts._rtts(packets, 0.05, index)):
+            if rtt is not None:
+                samples.add_reply(sequence, rtt)
+        results[f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"] = samples.snapshot()
+    return results
+
+
+def ping_benchmarks(sizes: dict):
+    for platform_name in transcripts.PLATFORMS:
+        for packets in sizes["ping_packets"]:
+            lines = transcripts.ping_transcript(platform_name, packets)
+            expected = len([line for line in lines if "time=" in line])
+            output = {}
+
+            def run(lines=lines, platform_name=platform_name, packets=packets, output=output):
+                with replaced(ping, CURRENT_PLATFORM=platform_name,
+                              stream_lines=lambda command, timeout=None, stderr_lines=None: iter(lines)):
+                    output["result"] = ping.run_ping(transcripts.TARGET, packets)
+
+            def check(output=output, expected=expected):
+                if len(output["result"].rtts) != expected:
+                    return f"parsed {len(output['result'].rtts)} replies, expected {expected}"
+                if output["result"].p99_latency is None:
+                    return "no percentiles"
+
+            yield Benchmark("ping_parse", {"platform": platform_name, "packets": packets}, run, len(lines), "lines",
+                            check)
+
+
+def capture_benchmarks():
+    for capture in transcripts.load_captures():
+        output = {}
+
+        def stream_lines(command, timeout=None, stderr_lines=None, capture=capture):
+            if stderr_lines is not None:
+                stderr_lines.extend(capture["stderr_lines"])
+            return iter(capture["lines"])
+
+        def run(capture=capture, stream_lines=stream_lines, output=output):
+            output.clear()
+            with replaced(ping, CURRENT_PLATFORM=capture["platform"], stream_lines=stream_lines):
+                try:
+                    output["result"] = ping.run_ping(transcripts.TARGET, capture["packets"])
+                except Exception as e:
+                    output["error"] = type(e).__name__
+
+        def check(capture=capture, output=output):
+            if "error" in capture:
+                if output.get("error") != capture["error"]:
+                    return f"expected {capture['error']}, got {output.get('error') or output['result']}"
+                return None
+            if "error" in output:
+                return f"raised {output['error']}"
+            if len(output["result"].rtts) != capture["replies"]:
+                return f"parsed {len(output['result'].rtts)} replies, expected {capture['replies']}"
+            wrong = {metric: output["result"][metric] for metric, value in capture["result"].items()
+                     if output["result"][metric] != value}
+            if wrong:
+                return f"parsed {wrong}, expected {capture['result']}"
+
+        yield Benchmark("ping_capture", {"file": capture["file"]}, run, len(capture["lines"]), "lines", check)
+
+
+def iperf_benchmarks(sizes: dict):
+    for intervals in sizes["iperf_intervals"]:
+        lines = transcripts.iperf_transcript(intervals)
+        expected = float(lines[-1].split("sec")[1].split("MBytes")[0])
+        output = {}
+
+        def run(lines=lines, output=output):
+            with replaced(iperf, stream_lines=lambda command, timeout=None, stderr_lines=None: iter(lines)):
+                output["result"] = iperf.run_iperf(transcripts.TARGET)
+
+        def check(output=output, expected=expected, intervals=intervals):
+            if output["result"].transfer_value != expected:
+                return f"transfer {output['result'].transfer_value}, expected {expected}"
+            if len(output["result"].intervals) != intervals:
+                return f"{len(output['result'].intervals)} intervals, expected {intervals}"
+
+        yield Benchmark("iperf_parse", {"intervals": intervals}, run, len(lines), "lines", check)
+
+
+def encode_benchmarks(sizes: dict):
+    for targets in sizes["targets"]:
+        results = fleet_results(targets)
+        encoder = datadog.SeriesEncoder("bench-host")
+        output = {}
+
+        def run(results=results, encoder=encoder, output=output):
+            output["chunks"] = datadog.encode_series_chunks(encoder.encode_fleet(results, "ping_remote"))
+
+        def check(output=output, targets=targets):
+            series = sum(len(json.loads(chunk)["series"]) for chunk in output["chunks"])
+            if series != targets * len(PingResult.METRICS):
+                return f"encoded {series} series, expected {targets * len(PingResult.METRICS)}"
+
+        yield Benchmark("encode_series", {"targets": targets}, run, targets * len(PingResult.METRICS), "series",
+                        check)
+
+
+def submit_benchmarks(sizes: dict, fake: fake_datadog.FakeDatadog):
+    for compression, spooled in [(None, False), (datadog.COMPRESSION_GZIP, False), (datadog.COMPRESSION_GZIP, True)]:
+        for targets in sizes["targets"]:
+            results = fleet_results(targets)
+            spool_dir = tempfile.TemporaryDirectory() if spooled else None
+            client = datadog.DatadogClient("bench", host="bench-host", batch=True, compression=compression,
+                                           spool=spool.MetricSpool(spool_dir.name) if spooled else None)
+            client.base_url = fake.url
+            client.validate_credentials()
+
+            def run(client=client, results=results):
+                fake.reset()
+                client.submit_ping_fleet(results, local=False)
+                client.flush()
+
+            def check():
+                if fake.requests == 0:
+                    return "nothing reached the fake Datadog"
+
+            def teardown(client=client, spool_dir=spool_dir):
+                client.close()
+                if spool_dir is not None:
+                    spool_dir.cleanup()
+
+            yield Benchmark("submit_end_to_end", {"targets": targets, "compression": compression or "none",
+                                                  "spool": spooled},
+                            run, targets * len(PingResult.METRICS), "series", check, teardown)
+
+
+def prometheus_benchmarks(sizes: dict):
+    for targets in sizes["targets"]:
+        results = fleet_results(targets)
+        exporter = prometheus.PrometheusExporter(host="127.0.0.1", port=0)
+        url = f"http://127.0.0.1:{exporter.port}{prometheus.METRICS_PATH}"
+        exporter.submit_ping_fleet(results, local=False)
+        output = {}
+
+        def update(exporter=exporter, results=results):
+            exporter.submit_ping_fleet(results, local=False)
+
+        def scrape(url=url, output=output):
+            with urllib.request.urlopen(url) as response:
+                output["body"] = response.read()
+
+        def check(output=output, targets=targets):
+            if output["body"].count(b"network_health_ping_remote_average_latency{") != targets:
+                return "scrape is missing targets"
+
+        yield Benchmark("prometheus_update", {"targets": targets}, update, targets, "targets")
+        yield Benchmark("prometheus_scrape", {"targets": targets}, scrape, targets, "targets", check,
+                        lambda exporter=exporter: exporter.close())
+
+
+def measure(benchmark: Benchmark, repeat: int):
+    """
+    The measure function runs a benchmark once to warm up, then repeat times.
+
+    :param benchmark: Benchmark: The case to run
+    :param repeat: int: The number of timed runs
+    :return: A dictionary describing the timings, ready for the JSON report
+    """
+    benchmark.run()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        benchmark.run()
+        timings.append((time.perf_counter_ns() - start) / 1e9)
+    error = benchmark.check() if benchmark.check is not None else None
+    median = statistics.median(timings)
+    return {
+        "name": benchmark.name,
+        "params": benchmark.params,
+        "repeat": repeat,
+        "items": benchmark.items,
+        "unit": benchmark.unit,
+        "seconds": {"min": min(timings), "median": median, "mean": statistics.fmean(timings), "max": max(timings)},
+        "throughput": benchmark.items / median if median else math.inf,
+        "ok": error is None,
+        "error": error
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: str):
+    with open(baseline_path) as baseline_file:
+        baseline = {(entry["name"], json.dumps(entry["params"], sort_keys=True)): entry
+                    for entry in json.load(baseline_file)["results"]}
+    print(f"\nCompared with {baseline_path} (median, >1 is faster now):", file=sys.stderr)
+    for entry in results:
+        previous = baseline.get((entry["name"], json.dumps(entry["params"], sort_keys=True)))
+        if previous is None:
+            continue
+        ratio = previous["seconds"]["median"] / entry["seconds"]["median"]
+        params = ",".join(f"{key}={value}" for key, value in entry["params"].items())
+        print(f"  {entry['name']}[{params}]: {ratio:.2f}x", file=sys.stderr)
+
+
+def parse_opts():
+    parser = argparse.ArgumentParser(description="Benchmark the parsers, series encoding and submission paths.")
+    parser.add_argument("--output", dest="output", default=None,
+                        help="Specify a file to write the JSON report to. Default = stdout")
+    parser.add_argument("--filter", dest="filter", default="*",
+                        help="Specify a shell-style pattern of benchmark names to run, e.g. `ping_*`. Default = *")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=5,
+                        help="Specify the number of timed runs of each benchmark. Default = 5")
+    parser.add_argument("--quick", dest="quick", default=False, action="store_true",
+                        help="Specify this argument to skip the largest inputs. Default = False")
+    parser.add_argument("--compare", dest="compare", default=None,
+                        help="Specify an earlier JSON report to print the speed up against. Default = None")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_opts()
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = []
+    with fake_datadog.FakeDatadog() as fake:
+        suites = [
+            (["ping_parse"], lambda: ping_benchmarks(sizes)),
+            (["ping_capture"], capture_benchmarks),
+            (["iperf_parse"], lambda: iperf_benchmarks(sizes)),
+            (["encode_series"], lambda: encode_benchmarks(sizes)),
+            (["submit_end_to_end"], lambda: submit_benchmarks(sizes, fake)),
+            (["prometheus_update", "prometheus_scrape"], lambda: prometheus_benchmarks(sizes))
+        ]
+        for names, suite in suites:
+            # Suites are only set up if one of their benchmarks is selected
+            if not any(fnmatch.fnmatchcase(name, args.filter) for name in names):
+                continue
+            for benchmark in suite():
+                try:
+                    if not fnmatch.fnmatchcase(benchmark.name, args.filter):
+                        continue
+                    entry = measure(benchmark, args.repeat)
+                finally:
+                    if benchmark.teardown is not None:
+                        benchmark.teardown()
+                results.append(entry)
+                status = "ok" if entry["ok"] else f"FAILED: {entry['error']}"
+                print(f"{benchmark.label}: median {entry['seconds']['median'] * 1000:.2f}ms, "
+                      f"{entry['throughput']:,.0f} {entry['unit']}/s, {status}", file=sys.stderr)
+
+    report = {
+        "schema": SCHEMA_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "system": platform.system(),
+        "machine": platform.machine(),
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare is not None:
+        compare(results, args.compare)
+    return 0 if all(entry["ok"] for entry in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
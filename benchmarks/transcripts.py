@@ -0,0 +1,142 @@
+"""
+Synthetic ping and iperf transcripts, in the exact formats printed by Linux (iputils), macOS and Windows ping and by
+iperf 2 with `-f M -i 1`. They are generated from a seed so every run parses the same input, at sizes no captured run
+reaches. Small ping transcripts of each platform, with loss, unreachable hosts and total loss, are kept in `captures/`
+in the exact form ping prints them, along with the results they must parse to.
+"""
+import json
+import math
+import os
+import random
+
+PLATFORM_LINUX = "Linux"
+PLATFORM_MACOS = "Darwin"
+PLATFORM_WINDOWS = "Windows"
+PLATFORMS = [PLATFORM_LINUX, PLATFORM_MACOS, PLATFORM_WINDOWS]
+
+TARGET = "8.8.8.8"
+
+CAPTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "captures")
+
+
+def _rtts(number_of_packets: int, loss: float, seed: int):
+    generator = random.Random(seed)
+    rtts = []
+    for _ in range(number_of_packets):
+        if generator.random() < loss:
+            rtts.append(None)
+        else:
+            rtts.append(round(generator.lognormvariate(math.log(12.0), 0.3), 3))
+    return rtts
+
+
+def _summary(rtts: list):
+    received = [rtt for rtt in rtts if rtt is not None]
+    mean = sum(received) / len(received)
+    deviation = math.sqrt(max(0.0, sum(rtt * rtt for rtt in received) / len(received) - mean * mean))
+    loss = 100.0 * (len(rtts) - len(received)) / len(rtts)
+    return len(received), loss, min(received), mean, max(received), deviation
+
+
+def ping_transcript(platform_name: str, number_of_packets: int, loss: float = 0.01, seed: int = 1):
+    """
+    The ping_transcript function generates the output of one ping run.
+
+    :param platform_name: str: One of PLATFORMS
+    :param number_of_packets: int: The number of packets in the run
+    :param loss: float: The fraction of packets that go unanswered
+    :param seed: int: Seeds the round trip times and losses
+    :return: A list of the lines ping prints, without line endings
+    """
+    rtts = _rtts(number_of_packets, loss, seed)
+    received, packet_loss, minimum, mean, maximum, deviation = _summary(rtts)
+    if platform_name == PLATFORM_WINDOWS:
+        lines = [f"Pinging {TARGET} with 32 bytes of data:"]
+        for rtt in rtts:
+            if rtt is None:
+                lines.append("Request timed out.")
+            else:
+                lines.append(f"Reply from {TARGET}: bytes=32 time={round(rtt)}ms TTL=117")
+        lines.extend([
+            "",
+            f"Ping statistics for {TARGET}:",
+            f"    Packets: Sent = {len(rtts)}, Received = {received}, Lost = {len(rtts) - received} "
+            f"({packet_loss:.0f}% loss),",
+            "Approximate round trip times in milli-seconds:",
+            f"    Minimum = {round(minimum)}ms, Maximum = {round(maximum)}ms, Average = {round(mean)}ms"
+        ])
+        return lines
+
+    if platform_name == PLATFORM_MACOS:
+        lines = [f"PING {TARGET} ({TARGET}): 56 data bytes"]
+        for sequence, rtt in enumerate(rtts):
+            if rtt is None:
+                lines.append(f"Request timeout for icmp_seq {sequence}")
+            else:
+                lines.append(f"64 bytes from {TARGET}: icmp_seq={sequence} ttl=117 time={rtt:.3f} ms")
+        lines.extend([
+            "",
+            f"--- {TARGET} ping statistics ---",
+            f"{len(rtts)} packets transmitted, {received} packets received, {packet_loss:.1f}% packet loss",
+            f"round-trip min/avg/max/stddev = {minimum:.3f}/{mean:.3f}/{maximum:.3f}/{deviation:.3f} ms"
+        ])
+        return lines
+
+    lines = [f"PING {TARGET} ({TARGET}) 56(84) bytes of data."]
+    for sequence, rtt in enumerate(rtts, start=1):
+        if rtt is not None:
+            lines.append(f"64 bytes from {TARGET}: icmp_seq={sequence} ttl=117 time={rtt:.1f} ms")
+    lines.extend([
+        "",
+        f"--- {TARGET} ping statistics ---",
+        f"{len(rtts)} packets transmitted, {received} received, {packet_loss:g}% packet loss, "
+        f"time {len(rtts) * 1000}ms",
+        f"rtt min/avg/max/mdev = {minimum:.3f}/{mean:.3f}/{maximum:.3f}/{deviation:.3f} ms"
+    ])
+    return lines
+
+
+def iperf_transcript(number_of_intervals: int, seed: int = 1):
+    """
+    The iperf_transcript function generates the output of one iperf client run with one second interval reports.
+
+    :param number_of_intervals: int: The length of the run in seconds
+    :param seed: int: Seeds the bandwidth of every interval
+    :return: A list of the lines iperf prints, without line endings
+    """
+    generator = random.Random(seed)
+    lines = [
+        "------------------------------------------------------------",
+        f"Client connecting to {TARGET}, TCP port 5001",
+        "TCP window size: 0.08 MByte (default)",
+        "------------------------------------------------------------",
+        f"[  1] local 10.0.0.2 port 50412 connected with {TARGET} port 5001",
+        "[ ID] Interval       Transfer     Bandwidth"
+    ]
+    total = 0.0
+    for second in range(number_of_intervals):
+        transfer = round(generator.uniform(100.0, 115.0), 1)
+        total += transfer
+        lines.append(f"[  1] {second:.2f}-{second + 1:.2f} sec   {transfer:g} MBytes   {transfer:g} MBytes/sec")
+    duration = number_of_intervals + 0.01
+    lines.append(f"[  1] 0.00-{duration:.2f} sec   {total:.0f} MBytes   {total / duration:.1f} MBytes/sec")
+    return lines
+
+
+def load_captures():
+    """
+    The load_captures function reads the captured ping transcripts and what each must parse to.
+
+    :return: A list of dictionaries with the keys: platform, packets, lines and stderr_lines, and either result, the
+        expected PingResult values, and replies, or error, the name of the exception parsing must raise
+    """
+    with open(os.path.join(CAPTURES_DIR, "expected.json")) as expected_file:
+        captures = json.load(expected_file)
+    for capture in captures:
+        with open(os.path.join(CAPTURES_DIR, capture["file"]), newline="") as capture_file:
+            capture["lines"] = capture_file.read().splitlines()
+        capture["stderr_lines"] = []
+        if "stderr" in capture:
+            with open(os.path.join(CAPTURES_DIR, capture["stderr"])) as stderr_file:
+                capture["stderr_lines"] = stderr_file.read().splitlines()
+    return captures
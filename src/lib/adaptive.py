@@ -0,0 +1,223 @@
+import logging
+import threading
+import time
+
+from lib.tracing import tracer
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_HEARTBEAT_PACKETS = 5  # Packets sent to every target on each run while nothing is wrong
+DEFAULT_LOSS_THRESHOLD = 2.0  # Percent of packets lost that escalates a target
+DEFAULT_CHANGE_RATIO = 0.5  # Average latency this far above or below the target's baseline escalates it
+DEFAULT_MIN_CHANGE = 1.0  # Milliseconds a latency change must also exceed, so sub-millisecond noise on a LAN is ignored
+DEFAULT_CALM_RUNS = 3  # Healthy full runs in a row before an escalated target backs off to heartbeats
+DEFAULT_BASELINE_WEIGHT = 0.2  # Weight of each healthy result in the moving average baseline
+
+MODE_HEARTBEAT = "heartbeat"
+MODE_FULL = "full"
+
+
+class _TargetState:
+    """What the monitor knows about one target between runs."""
+
+    __slots__ = ("baseline_latency", "escalated", "calm_runs", "mode")
+
+    def __init__(self):
+        self.baseline_latency = None
+        self.escalated = False
+        self.calm_runs = 0
+        self.mode = MODE_HEARTBEAT  # How the target was tested on its latest run
+
+
+class AdaptiveMonitor:
+    """
+    Keeps a set of ping targets under a low-rate heartbeat, a few packets per target and run, and only escalates a
+    target to a full ping when its heartbeat crosses the loss or latency threshold, its latency moves sharply away from
+    its baseline, or the heartbeat fails outright, as it does when the target stops answering. An escalated target is
+    tested in full on every run until it has been healthy for a few runs in a row, then backs off to heartbeats again.
+    While any target is escalated, bandwidth tests are let through as well.
+    """
+
+    def __init__(self, ping_fleet, heartbeat_packets: int = DEFAULT_HEARTBEAT_PACKETS,
+                 loss_threshold: float = DEFAULT_LOSS_THRESHOLD, latency_threshold: float = None,
+                 change_ratio: float = DEFAULT_CHANGE_RATIO, min_change: float = DEFAULT_MIN_CHANGE,
+                 calm_runs: int = DEFAULT_CALM_RUNS, bandwidth_interval: float = None, clock=time.monotonic):
+        """
+        :param ping_fleet: Called with a list of targets and a number of packets, returns a dictionary of target to
+            PingResult and a dictionary of target to the exception it raised, like fleet.run_ping_fleet
+        :param heartbeat_packets: int: The packets of a heartbeat
+        :param loss_threshold: float: Packet loss, in percent, at or above which a target is escalated
+        :param latency_threshold: float: Average latency, in milliseconds, at or above which a target is escalated.
+            No fixed latency threshold if not specified
+        :param change_ratio: float: How far, as a fraction of the baseline, the average latency may move before the
+            target is escalated
+        :param min_change: float: Milliseconds the average latency must also move by before the target is escalated
+        :param calm_runs: int: Healthy full runs in a row before a target backs off to heartbeats
+        :param bandwidth_interval: float: Seconds between bandwidth tests while escalated. The first run of every
+            escalation always lets them through
+        :param clock: Returns the current time in seconds
+        """
+        self.ping_fleet = ping_fleet
+        self.heartbeat_packets = heartbeat_packets
+        self.loss_threshold = loss_threshold
+        self.latency_threshold = latency_threshold
+        self.change_ratio = change_ratio
+        self.min_change = min_change
+        self.calm_runs = calm_runs
+        self.bandwidth_interval = bandwidth_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.states = {}
+        self.escalated_at = None  # When the current escalation began, None while every target is calm
+        self.last_bandwidth = None
+
+    def state(self, target: str):
+        with self.lock:
+            state = self.states.get(target)
+            if state is None:
+                state = self.states[target] = _TargetState()
+            return state
+
+    def anomalies(self, state: _TargetState, result):
+        """
+        The anomalies function lists why a result warrants a full test.
+
+        :param state: _TargetState: The state of the target, for its baseline
+        :param result: PingResult: The latest result of the target
+        :return: A list of reasons, empty if the result looks healthy
+        """
+        reasons = []
+        loss = result.packet_loss
+        latency = result.average_latency
+        if loss is not None and loss >= self.loss_threshold:
+            reasons.append(f"packet loss {loss:g}% >= {self.loss_threshold:g}%")
+        if latency is None:
+            return reasons
+        if self.latency_threshold is not None and latency >= self.latency_threshold:
+            reasons.append(f"latency {latency:g}ms >= {self.latency_threshold:g}ms")
+        baseline = state.baseline_latency
+        if baseline is not None:
+            change = abs(latency - baseline)
+            if change > baseline * self.change_ratio and change > self.min_change:
+                reasons.append(f"latency {latency:g}ms moved from its baseline of {baseline:.3g}ms")
+        return reasons
+
+    def _escalate(self, target: str, state: _TargetState, reasons: list):
+        """
+        The _escalate function escalates a target to full tests, or keeps it escalated and starts its count of healthy
+        runs over.
+
+        :return: True, the target needs a full test
+        """
+        state.calm_runs = 0
+        if not state.escalated:
+            logger.warning(f"Escalating target: {target} to full tests: {', '.join(reasons)}")
+            tracer.count("adaptive.escalations")
+            state.escalated = True
+        return True
+
+    def _update(self, target: str, state: _TargetState, result):
+        """
+        The _update function folds a result into the target's state. Only healthy results move the baseline, so an
+        incident is never learned as normal.
+
+        :return: True if the target needs a full test
+        """
+        reasons = self.anomalies(state, result)
+        if len(reasons) > 0:
+            return self._escalate(target, state, reasons)
+        if result.average_latency is not None:
+            if state.baseline_latency is None:
+                state.baseline_latency = result.average_latency
+            else:
+                state.baseline_latency += DEFAULT_BASELINE_WEIGHT * (result.average_latency - state.baseline_latency)
+        if state.escalated:
+            state.calm_runs += 1
+            if state.calm_runs >= self.calm_runs:
+                logger.info(f"Target: {target} has been healthy for {state.calm_runs} full run(s), backing off to "
+                            f"heartbeats")
+                state.escalated = False
+        return state.escalated
+
+    def _failed(self, target: str, state: _TargetState, error: Exception):
+        """
+        The _failed function treats a test that raised, such as a ping that timed out or got no reply at all, as the
+        worst anomaly there is: a target that can not be tested is escalated, and is not calm.
+
+        :return: True, the target needs a full test
+        """
+        return self._escalate(target, state, [f"test failed: {error!r}"])
+
+    def run(self, targets: list, number_of_packets: int):
+        """
+        The run function tests every target once: escalated targets get a full ping straight away, the others a
+        heartbeat, and any heartbeat that looks wrong is followed by a full ping in the same run.
+
+        :param targets: list: The targets to test
+        :param number_of_packets: int: The packets of a full ping
+        :return: A dictionary of target to its latest PingResult, full where one was run, and a dictionary of target to
+            the exception it raised
+        """
+        states = {target: self.state(target) for target in targets}
+        heartbeat_targets = [target for target in targets if not states[target].escalated]
+        full_targets = [target for target in targets if states[target].escalated]
+        results, errors = {}, {}
+        if len(heartbeat_targets) > 0:
+            logger.info(f"Sending {self.heartbeat_packets} packet heartbeat(s) to {len(heartbeat_targets)} target(s)")
+            results, errors = self.ping_fleet(heartbeat_targets, self.heartbeat_packets)
+            for target, result in results.items():
+                states[target].mode = MODE_HEARTBEAT
+                if self._update(target, states[target], result):
+                    full_targets.append(target)
+            for target, error in errors.items():
+                states[target].mode = MODE_HEARTBEAT
+                self._failed(target, states[target], error)
+                full_targets.append(target)
+        if len(full_targets) > 0:
+            logger.info(f"Running full {number_of_packets} packet ping(s) against {len(full_targets)} target(s)")
+            full_results, full_errors = self.ping_fleet(full_targets, number_of_packets)
+            for target, result in full_results.items():
+                states[target].mode = MODE_FULL
+                self._update(target, states[target], result)
+                results[target] = result
+                errors.pop(target, None)
+            for target, error in full_errors.items():
+                states[target].mode = MODE_FULL
+                self._failed(target, states[target], error)
+            errors.update(full_errors)
+        tracer.count("adaptive.heartbeats", len(heartbeat_targets))
+        tracer.count("adaptive.full_tests", len(full_targets))
+        with self.lock:
+            escalated = any(state.escalated for state in self.states.values())
+            if escalated and self.escalated_at is None:
+                self.escalated_at = self.clock()
+            elif not escalated:
+                self.escalated_at = None
+        return results, errors
+
+    def mode_tags(self, targets):
+        """
+        The mode_tags function tags every target with how it was tested on its latest run.
+
+        :param targets: The targets
+        :return: A dictionary of target to a list holding its `mode:heartbeat` or `mode:full` tag
+        """
+        return {target: [f"mode:{self.state(target).mode}"] for target in targets}
+
+    def bandwidth_due(self):
+        """
+        The bandwidth_due function decides whether bandwidth tests run this cycle: once as soon as a target is
+        escalated, then every bandwidth_interval seconds for as long as the escalation lasts. When this returns True
+        the run is counted as made.
+
+        :return: True if the bandwidth tests should run
+        """
+        with self.lock:
+            if self.escalated_at is None:
+                return False
+            now = self.clock()
+            due = (self.last_bandwidth is None or self.last_bandwidth < self.escalated_at or
+                   self.bandwidth_interval is None or now - self.last_bandwidth >= self.bandwidth_interval)
+            if due:
+                self.last_bandwidth = now
+            return due
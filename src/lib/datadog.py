@@ -2,72 +2,186 @@ import requests
 from requests import Response
 import logging
 from socket import gethostname
+import threading
 import time
 import json
+import math
+import zlib
+
+from lib.retry import RetryPolicy
+from lib.sender import BackgroundSender, DEFAULT_MAX_QUEUE_SIZE, DEFAULT_SHUTDOWN_TIMEOUT, POLICY_DROP_OLDEST
+from lib.spool import MetricSpool
+from lib.tracing import KIND_COUNTER, tracer
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_DEFLATE = "deflate"
+COMPRESSION_TYPES = [COMPRESSION_GZIP, COMPRESSION_DEFLATE]
+
+SAMPLE_KEYS = {"intervals"}  # Per-interval samples carried in results, not submitted as metrics of their own
+
+DEFAULT_MAX_PAYLOAD_BYTES = 500_000  # Uncompressed size of each /v2/series request, well under Datadog's 5MB limit
 
 logger = logging.getLogger("network_health")
 
 METRIC_TYPE_COUNT = 1  # Datadog enum for metric type of `count`
 METRIC_TYPE_RATE = 2  # Datadog enum for metric type of `rate`
+METRIC_TYPE_GAUGE = 3  # Datadog enum for metric type of `gauge`
+
+
+METRIC_UNITS = {
+    "transfer_value": "megabyte",
+    "bandwidth_value": "megabyte",
+    "interval_value": "second",
+    "packet_loss": "percent",
+    "minimum_latency": "millisecond",
+    "average_latency": "millisecond",
+    "max_latency": "millisecond",
+    "standard_deviation_latency": "millisecond",
+    "p50_latency": "millisecond",
+    "p95_latency": "millisecond",
+    "p99_latency": "millisecond",
+    "jitter": "millisecond",
+    "max_loss_burst": "packet",
+    "hop_count": "hop",
+    "lookup_time": "millisecond"
+}
+
+METRIC_TYPES = {
+    "transfer_value": METRIC_TYPE_RATE,
+    "bandwidth_value": METRIC_TYPE_RATE,
+    "interval_value": METRIC_TYPE_RATE,
+    "packet_loss": METRIC_TYPE_COUNT,
+    "minimum_latency": METRIC_TYPE_RATE,
+    "average_latency": METRIC_TYPE_RATE,
+    "max_latency": METRIC_TYPE_RATE,
+    "standard_deviation_latency": METRIC_TYPE_RATE,
+    "p50_latency": METRIC_TYPE_RATE,
+    "p95_latency": METRIC_TYPE_RATE,
+    "p99_latency": METRIC_TYPE_RATE,
+    "jitter": METRIC_TYPE_RATE,
+    "max_loss_burst": METRIC_TYPE_COUNT,
+    "hop_count": METRIC_TYPE_GAUGE,
+    "lookup_time": METRIC_TYPE_RATE
+}
 
 
-def generate_network_data_body(data: dict, hostname: str, test_type: str):
+class SeriesEncoder:
     """
-    The generate_network_data_body function takes in a dictionary of data, the hostname, and the test type.
-    It then creates a timestamp for each item in the dictionary and appends it to an empty list.
-    The function returns a series of points with timestamps.
-
-    :param data: dict: Pass the data collected from the network tests
-    :param hostname: str: Identify the hostname of the device
-    :param test_type: str: Determine what type of test is being run
-    :return: A formatted dictionary in a format the Datadog metrics endpoint requires
+    Encodes test results straight into /v2/series JSON, one bytes object per series. The part of a series that does not
+    change between runs, its metric name, type, unit and host resource, is rendered once per metric and reused, so
+    each series only costs formatting its timestamp, value and tags.
     """
-    metric_units = {
-        "transfer_value": "megabyte",
-        "bandwidth_value": "megabyte",
-        "interval_value": "second",
-        "packet_loss": "percent",
-        "minimum_latency": "millisecond",
-        "average_latency": "millisecond",
-        "max_latency": "millisecond",
-        "standard_deviation_latency": "millisecond"
-    }
-
-    metric_types = {
-        "transfer_value": METRIC_TYPE_RATE,
-        "bandwidth_value": METRIC_TYPE_RATE,
-        "interval_value": METRIC_TYPE_RATE,
-        "packet_loss": METRIC_TYPE_COUNT,
-        "minimum_latency": METRIC_TYPE_RATE,
-        "average_latency": METRIC_TYPE_RATE,
-        "max_latency": METRIC_TYPE_RATE,
-        "standard_deviation_latency": METRIC_TYPE_RATE
-    }
-
-    timestamp = int(time.time())
-    series_points = []
-    for key, value in data.items():
-        unit = metric_units[key]
-        metric_type = metric_types[key]
-        each_item = {
-            "metric": f"network_health.{test_type}.{key}",
-            "resources": [
-                {
-                    "name": hostname,
-                    "type": "host"
-                }
-            ],
-            "type": metric_type,
-            "unit": unit,
-            "points": [
-                {
-                    "timestamp": timestamp,
-                    "value": value
-                }
-            ],
-        }
-        series_points.append(each_item)
-    return {"series": series_points}
+
+    def __init__(self, hostname: str):
+        """
+        :param hostname: str: The host the series are reported for
+        """
+        self.resources = json.dumps([{"name": hostname, "type": "host"}], separators=(",", ":"))
+        self.prefixes = {}
+
+    def prefix(self, test_type: str, metric: str):
+        """
+        The prefix method renders the start of a series, up to its timestamp.
+
+        :param test_type: str: The test type, such as `ping_local`
+        :param metric: str: The metric within the test, such as `average_latency`
+        :return: The rendered prefix
+        """
+        prefix = self.prefixes.get((test_type, metric))
+        if prefix is None:
+            prefix = self._render_prefix(f"network_health.{test_type}.{metric}", METRIC_TYPES[metric],
+                                         METRIC_UNITS[metric])
+            self.prefixes[(test_type, metric)] = prefix
+        return prefix
+
+    def _render_prefix(self, name: str, metric_type: int, unit: str):
+        # Metrics without a unit, such as counters of the process itself, leave it out rather than sending null
+        unit = f'"unit":{json.dumps(unit)},' if unit is not None else ""
+        return (f'{{"metric":{json.dumps(name)},"resources":{self.resources},"type":{metric_type},{unit}'
+                f'"points":[{{"timestamp":').encode()
+
+    def encode(self, data, test_type: str, tags: list = None, timestamp: int = None):
+        """
+        The encode function encodes the metrics of one test result.
+
+        :param data: The PingResult or IperfResult of the test. A dictionary of metric to value is also accepted
+        :param test_type: str: Determine what type of test is being run
+        :param tags: list: Optional tags, such as `target:8.8.8.8`, to attach to every series
+        :param timestamp: int: The time of the points. Defaults to now
+        :return: A list of encoded series
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+        suffix = b"}]}"
+        if tags:
+            suffix = b'}],"tags":' + json.dumps(list(tags), separators=(",", ":")).encode() + b"}"
+        series = []
+        for metric, value in data.items():
+            if metric in SAMPLE_KEYS or value is None:
+                continue
+            value = float(value)
+            if not math.isfinite(value):
+                logger.warning(f"Skipping {test_type}.{metric}, its value is {value}")
+                continue
+            series.append(b'%s%d,"value":%r%s' % (self.prefix(test_type, metric), timestamp, value, suffix))
+        return series
+
+    def encode_fleet(self, results_by_target: dict, test_type: str, tags_by_target: dict = None):
+        """
+        The encode_fleet function encodes the results of many targets. Each target's series are tagged with
+        `target:$TARGET` so they can be told apart in Datadog.
+
+        :param results_by_target: dict: A dictionary of target to the results collected for it
+        :param test_type: str: Determine what type of test is being run
+        :param tags_by_target: dict: A dictionary of target to further tags for its series
+        :return: A list of encoded series
+        """
+        timestamp = int(time.time())
+        tags_by_target = tags_by_target or {}
+        series = []
+        for target, data in results_by_target.items():
+            tags = [f"target:{target}"] + tags_by_target.get(target, [])
+            series.extend(self.encode(data, test_type, tags=tags, timestamp=timestamp))
+        return series
+
+    def encode_path(self, results_by_target: dict):
+        """
+        The encode_path function encodes path analysis results. The hop count of every path is tagged with its
+        target, and the metrics of every hop are tagged with the target, the hop's TTL and the address that answered.
+
+        :param results_by_target: dict: A dictionary of target to PathResult
+        :return: A list of encoded series
+        """
+        timestamp = int(time.time())
+        series = []
+        for target, result in results_by_target.items():
+            series.extend(self.encode(result, "path", tags=[f"target:{target}"], timestamp=timestamp))
+            for ttl, hop in enumerate(result.hops, start=1):
+                tags = [f"target:{target}", f"hop:{ttl}"]
+                if hop.address is not None:
+                    tags.append(f"hop_address:{hop.address}")
+                series.extend(self.encode(hop, "path.hop", tags=tags, timestamp=timestamp))
+        return series
+
+    def encode_self_metrics(self, metrics: dict, timestamp: int = None):
+        """
+        The encode_self_metrics function encodes the stats the process collects about itself. Counters are submitted
+        as counts and everything else as gauges.
+
+        :param metrics: dict: Metric name to a tuple of value, unit and kind, from tracing.snapshot_metrics
+        :param timestamp: int: The time of the points. Defaults to now
+        :return: A list of encoded series
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+        series = []
+        for name, (value, unit, kind) in metrics.items():
+            prefix = self.prefixes.get(name)
+            if prefix is None:
+                metric_type = METRIC_TYPE_COUNT if kind == KIND_COUNTER else METRIC_TYPE_GAUGE
+                prefix = self.prefixes[name] = self._render_prefix(f"network_health.{name}", metric_type, unit)
+            series.append(b'%s%d,"value":%r}]}' % (prefix, timestamp, float(value)))
+        return series
 
 
 class DatadogAuthenticationError(Exception):
@@ -89,19 +203,142 @@ class DatadogNotAuthenticated(Exception):
 class DatadogFailedMetricsUpdate(Exception):
     """Raised when updating metrics in Datadog fails."""
 
-    def __init__(self, message=None):
+    def __init__(self, message=None, sent: int = 0):
         self.message = message
+        self.sent = sent  # Series accepted by earlier requests before the failure, which need not be sent again
         super().__init__(self.message)
 
 
+def encode_series_chunks(series: list, max_payload_bytes: int = DEFAULT_MAX_PAYLOAD_BYTES, counts: list = None):
+    """
+    The encode_series_chunks function joins series into as few /v2/series request bodies as possible, starting a new
+    body whenever the current one would grow past max_payload_bytes. Every body is written into the same buffer.
+
+    :param series: list: The series to send, already encoded by SeriesEncoder or as dictionaries
+    :param max_payload_bytes: int: The maximum size of each body
+    :param counts: list: If given, the number of series in each body is appended to it
+    :return: A list of encoded request bodies
+    """
+    prefix, suffix = b'{"series":[', b"]}"
+    chunks = []
+    body = bytearray(prefix)
+    in_body = 0
+    for each_series in series:
+        if not isinstance(each_series, (bytes, bytearray)):
+            each_series = json.dumps(each_series, separators=(",", ":")).encode()
+        if len(body) > len(prefix):
+            if len(body) + len(each_series) + 1 + len(suffix) > max_payload_bytes:
+                body += suffix
+                chunks.append(bytes(body))
+                del body[len(prefix):]
+                if counts is not None:
+                    counts.append(in_body)
+                in_body = 0
+            else:
+                body += b","
+        body += each_series
+        in_body += 1
+    if len(body) > len(prefix):
+        body += suffix
+        chunks.append(bytes(body))
+        if counts is not None:
+            counts.append(in_body)
+    return chunks
+
+
+def compress_body(body: bytes, compression: str = None):
+    """
+    The compress_body function compresses a request body for the given Content-Encoding.
+
+    :param body: bytes: The encoded request body
+    :param compression: str: COMPRESSION_GZIP, COMPRESSION_DEFLATE or None to leave the body as is
+    :return: The compressed body
+    """
+    if compression == COMPRESSION_GZIP:
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    elif compression == COMPRESSION_DEFLATE:
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS)
+    else:
+        return body
+    return compressor.compress(body) + compressor.flush()
+
+
 class DatadogClient:
-    def __init__(self, api_key, host=gethostname()):
+    def __init__(self, api_key, host=gethostname(), batch: bool = False, compression: str = None,
+                 max_payload_bytes: int = DEFAULT_MAX_PAYLOAD_BYTES, retry_policy: RetryPolicy = None,
+                 spool: MetricSpool = None):
+        """
+        :param api_key: The Datadog API key
+        :param host: The hostname the metrics are reported for
+        :param batch: bool: Hold submitted series until flush is called instead of sending each test on its own
+        :param compression: str: Compress request bodies with COMPRESSION_GZIP or COMPRESSION_DEFLATE
+        :param max_payload_bytes: int: The maximum uncompressed size of each request when flushing
+        :param retry_policy: RetryPolicy: How failed submissions are retried. Defaults to RetryPolicy()
+        :param spool: MetricSpool: If given, every series is written to the spool before it is sent, and series that
+            could not be sent are replayed from it on later submissions
+        """
         logger.info(f"Initializing Datadog Client as host={host}")
         self.base_url = "https://api.datadoghq.com/api"
         self.api_key = api_key
         self.host = host
         self.base_headers = {"DD-API-KEY": self.api_key}
         self.credentials_validated = False
+        self.batch = batch
+        self.compression = compression
+        self.max_payload_bytes = max_payload_bytes
+        self.pending_series = []
+        self.pending_lock = threading.Lock()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.spool = spool
+        self.sender = None
+        self.encoder = SeriesEncoder(host)
+        # One pooled, keep-alive session for every request this client makes
+        self.session = requests.Session()
+        self.session.headers.update(self.base_headers)
+        self.session.headers.update({"Accept": "application/json"})
+
+    def start_background_sender(self, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE, policy: str = POLICY_DROP_OLDEST):
+        """
+        The start_background_sender function makes submissions and flushes hand their series to a background thread
+        and return straight away, instead of waiting on Datadog.
+
+        :param self: Refer to the current instance of a class
+        :param max_queue_size: int: The number of batches that may wait to be sent
+        :param policy: str: What to do when the queue is full, one of sender.BACKPRESSURE_POLICIES
+        """
+        self.sender = BackgroundSender(self, max_queue_size=max_queue_size, policy=policy)
+        logger.info(f"Started background sender with a queue of {max_queue_size} and the {policy} policy")
+
+    def stop_background_sender(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        """
+        The stop_background_sender function sends anything still queued, waiting up to timeout seconds, and stops the
+        background thread. Later submissions and flushes are sent from the calling thread.
+
+        :param self: Refer to the current instance of a class
+        :param timeout: float: Seconds to wait for queued series to be sent
+        :return: True if every queued series was sent
+        """
+        if self.sender is None:
+            return True
+        logger.info(f"Waiting up to {timeout} seconds for queued series to be sent...")
+        delivered = self.sender.close(timeout)
+        self.sender = None
+        return delivered
+
+    def close(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        """
+        The close function sends anything still queued, waiting up to timeout seconds, then releases the client's
+        connections and spool.
+
+        :param self: Refer to the current instance of a class
+        :param timeout: float: Seconds to wait for queued series to be sent
+        :return: True if every queued series was sent
+        """
+        delivered = self.stop_background_sender(timeout)
+        if self.spool is not None:
+            self.spool.close()
+        self.session.close()
+        return delivered
 
     def validate_credentials(self):
         """
@@ -113,31 +350,37 @@ class DatadogClient:
         :return: True if the credentials are valid, and raises an exception otherwise
         """
         url = f"{self.base_url}/v1/validate"
-        headers = dict(self.base_headers)
-        headers.update({"Accept": "application/json"})
-        response = requests.get(url, headers=headers)
+        response = self.session.get(url)
         if response.ok:
             self.credentials_validated = True
         else:
             raise DatadogAuthenticationError(
                 f"Failed to validate Datadog credentials, status code: {response.status_code} || Error message: {response.reason}")
 
-    def submit_metric_with_retries(self, response: Response, data: dict, retries=10):
-        if response.ok:
+    def submit_metric_with_retries(self, response: Response, data):
+        """
+        The submit_metric_with_retries function retries a failed submission according to the client's retry policy.
+        Failures are raised to the caller instead of ending the process.
+
+        :param self: Refer to the current instance of a class
+        :param response: Response: The response to the first attempt, or None to make the first attempt here
+        :param data: The data to submit, either a dictionary or an already encoded body
+        :return: True once the metrics are submitted. Raises DatadogAuthenticationError if Datadog rejects the API key,
+            and DatadogFailedMetricsUpdate if the submission could not be completed
+        """
+        if not self.credentials_validated:
+            raise DatadogNotAuthenticated()
+        with tracer.span("datadog.submit"):
+            response, succeeded = self.retry_policy.call(lambda: self.handle_metric_submission(data),
+                                                         response=response)
+        if succeeded:
             return True
-        if not response.ok:
-            if response.status_code == 403:
-                logger.error(f"Datadog reports you are unauthorized! Error: {response.json()}")
-                exit(255)
-        for attempt in range(retries):
-            attempt = attempt + 1
-            logger.info(f"Attempting retry: {attempt}/{retries}...")
-            response = self.handle_metric_submission(data)
-            if response.ok:
-                logger.info("Successfully sent metrics!")
-                return True
-        logger.error(f"Failed to update Datadog with metric!")
-        exit(1)
+        if response is not None and response.status_code == 403:
+            logger.error(f"Datadog reports you are unauthorized! Error: {response.text}")
+            raise DatadogAuthenticationError(f"Datadog rejected the API key, status code: {response.status_code}")
+        status = "no response" if response is None else f"status code: {response.status_code}"
+        logger.error(f"Failed to update Datadog with metric! ({status})")
+        raise DatadogFailedMetricsUpdate(f"Failed to submit metrics to Datadog ({status})")
 
     def handle_metric_submission(self, data):
         """
@@ -146,43 +389,147 @@ class DatadogClient:
         If it fails, it raises an exception.
 
         :param self: Refer to the current instance of a class
-        :param data: Pass the data to be sent to datadog
+        :param data: Pass the data to be sent to datadog, either a dictionary or an already encoded body
         :return: True if the metrics are successfully submitted to datadog
         """
         if not self.credentials_validated:
             raise DatadogNotAuthenticated()
         url = f"{self.base_url}/v2/series"
-        headers = dict(self.base_headers)
-        headers.update({
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-            "DD-API-KEY": self.api_key
-        })
-        data = json.dumps(data)
-        response = requests.post(url, headers=headers, data=data)
+        headers = {"Content-Type": "application/json"}
+        if isinstance(data, dict):
+            data = json.dumps(data, separators=(",", ":")).encode()
+        if self.compression is not None:
+            with tracer.span("datadog.compress"):
+                data = compress_body(data, self.compression)
+            headers["Content-Encoding"] = self.compression
+        tracer.observe("datadog.request_bytes", len(data))
+        with tracer.span("datadog.request"):
+            response = self.session.post(url, headers=headers, data=data)
         return response
 
-    def submit_ping_network_health(self, data: dict, local: bool = True):
+    def submit_series(self, series: list):
+        """
+        The submit_series function sends series to Datadog, or holds them until flush is called when the client is
+        batching.
+
+        :param self: Refer to the current instance of a class
+        :param series: list: Series encoded by SeriesEncoder
+        """
+        if self.batch:
+            with self.pending_lock:
+                self.pending_series.extend(series)
+            logger.info(f"Queued {len(series)} series for the next flush")
+            return
+        if self.sender is not None:
+            self.sender.enqueue(series)
+            return
+        self.retry_policy.start_cycle()
+        self.deliver_series(series)
+
+    def flush(self):
+        """
+        The flush function sends every series held since the last flush, in as few requests as the payload size limit
+        allows.
+
+        :param self: Refer to the current instance of a class
+        :return: The number of series sent, including any replayed from the spool. With a background sender the series
+            are only queued, and the number queued is returned
+        """
+        with self.pending_lock:
+            series, self.pending_series = self.pending_series, []
+        if self.sender is not None:
+            self.sender.enqueue(series)
+            return len(series)
+        if len(series) == 0 and self.spool is None:
+            return 0
+        self.retry_policy.start_cycle()
+        sent = self.deliver_series(series)
+        logger.info(f"Successfully flushed {sent} series")
+        return sent
+
+    def deliver_series(self, series: list):
+        """
+        The deliver_series function sends series to Datadog. When the client has a spool, the series are written to it
+        first and the whole spool is replayed oldest first, so anything left over from earlier failures goes out ahead
+        of the new series and nothing is lost if this attempt fails too.
+
+        :param self: Refer to the current instance of a class
+        :param series: list: The series to send
+        :return: The number of series sent. Raises DatadogFailedMetricsUpdate if some could not be sent
+        """
+        if self.spool is None:
+            self.send_series(series)
+            return len(series)
+        if len(series) > 0:
+            self.spool.append(series)
+        self.spool.seal()
+        return self.spool.replay(self.send_series)
+
+    def send_series(self, series: list):
+        """
+        The send_series function sends series to Datadog in size bounded requests.
+
+        :param self: Refer to the current instance of a class
+        :param series: list: The series to send
+        :return: Raises DatadogFailedMetricsUpdate if any request could not be completed, with the number of series
+            sent by the requests before it
+        """
+        counts = []
+        with tracer.span("datadog.chunk"):
+            chunks = encode_series_chunks(series, self.max_payload_bytes, counts)
+        for body in chunks:
+            tracer.observe("datadog.payload_bytes", len(body))
+        logger.info(f"Sending {len(series)} series to Datadog in {len(chunks)} request(s)...")
+        for index, body in enumerate(chunks):
+            try:
+                self.submit_metric_with_retries(None, body)
+            except DatadogFailedMetricsUpdate:
+                raise DatadogFailedMetricsUpdate(f"Failed to submit {len(chunks) - index}/{len(chunks)} request(s) "
+                                                 f"to Datadog", sent=sum(counts[:index]))
+
+    def submit_ping_network_health(self, data, local: bool = True, tags: list = None):
         """
         The submit_ping_network_health function is used to submit a ping test result to the network health endpoint.
             The function takes two arguments: data and local. Data is a dictionary containing the following keys: -
 
         :param self: Bind the method to an object
-        :param data: dict: Pass in the data that is to be sent
+        :param data: PingResult: Pass in the data that is to be sent
         :param local: bool: Determine if the ping is local or remote and sets the metric name based on this
+        :param tags: list: Optional tags to attach to every series
         """
         if local:
             test_type = "ping_local"
         else:
             test_type = "ping_remote"
-        logger.info("Generating data body for ping test...")
-        data = generate_network_data_body(data, self.host, test_type=test_type)
-        logger.info(f"Generated ping data body, submitting to endpoint as {test_type}")
-        response = self.handle_metric_submission(data)
-        self.submit_metric_with_retries(response, data)
+        logger.info("Encoding series for ping test...")
+        with tracer.span("datadog.encode"):
+            series = self.encoder.encode(data, test_type=test_type, tags=tags)
+        logger.info(f"Encoded {len(series)} ping series, submitting to endpoint as {test_type}")
+        self.submit_series(series)
         logger.info(f"Successfully submitted metric data for ping as {test_type}")
 
-    def submit_bandwidth_data(self, data: dict, local: bool = True):
+    def submit_ping_fleet(self, results_by_target: dict, local: bool = True, tags_by_target: dict = None):
+        """
+        The submit_ping_fleet function submits the ping results of many targets in a single request.
+            Each target's metrics are tagged with `target:$TARGET`.
+
+        :param self: Bind the method to an object
+        :param results_by_target: dict: A dictionary of target to ping results
+        :param local: bool: Determine if the pings are local or remote and sets the metric name based on this
+        :param tags_by_target: dict: Optional dictionary of target to further tags for its series
+        """
+        if local:
+            test_type = "ping_local"
+        else:
+            test_type = "ping_remote"
+        logger.info(f"Encoding series for {len(results_by_target)} ping target(s)...")
+        with tracer.span("datadog.encode"):
+            series = self.encoder.encode_fleet(results_by_target, test_type=test_type, tags_by_target=tags_by_target)
+        logger.info(f"Encoded {len(series)} fleet ping series, submitting to endpoint as {test_type}")
+        self.submit_series(series)
+        logger.info(f"Successfully submitted fleet metric data for ping as {test_type}")
+
+    def submit_bandwidth_data(self, data, local: bool = True, tags: list = None):
 
         """
         The submit_bandwidth_data function is used to submit bandwidth data to the network_health endpoint.
@@ -190,17 +537,57 @@ class DatadogClient:
             The function also takes a boolean value that determines whether the test was local or remote.
 
         :param self: Bind the method to an object
-        :param data: dict: Pass in the data that is to be submitted
+        :param data: IperfResult: Pass in the data that is to be submitted
         :param local: bool: Determine whether the test is local or remote
+        :param tags: list: Optional tags, such as `target:10.0.0.5`, to attach to every series
         :return: The handle_metric_submission function
         """
         if local:
             test_type = "bandwidth_local"
         else:
             test_type = "bandwidth_remote"
-        logger.info("Generating data body for bandwidth test...")
-        data = generate_network_data_body(data, self.host, test_type=test_type)
-        logger.info(f"Generated bandwidth data body, submitting to endpoint as {test_type}")
-        response = self.handle_metric_submission(data)
-        self.submit_metric_with_retries(response, data)
+        logger.info("Encoding series for bandwidth test...")
+        with tracer.span("datadog.encode"):
+            series = self.encoder.encode(data, test_type=test_type, tags=tags)
+        logger.info(f"Encoded {len(series)} bandwidth series, submitting to endpoint as {test_type}")
+        self.submit_series(series)
         logger.info(f"Successfully submitted metric data for bandwidth as {test_type}")
+
+    def submit_path_analysis(self, results_by_target: dict):
+        """
+        The submit_path_analysis function submits the hop count of every traced path and the loss and latency of every
+        hop on it.
+
+        :param self: Bind the method to an object
+        :param results_by_target: dict: A dictionary of target to PathResult
+        """
+        logger.info(f"Encoding series for {len(results_by_target)} path(s)...")
+        with tracer.span("datadog.encode"):
+            series = self.encoder.encode_path(results_by_target)
+        logger.info(f"Encoded {len(series)} path series, submitting to endpoint")
+        self.submit_series(series)
+        logger.info("Successfully submitted metric data for path analysis")
+
+    def submit_dns(self, results_by_target: dict):
+        """
+        The submit_dns function submits how long every target took to resolve, as `network_health.dns.lookup_time`
+        tagged with the target.
+
+        :param self: Bind the method to an object
+        :param results_by_target: dict: A dictionary of target to DnsResult
+        """
+        series = self.encoder.encode_fleet(results_by_target, test_type="dns")
+        logger.info(f"Encoded {len(series)} DNS series")
+        self.submit_series(series)
+
+    def submit_self_metrics(self, metrics: dict):
+        """
+        The submit_self_metrics function submits the stats the process collected about its own runs, such as how long
+        each stage took and how many retries were needed, as `network_health.self.*` metrics.
+
+        :param self: Bind the method to an object
+        :param metrics: dict: Metric name to a tuple of value, unit and kind, from tracing.snapshot_metrics
+        """
+        series = self.encoder.encode_self_metrics(metrics)
+        logger.info(f"Encoded {len(series)} self metric series")
+        self.submit_series(series)
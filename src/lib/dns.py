@@ -0,0 +1,167 @@
+import ipaddress
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter_ns
+
+from lib.results import DnsResult
+from lib.tracing import tracer
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_CACHE_TTL = 300.0  # Seconds a resolved address is reused. getaddrinfo does not expose the record's own TTL
+DEFAULT_NEGATIVE_TTL = 30.0  # Seconds a failed lookup is remembered, so a dead name is not looked up by every test
+DEFAULT_MAX_WORKERS = 16  # Lookups running at the same time when many targets are resolved up front
+
+
+class ResolutionFailed(Exception):
+    """Raised when a target can not be resolved to an IPv4 address."""
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class _Entry:
+    """The outcome of one lookup: the address, or the error it failed with."""
+
+    __slots__ = ("address", "error", "expires_at")
+
+    def __init__(self, address: str, error: Exception, expires_at: float):
+        self.address = address
+        self.error = error
+        self.expires_at = expires_at
+
+
+def is_address(name: str):
+    try:
+        ipaddress.ip_address(name)
+    except ValueError:
+        return False
+    return True
+
+
+class Resolver:
+    """
+    Resolves targets once and hands every test the cached address, so no test spends part of its measurement waiting on
+    DNS and a fleet does not look the same names up on every run. Targets are resolved up front and concurrently at the
+    start of each cycle, and the time every lookup took is kept until it is drained and reported.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_CACHE_TTL, negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 max_workers: int = DEFAULT_MAX_WORKERS, clock=time.monotonic):
+        """
+        :param ttl: float: Seconds a resolved address is reused. 0 looks the target up on every call
+        :param negative_ttl: float: Seconds a failed lookup is remembered, at most ttl
+        :param max_workers: int: The maximum number of lookups running at the same time
+        :param clock: Returns the current time in seconds
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_workers = max_workers
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.lookups = {}  # Target to the DnsResult of its latest lookup since the last drain
+
+    def _cached(self, name: str):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or self.clock() >= entry.expires_at:
+                return None
+            return entry
+
+    def _lookup(self, name: str):
+        """
+        The _lookup function resolves a target with getaddrinfo, so /etc/hosts and the rest of the system's resolver
+        configuration apply just as they do for ping and iperf, and caches the outcome.
+
+        :param name: str: The target
+        :return: The _Entry of the lookup
+        """
+        tracer.count("dns.lookups")
+        start = perf_counter_ns()
+        try:
+            address = socket.getaddrinfo(name, None, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+            error = None
+        except (OSError, UnicodeError) as e:
+            address = None
+            error = ResolutionFailed(f"Failed to resolve {name}: {e}")
+        lookup_time = round((perf_counter_ns() - start) / 1e6, 3)
+        if error is None:
+            logger.debug(f"Resolved target: {name} to {address} in {lookup_time}ms")
+            expires_at = self.clock() + self.ttl
+        else:
+            logger.error(f"Failed to resolve target: {name} after {lookup_time}ms: {error}")
+            tracer.count("dns.failures")
+            expires_at = self.clock() + min(self.ttl, self.negative_ttl)
+        entry = _Entry(address, error, expires_at)
+        with self.lock:
+            self.entries[name] = entry
+            self.lookups[name] = DnsResult(address=address, lookup_time=lookup_time)
+        return entry
+
+    def resolve(self, name: str):
+        """
+        The resolve function looks up the IPv4 address of a target, from the cache while the cached lookup is fresh.
+
+        :param name: str: The target, a host name or an address
+        :return: The address. Raises ResolutionFailed if the target does not resolve
+        """
+        if is_address(name):
+            return name
+        entry = self._cached(name)
+        if entry is not None:
+            tracer.count("dns.cache_hits")
+        else:
+            entry = self._lookup(name)
+        if entry.error is not None:
+            raise entry.error
+        return entry.address
+
+    def address_or_name(self, name: str):
+        """
+        The address_or_name function resolves a target for tools that can resolve it themselves, such as the ping and
+        iperf binaries and socket.create_connection. A target that does not resolve to an IPv4 address, such as an
+        IPv6-only host, is handed over as it is.
+
+        :param name: str: The target
+        :return: The cached address, or the name if it did not resolve
+        """
+        try:
+            return self.resolve(name)
+        except ResolutionFailed:
+            return name
+
+    def prefetch(self, names):
+        """
+        The prefetch function resolves every target that is not cached yet, concurrently, so the tests that follow
+        find their addresses in the cache.
+
+        :param names: The targets
+        """
+        names = [name for name in dict.fromkeys(names) if not is_address(name) and self._cached(name) is None]
+        if len(names) == 0:
+            return
+        with tracer.span("dns.prefetch"):
+            max_workers = max(1, min(self.max_workers, len(names)))
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dns") as executor:
+                entries = list(executor.map(self._lookup, names))
+        failed = sum(1 for entry in entries if entry.error is not None)
+        logger.info(f"Resolved {len(names) - failed}/{len(names)} target(s) with {max_workers} worker(s)")
+
+    def drain(self):
+        """
+        The drain function takes the lookups made since the last drain.
+
+        :return: A dictionary of target to DnsResult
+        """
+        with self.lock:
+            lookups, self.lookups = self.lookups, {}
+        return lookups
+
+
+resolver = Resolver()  # Shared by every module, configured from the command line
+resolve = resolver.resolve
+address_or_name = resolver.address_or_name
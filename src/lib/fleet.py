@@ -0,0 +1,72 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lib import ping, prober
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_MAX_WORKERS = 64
+TIMEOUT_GRACE_SECONDS = 10  # Added on top of one second per packet when no timeout is given
+
+
+def load_targets(path: str):
+    """
+    The load_targets function reads a list of targets from a file. Each line holds one target, blank lines and lines
+    starting with `#` are ignored.
+
+    :param path: str: Path to the file with the targets
+    :return: A list of targets in the order they appear in the file
+    """
+    targets = []
+    with open(path) as targets_file:
+        for line in targets_file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                targets.append(line)
+    logger.info(f"Loaded {len(targets)} target(s) from {path}")
+    return targets
+
+
+def run_ping_fleet(targets: list, number_of_packets: int = 100, max_workers: int = DEFAULT_MAX_WORKERS,
+                   timeout: float = None, native: bool = False, udp_port: int = None):
+    """
+    The run_ping_fleet function runs run_ping against every target using a bounded pool of workers, so the whole
+    fleet takes about as long as a single ping run while at most max_workers ping processes exist at once.
+
+    :param targets: list: The targets to ping
+    :param number_of_packets: int: Specify the number of packets to send to each target
+    :param max_workers: int: The maximum number of pings running at the same time. Not used with native, where every
+        target is probed from a single thread
+    :param timeout: float: Seconds to wait for each ping before giving up on that target. With native, the seconds the
+        whole run may take before it is cut short. Defaults to one second per packet plus a grace period
+    :param native: bool: Probe every target from this process over a single socket instead of running ping processes
+    :param udp_port: int: With native, send UDP probes to this port instead of ICMP echo requests
+    :return: A dictionary of target to ping results, and a dictionary of target to the exception it raised
+    """
+    if timeout is None:
+        timeout = int(number_of_packets) + TIMEOUT_GRACE_SECONDS
+    if native:
+        return prober.probe_targets(targets, number_of_packets=number_of_packets, udp_port=udp_port,
+                                    max_duration=timeout)
+    targets = list(dict.fromkeys(targets))  # Drop duplicates while keeping the order
+    results = {}
+    errors = {}
+    if len(targets) == 0:
+        return results, errors
+
+    max_workers = max(1, min(max_workers, len(targets)))
+    logger.info(f"Pinging {len(targets)} target(s) with {max_workers} worker(s), timeout: {timeout} seconds...")
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ping-fleet") as executor:
+        futures = {
+            executor.submit(ping.run_ping, target, number_of_packets=number_of_packets, timeout=timeout): target
+            for target in targets
+        }
+        for future in as_completed(futures):
+            target = futures[future]
+            try:
+                results[target] = future.result()
+            except Exception as e:
+                logger.error(f"Ping against target: {target} failed: {e!r}")
+                errors[target] = e
+    logger.info(f"Completed fleet ping: {len(results)} succeeded, {len(errors)} failed")
+    return results, errors
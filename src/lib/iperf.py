@@ -1,18 +1,24 @@
-import subprocess
 import re
 import platform
 import logging
+from collections import namedtuple
+from time import perf_counter_ns
+
+from lib.dns import address_or_name
+from lib.process import ProcessTimedOut, format_stderr, stream_lines
+from lib.results import IperfResult
+from lib.tracing import traced, tracer
 
 
 class IperfExecutionFailed(Exception):
-    """Raised when running the ping process fails."""
+    """Raised when running the iperf process fails."""
 
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
 
 
 class FailedToParseIperfResults(Exception):
-    """Raised when running the ping process fails."""
+    """Raised when the iperf output can not be parsed."""
 
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
@@ -23,60 +29,132 @@ logger = logging.getLogger("network_health")
 CURRENT_PLATFORM = platform.system()
 logger.info(f"Operating System: {CURRENT_PLATFORM}")
 
+DEFAULT_REPORT_INTERVAL = 1  # Seconds between the interval reports iperf prints while running
+
+# Matches both interval reports and the final report, e.g. `[  1] 0.00-1.00 sec   112 MBytes   112 MBytes/sec`
+INTERVAL_PATTERN = re.compile(
+    r"\]\s*(\d+(?:\.\d+)?)\s*-\s*(\d+(?:\.\d+)?)\s*sec\s+(\d+(?:\.\d+)?)\s*MBytes\s+(\d+(?:\.\d+)?)\s*MBytes\/sec")
+
+IperfInterval = namedtuple("IperfInterval", ["start", "end", "transfer", "bandwidth"])
+
 
-def run_iperf(target: str, port: int=None):
+def parse_interval(line: str):
     """
-    The run_iperf function runs the iperf command on a target host and returns the transfer value and bandwidth value.
+    The parse_interval function parses one report line printed by iperf.
 
-    :param target: str: Specify the target ip address
-    :return: A dictionary with two keys:
+    :param line: str: A line printed by iperf
+    :return: An IperfInterval with the transfer in megabytes and bandwidth in megabytes/second, or None if the line is
+        not a report
     """
+    match = INTERVAL_PATTERN.search(line)
+    if match is None:
+        return None
+    return IperfInterval(float(match.group(1)), float(match.group(2)), float(match.group(3)), float(match.group(4)))
 
-    def validate_iperf_results(match_value: re.Match):
-        if match_value is not None:
-            return match_value.group(1)
-        logger.error("Failed to find march on pattern!")
-        raise FailedToParseIperfResults
 
-    logger.info(f"Starting iperf process with target: {target}...")
+def is_summary(interval: IperfInterval, previous: IperfInterval = None):
+    """
+    The is_summary function tells the final report of a run from its interval reports. Interval reports follow on from
+    one another, each starting where the previous one ended, while the final report starts over at zero and covers the
+    whole run, however short the run was.
+
+    :param interval: IperfInterval: The report
+    :param previous: IperfInterval: The last interval report before it, or None if there was none
+    :return: True if the report is the final report
+    """
+    return previous is not None and interval.start == 0 and interval.start < previous.end
+
+
+def stream_iperf(target: str, port: int = None, report_interval: int = DEFAULT_REPORT_INTERVAL,
+                 timeout: float = None, stderr_lines: list = None):
+    """
+    The stream_iperf function runs iperf against a target and yields every report as soon as iperf prints it. The last
+    report starts at zero and covers the whole test.
+
+    :param target: str: Specify the target ip address
+    :param port: int: Specify the port of the iperf server
+    :param report_interval: int: Seconds between interval reports
+    :param timeout: float: Seconds to let iperf run before killing it. Runs until iperf exits if not specified
+    :param stderr_lines: list: If given, the last lines iperf writes to stderr are appended to it
+    :return: A generator of IperfInterval objects. Raises ProcessTimedOut once iperf is killed for running too long
+    """
     if CURRENT_PLATFORM == "Windows":
         command = ["iperf2", "-c", target, "-w", "128K", "-f", "M"]
     else:
         command = ["iperf", "-c", target, "-f", "M"]
+    command.extend(["-i", str(report_interval)])
     if port is not None:
         logger.info(f"Port is specified, appending: `-p {port}`")
-        command.extend(["-p", port])
-
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    stdout, stderr = stdout.decode(), stderr.decode()
-    print(stdout)
+        command.extend(["-p", str(port)])
+
+    parse_ns = 0  # Parsing is timed line by line and recorded once, as a single stage
+    try:
+        for line in stream_lines(command, timeout=timeout, stderr_lines=stderr_lines):
+            logger.debug(f"iperf output: {line}")
+            start = perf_counter_ns()
+            interval = parse_interval(line)
+            parse_ns += perf_counter_ns() - start
+            if interval is not None:
+                yield interval
+    finally:
+        tracer.record("iperf.parse", parse_ns)
+
+
+@traced("iperf.run")
+def run_iperf(target: str, port: int = None, timeout: float = None, on_interval=None):
+    """
+    The run_iperf function runs the iperf command on a target host and returns the transfer value and bandwidth value.
+    If iperf is killed or times out before printing its final report, the results are computed from the interval
+    reports received up to that point.
 
-    logger.info("Completed iperf process, parsing output...")
+    :param target: str: Specify the target ip address
+    :param port: int: Specify the port of the iperf server
+    :param timeout: float: Seconds to wait for the iperf process before killing it. Waits forever if not specified
+    :param on_interval: Called with each IperfInterval as iperf reports it
+    :return: An IperfResult with the metrics: (transfer_value, bandwidth_value, interval_value). Its intervals hold
+        the IperfInterval of every interval report
+    """
+    logger.info(f"Starting iperf process with target: {target}...")
 
-    transfer_pattern = r"sec\s*(\d*.\d*) MBytes"
-    bandwidth_pattern = r"MBytes\s* (\d*.\d*)\s*MBytes\/sec"
-    interval_pattern = r"-(.*\d) sec"
+    intervals = []
+    summary = None
+    stderr_lines = []
+    timed_out = False
+    try:
+        for interval in stream_iperf(address_or_name(target), port=port, timeout=timeout,
+                                     stderr_lines=stderr_lines):
+            if on_interval is not None:
+                on_interval(interval)
+            if is_summary(interval, intervals[-1] if intervals else None):
+                summary = interval
+            else:
+                intervals.append(interval)
+    except ProcessTimedOut:
+        logger.error(f"iperf against target: {target} did not complete within {timeout} seconds")
+        timed_out = True
 
-    pattern = r"]\s*0.00-(\d*.\d*) sec\s*(\d*)\s*MBytes\s*(\d*.\d*) \s*MBytes"
+    logger.info("Completed iperf process, parsing output...")
 
-    match = re.search(pattern, stdout)
-    
-    if match:
-        transfer_match = match.group(1)
-        bandwidth_match = match.group(2)
-        interval_match = match.group(3)
+    if summary is None:
+        if len(intervals) == 0:
+            logger.error(f"Failed to find regex match from iperf results for target: {target}")
+            if timed_out:
+                raise IperfExecutionFailed(f"iperf against {target} timed out after {timeout} seconds"
+                                           f"{format_stderr(stderr_lines)}")
+            if stderr_lines:
+                raise IperfExecutionFailed(f"iperf against {target} failed{format_stderr(stderr_lines)}")
+            raise FailedToParseIperfResults(f"No iperf reports found for {target}")
+        transfer = sum(interval.transfer for interval in intervals)
+        duration = intervals[-1].end - intervals[0].start
+        summary = IperfInterval(intervals[0].start, intervals[-1].end, transfer,
+                                transfer / duration if duration else 0.0)
+        logger.warning(f"iperf against target: {target} did not finish, reporting partial results from "
+                       f"{len(intervals)} interval(s)")
     else:
-        logger.error(f"Failed to find regex match from iperf results, stdout:\n {stdout}")
-        exit(1)
-
-    logger.info("Found pattern matches from iperf output!")
+        logger.info("Found pattern matches from iperf output!")
 
-    results = {
-        "transfer_value": transfer_match,
-        "bandwidth_value": bandwidth_match,
-        "interval_value": interval_match
-    }
+    results = IperfResult(transfer_value=summary.transfer, bandwidth_value=summary.bandwidth,
+                          interval_value=round(summary.end - summary.start, 3), intervals=intervals)
 
     logger.info("Results:")
 
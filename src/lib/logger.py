@@ -1,12 +1,9 @@
 import logging
 import os
-from datetime import datetime
+from logging.handlers import TimedRotatingFileHandler
 from sys import exit
 from pathlib import Path
 
-now = datetime.utcnow()
-date = now.strftime("%Y-%m-%d")
-
 
 def generate_logger(logger_name, level=logging.INFO):
     """
@@ -23,16 +20,14 @@ def generate_logger(logger_name, level=logging.INFO):
     home_dir = os.path.expanduser("~")
     system_log_path = f"/var/log/{logger_name}"
     backup_log_path = f"{home_dir}/.logs/{logger_name}"
-    if not os.path.exists(system_log_path):
-        try:
-            os.makedirs(system_log_path)
+    try:
+        os.makedirs(system_log_path, exist_ok=True)
+        if os.access(system_log_path, os.W_OK):
             log_path = system_log_path
-        except PermissionError:
-            if not os.path.exists(backup_log_path):
-                os.makedirs(backup_log_path)
-            else:
-                log_path = backup_log_path
-    else:
+    except PermissionError:
+        pass
+    if log_path is None:
+        os.makedirs(backup_log_path, exist_ok=True)
         log_path = backup_log_path
     # Create a logger
     logger = logging.getLogger(logger_name)
@@ -48,8 +43,11 @@ def generate_logger(logger_name, level=logging.INFO):
     if log_path is None:
         print(f"Failed to setup logging")
         exit(255)
-    log_file = Path(f"{log_path}/{date}.log")
-    file_handler = logging.FileHandler(log_file)
+    # Log to {logger_name}.log and move it to {date}.log at every UTC midnight, so a long running daemon gets a file
+    # per day too
+    log_file = Path(f"{log_path}/{logger_name}.log")
+    file_handler = TimedRotatingFileHandler(log_file, when="midnight", utc=True)
+    file_handler.namer = lambda name: os.path.join(log_path, f"{name.rsplit('.', 1)[-1]}.log")
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
 
@@ -0,0 +1,418 @@
+import errno
+import logging
+import math
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+
+from lib.dns import ResolutionFailed, resolve
+from lib.results import HopResult, PathResult
+from lib.tracing import traced
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_BASE_PORT = 33434  # Traditional traceroute base port. The probe with TTL n is sent to DEFAULT_BASE_PORT + n - 1
+DEFAULT_MAX_TTL = 30
+DEFAULT_ROUNDS = 10  # Every hop is probed once per round
+DEFAULT_INTERVAL = 1.0  # Seconds between rounds. A reply arriving after the next round is sent counts as lost
+DEFAULT_TIMEOUT = 1.0  # Seconds to wait for stragglers after the last round
+DEFAULT_CACHE_TTL = 600.0  # Seconds a discovered path is trusted before it is discovered again
+
+MODE_RECVERR = "recverr"  # Unprivileged UDP sockets reading ICMP errors from their error queue (Linux)
+MODE_RAW = "raw"  # UDP probes with replies read from a privileged raw ICMP socket
+
+# Linux values, not exposed by the socket module of every Python version
+IP_RECVERR = getattr(socket, "IP_RECVERR", 11)
+MSG_ERRQUEUE = getattr(socket, "MSG_ERRQUEUE", 0x2000)
+SO_EE_ORIGIN_ICMP = 2
+
+ICMP_DEST_UNREACHABLE = 3
+ICMP_PORT_UNREACHABLE = 3  # Code of ICMP_DEST_UNREACHABLE sent by the target itself once a probe reaches it
+ICMP_TIME_EXCEEDED = 11
+
+EXTENDED_ERROR = struct.Struct("=IBBBBII")  # sock_extended_err: errno, origin, type, code, pad, info, data
+OFFENDER = struct.Struct("=H2x4s")  # sockaddr_in of the router that sent the error: family, port, address
+UDP_PORTS = struct.Struct("!HH")  # source port, destination port
+
+PROBE_PAYLOAD = b"NHPATH00" * 4
+SEND_ATTEMPTS = 3  # Sends of one probe, each after reading the error queue that made the previous one fail
+
+
+class PathAnalysisUnavailable(Exception):
+    """Raised when no socket type usable for path analysis can be opened."""
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class _HopStats:
+    """
+    The per-hop counters of one path, each a flat array indexed by TTL - 1, so a path of 30 hops costs a few hundred
+    bytes however many rounds are run.
+    """
+
+    __slots__ = ("sent", "received", "total", "total_squares", "best", "worst", "addresses")
+
+    def __init__(self, max_ttl: int):
+        self.sent = array("I", bytes(4 * max_ttl))
+        self.received = array("I", bytes(4 * max_ttl))
+        self.total = array("d", bytes(8 * max_ttl))
+        self.total_squares = array("d", bytes(8 * max_ttl))
+        self.best = array("d", [math.inf]) * max_ttl
+        self.worst = array("d", bytes(8 * max_ttl))
+        self.addresses = [None] * max_ttl
+
+    def add_reply(self, index: int, rtt: float, address: str):
+        self.received[index] += 1
+        self.total[index] += rtt
+        self.total_squares[index] += rtt * rtt
+        if rtt < self.best[index]:
+            self.best[index] = rtt
+        if rtt > self.worst[index]:
+            self.worst[index] = rtt
+        if self.addresses[index] is None:
+            self.addresses[index] = address
+
+    def hop_result(self, index: int):
+        sent, received = self.sent[index], self.received[index]
+        packet_loss = round(100.0 * (sent - received) / sent, 3) if sent else 100.0
+        if received == 0:
+            return HopResult(address=self.addresses[index], packet_loss=packet_loss)
+        mean = self.total[index] / received
+        variance = max(0.0, self.total_squares[index] / received - mean * mean)
+        return HopResult(address=self.addresses[index], packet_loss=packet_loss,
+                         minimum_latency=round(self.best[index], 3), average_latency=round(mean, 3),
+                         max_latency=round(self.worst[index], 3),
+                         standard_deviation_latency=round(math.sqrt(variance), 3))
+
+
+class CachedPath:
+    """A discovered path: the address of every hop and the number of hops to the target."""
+
+    __slots__ = ("addresses", "hop_count", "discovered_at")
+
+    def __init__(self, addresses: list, hop_count: int, discovered_at: float):
+        self.addresses = addresses
+        self.hop_count = hop_count
+        self.discovered_at = discovered_at
+
+
+class PathCache:
+    """
+    Remembers the path to every target, so later runs only probe as far as the target instead of discovering the
+    route up to the maximum TTL again. A path is forgotten once it is older than ttl seconds, or as soon as a run sees
+    the route change.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_CACHE_TTL, clock=time.monotonic):
+        """
+        :param ttl: float: Seconds a path is trusted
+        :param clock: Returns the current time in seconds
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.paths = {}
+
+    def get(self, target: str):
+        """
+        The get function looks up the path to a target.
+
+        :param target: str: The target
+        :return: The CachedPath, or None if the path is unknown or too old
+        """
+        with self.lock:
+            path = self.paths.get(target)
+            if path is None or self.clock() - path.discovered_at >= self.ttl:
+                return None
+            return path
+
+    def update(self, target: str, addresses: list, hop_count: int):
+        """
+        The update function stores the path seen by a run. A path that changed is rediscovered up to the maximum TTL
+        on the next run, and one that is unchanged keeps its discovery time, so it still expires after ttl seconds.
+
+        :param target: str: The target
+        :param addresses: list: The address of every hop, None for hops that did not answer
+        :param hop_count: int: The number of hops to the target, or None if it was not reached
+        """
+        with self.lock:
+            cached = self.paths.get(target)
+            if hop_count is None:
+                self.paths.pop(target, None)
+                return
+            if cached is not None and cached.hop_count == hop_count:
+                changed = [ttl for ttl, (old, new) in enumerate(zip(cached.addresses, addresses), start=1)
+                           if old is not None and new is not None and old != new]
+                if len(changed) == 0:
+                    for index, address in enumerate(addresses):
+                        if cached.addresses[index] is None:
+                            cached.addresses[index] = address
+                    return
+                logger.info(f"Route to {target} changed at hop(s) {', '.join(map(str, changed))}, rediscovering it")
+                self.paths.pop(target, None)
+                return
+            self.paths[target] = CachedPath(list(addresses), hop_count, self.clock())
+
+
+class _Path:
+    """Book-keeping for the path to one target during a run."""
+
+    __slots__ = ("name", "address", "sock", "limit", "hop_count", "reached", "outstanding", "stats")
+
+    def __init__(self, name: str, address: str, limit: int):
+        self.name = name
+        self.address = address
+        self.sock = None
+        self.limit = limit  # The highest TTL probed
+        self.hop_count = None  # The lowest TTL answered by the target, or by a router refusing to forward further
+        self.reached = False
+        self.outstanding = array("q", [-1]) * limit  # perf_counter_ns at send time per TTL, -1 once answered
+        self.stats = _HopStats(limit)
+
+
+class PathProber:
+    """
+    Traces the path to many targets at once, MTR style. Every round sends one UDP probe per TTL, to every hop of every
+    target at the same time, so a round takes as long as the slowest hop rather than the sum of all hops. The TTL of a
+    probe is encoded in its destination port, which every ICMP error quotes back. Routers answer with ICMP time
+    exceeded, and the target with port unreachable.
+
+    On Linux the errors are read from each UDP socket's error queue (IP_RECVERR), which needs no privileges. Elsewhere
+    a raw ICMP socket is used and the process must be allowed to open one.
+    """
+
+    def __init__(self, mode: str = None, base_port: int = DEFAULT_BASE_PORT, max_ttl: int = DEFAULT_MAX_TTL):
+        """
+        :param mode: str: Force MODE_RECVERR or MODE_RAW instead of picking the best one available
+        :param base_port: int: The destination port of the probes with TTL 1
+        :param max_ttl: int: The highest TTL probed while discovering a path
+        """
+        self.base_port = base_port
+        self.max_ttl = max_ttl
+        self.icmp_sock = None
+        if mode is None:
+            mode = MODE_RECVERR if sys.platform.startswith("linux") else MODE_RAW
+        if mode == MODE_RAW:
+            try:
+                self.icmp_sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            except OSError as e:
+                raise PathAnalysisUnavailable(f"Unable to open a raw ICMP socket: {e}")
+            self.icmp_sock.setblocking(False)
+        self.mode = mode
+        logger.info(f"Path prober using {self.mode} sockets")
+
+    def close(self):
+        if self.icmp_sock is not None:
+            self.icmp_sock.close()
+            self.icmp_sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self, path: _Path):
+        path.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        path.sock.setblocking(False)
+        if self.mode == MODE_RECVERR:
+            path.sock.setsockopt(socket.IPPROTO_IP, IP_RECVERR, 1)
+        else:
+            path.sock.bind(("", 0))  # The source port tells the replies of each path apart
+
+    def _send(self, path: _Path, index: int):
+        """
+        The _send function sends the probe with TTL index + 1. With IP_RECVERR, every ICMP error the socket receives is
+        also reported by its next send, which then fails without sending anything. The error queue is read, recording
+        the replies it holds and clearing the error, and the send is tried again.
+
+        :return: True if the probe was sent
+        """
+        for _ in range(SEND_ATTEMPTS):
+            sent_at = time.perf_counter_ns()
+            try:
+                path.sock.sendto(PROBE_PAYLOAD, (path.address, self.base_port + index))
+            except OSError as e:
+                if e.errno not in (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH):
+                    raise
+                logger.debug(f"Send to {path.name} reported an earlier error: {e!r}")
+                if self.mode == MODE_RECVERR:
+                    self._receive_errqueue(path)
+                continue
+            path.outstanding[index] = sent_at
+            path.stats.sent[index] += 1
+            return True
+        logger.debug(f"Probe to {path.name} with TTL {index + 1} could not be sent")
+        return False
+
+    def _send_round(self, path: _Path):
+        limit = path.limit if path.hop_count is None else path.hop_count
+        for index in range(limit):
+            path.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, index + 1)
+            path.outstanding[index] = -1  # A reply to the previous round's probe from now on counts as lost
+            self._send(path, index)
+
+    def _record(self, path: _Path, port: int, icmp_type: int, icmp_code: int, address: str, received_at: int):
+        index = port - self.base_port
+        if not 0 <= index < path.limit or path.outstanding[index] < 0:
+            return
+        rtt = (received_at - path.outstanding[index]) / 1_000_000
+        path.outstanding[index] = -1
+        if icmp_type == ICMP_DEST_UNREACHABLE:
+            if address == path.address and icmp_code == ICMP_PORT_UNREACHABLE:
+                if not path.reached or index + 1 < path.hop_count:
+                    path.hop_count = index + 1
+                path.reached = True
+            elif path.hop_count is None:
+                path.hop_count = index + 1  # A router refused to forward further, the path ends here
+        elif icmp_type != ICMP_TIME_EXCEEDED:
+            return
+        path.stats.add_reply(index, rtt, address)
+
+    def _receive_errqueue(self, path: _Path):
+        while True:
+            try:
+                _, ancillary, _, destination = path.sock.recvmsg(512, 512, MSG_ERRQUEUE)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.debug(f"Reading the error queue of {path.name} failed: {e!r}")
+                return
+            received_at = time.perf_counter_ns()
+            for level, kind, data in ancillary:
+                if level != socket.IPPROTO_IP or kind != IP_RECVERR or len(data) < EXTENDED_ERROR.size + OFFENDER.size:
+                    continue
+                _, origin, icmp_type, icmp_code, _, _, _ = EXTENDED_ERROR.unpack_from(data)
+                if origin != SO_EE_ORIGIN_ICMP:
+                    continue
+                _, offender = OFFENDER.unpack_from(data, EXTENDED_ERROR.size)
+                self._record(path, destination[1], icmp_type, icmp_code, socket.inet_ntoa(offender), received_at)
+
+    def _receive_raw(self, by_port: dict):
+        while True:
+            try:
+                packet, (address, _) = self.icmp_sock.recvfrom(65535)
+            except BlockingIOError:
+                return
+            received_at = time.perf_counter_ns()
+            packet = packet[(packet[0] & 0x0F) * 4:]  # Strip the IP header
+            if len(packet) < 8 + 20 + UDP_PORTS.size or packet[0] not in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACHABLE):
+                continue
+            quoted = packet[8:]  # The IP header and first bytes of the probe the error is about
+            quoted_udp = quoted[(quoted[0] & 0x0F) * 4:]
+            if quoted[9] != socket.IPPROTO_UDP or len(quoted_udp) < UDP_PORTS.size:
+                continue
+            source_port, destination_port = UDP_PORTS.unpack_from(quoted_udp)
+            path = by_port.get(source_port)
+            if path is not None:
+                self._record(path, destination_port, packet[0], packet[1], address, received_at)
+
+    def trace(self, targets: list, rounds: int = DEFAULT_ROUNDS, interval: float = DEFAULT_INTERVAL,
+              timeout: float = DEFAULT_TIMEOUT, cache: PathCache = None):
+        """
+        The trace method measures the loss and latency of every hop on the path to every target.
+
+        :param targets: list: The targets to trace
+        :param rounds: int: The number of probes sent to every hop
+        :param interval: float: Seconds between rounds
+        :param timeout: float: Seconds to wait for replies after the last round
+        :param cache: PathCache: Known paths. Targets with a known path are only probed up to their hop count, and
+            the cache is updated with what this run saw
+        :return: A dictionary of target to PathResult, and a dictionary of target to the exception it raised
+        """
+        errors = {}
+        paths = []
+        for name in dict.fromkeys(targets):
+            try:
+                address = resolve(name)
+            except ResolutionFailed as e:
+                errors[name] = e
+                continue
+            cached = cache.get(name) if cache is not None else None
+            paths.append(_Path(name, address, cached.hop_count if cached is not None else self.max_ttl))
+
+        selector = selectors.DefaultSelector()
+        by_port = {}
+        try:
+            for path in paths:
+                self._open(path)
+                if self.mode == MODE_RECVERR:
+                    selector.register(path.sock, selectors.EVENT_READ, path)
+                else:
+                    by_port[path.sock.getsockname()[1]] = path
+            if self.mode == MODE_RAW:
+                selector.register(self.icmp_sock, selectors.EVENT_READ, None)
+
+            logger.info(f"Tracing {len(paths)} path(s) over {rounds} round(s) with {self.mode} sockets...")
+            start = time.perf_counter()
+            deadline = start + (rounds - 1) * interval + timeout
+            next_round = 0
+            while True:
+                now = time.perf_counter()
+                if next_round < rounds and now >= start + next_round * interval:
+                    for path in paths:
+                        self._send_round(path)
+                    next_round += 1
+                if now >= deadline:
+                    break
+                wait = (start + next_round * interval if next_round < rounds else deadline) - now
+                for key, _ in selector.select(max(0.0, wait)):
+                    if key.data is None:
+                        self._receive_raw(by_port)
+                    else:
+                        self._receive_errqueue(key.data)
+        finally:
+            selector.close()
+            for path in paths:
+                if path.sock is not None:
+                    path.sock.close()
+
+        results = {}
+        for path in paths:
+            stats = path.stats
+            answered = [index for index in range(path.limit) if stats.received[index] > 0]
+            if len(answered) == 0:
+                logger.error(f"No hop on the path to {path.name} answered")
+                errors[path.name] = PathAnalysisUnavailable(f"No hop on the path to {path.name} answered")
+                if cache is not None:
+                    cache.update(path.name, [], None)
+                continue
+            hop_count = path.hop_count if path.hop_count is not None else answered[-1] + 1
+            results[path.name] = PathResult(hop_count=hop_count, reached=path.reached,
+                                            hops=[stats.hop_result(index) for index in range(hop_count)])
+            if cache is not None:
+                # Only paths that reach their target are reused, so a path cut short is looked at in full again
+                cache.update(path.name, stats.addresses[:hop_count], hop_count if path.reached else None)
+        logger.info(f"Completed path analysis: {len(results)} succeeded, {len(errors)} failed")
+        return results, errors
+
+
+@traced("path.trace")
+def run_path_analysis(targets: list, rounds: int = DEFAULT_ROUNDS, max_ttl: int = DEFAULT_MAX_TTL,
+                      interval: float = DEFAULT_INTERVAL, timeout: float = DEFAULT_TIMEOUT, cache: PathCache = None,
+                      mode: str = None):
+    """
+    The run_path_analysis function traces the path to every target, see PathProber.
+
+    :param targets: list: The targets to trace
+    :param rounds: int: The number of probes sent to every hop
+    :param max_ttl: int: The highest TTL probed while discovering a path
+    :param interval: float: Seconds between rounds
+    :param timeout: float: Seconds to wait for replies after the last round
+    :param cache: PathCache: Known paths, kept between runs
+    :param mode: str: Force MODE_RECVERR or MODE_RAW
+    :return: A dictionary of target to PathResult, and a dictionary of target to the exception it raised
+    """
+    with PathProber(mode=mode, max_ttl=max_ttl) as prober:
+        results, errors = prober.trace(targets, rounds=rounds, interval=interval, timeout=timeout, cache=cache)
+    for target, result in results.items():
+        logger.info(f"Path to {target}: {result.hop_count} hop(s){'' if result.reached else ', target not reached'}")
+        for ttl, hop in enumerate(result.hops, start=1):
+            latency = f"{hop.average_latency}ms" if hop.average_latency is not None else "*"
+            logger.info(f"  {ttl:2d}. {hop.address or '???':15s} loss {hop.packet_loss}% avg {latency}")
+    return results, errors
@@ -1,7 +1,14 @@
-import subprocess
 import re
 import platform
 import logging
+from collections import namedtuple
+from time import perf_counter_ns
+
+from lib.dns import address_or_name
+from lib.process import ProcessTimedOut, format_stderr, stream_lines
+from lib.results import PingResult
+from lib.stats import RttSamples, standard_deviation, summarize_samples
+from lib.tracing import traced, tracer
 
 
 class PingExecutionFailed(Exception):
@@ -23,34 +30,138 @@ logger = logging.getLogger("network_health")
 CURRENT_PLATFORM = platform.system()
 logger.info(f"Operating System: {CURRENT_PLATFORM}")
 
+REPLY_PATTERN = re.compile(r"icmp_seq=(\d+).*?time[=<]\s*(\d+(?:\.\d+)?)\s*ms")
+WINDOWS_REPLY_PATTERN = re.compile(r"Reply from .*?time[=<](\d+(?:\.\d+)?)ms", re.IGNORECASE)
+WINDOWS_TIMEOUT_PATTERN = re.compile(r"Request timed out|Destination host unreachable", re.IGNORECASE)
+
+PingSample = namedtuple("PingSample", ["index", "rtt"])  # rtt is None for a packet reported as lost
+
+
+class ReplyParser:
+    """Turns the per-packet lines printed by ping into PingSample objects, one line at a time."""
+
+    def __init__(self, platform_name: str = None):
+        if platform_name is None:
+            platform_name = CURRENT_PLATFORM
+        self.windows = platform_name == "Windows"
+        self.first_sequence = 0 if platform_name == "Darwin" else 1
+        self.index = 0  # Windows does not print sequence numbers, but prints one line per packet in order
+
+    def parse(self, line: str):
+        """
+        The parse method parses one line of ping output.
+
+        :param line: str: A line printed by ping
+        :return: A PingSample if the line reports a reply or a lost packet, None otherwise
+        """
+        if self.windows:
+            match = WINDOWS_REPLY_PATTERN.search(line)
+            if match:
+                self.index += 1
+                return PingSample(self.index - 1, float(match.group(1)))
+            if WINDOWS_TIMEOUT_PATTERN.search(line):
+                self.index += 1
+                return PingSample(self.index - 1, None)
+            return None
+        match = REPLY_PATTERN.search(line)
+        if match and int(match.group(1)) >= self.first_sequence:
+            return PingSample(int(match.group(1)) - self.first_sequence, float(match.group(2)))
+        return None
+
+
+def parse_replies(stdout: str, number_of_packets: int):
+    """
+    The parse_replies function collects the round trip time of every reply line in the output of ping.
 
-def run_ping(target: str, number_of_packets: int = 100):
+    :param stdout: str: The output of the ping process
+    :param number_of_packets: int: The number of packets that were sent
+    :return: An RttSamples object with every reply
     """
-    The run_ping function takes a target and an optional number of packets to send.
-    It then runs the ping command on the target with the specified number of packets,
-    and returns a dictionary containing information about packet loss, minimum latency,
-    average latency, max latency and standard deviation in latencies.
+    samples = RttSamples(int(number_of_packets))
+    parser = ReplyParser()
+    for line in stdout.splitlines():
+        sample = parser.parse(line)
+        if sample is None:
+            continue
+        if sample.rtt is None:
+            samples.add_loss(sample.index)
+        else:
+            samples.add_reply(sample.index, sample.rtt)
+    return samples
+
+
+def stream_ping(target: str, number_of_packets: int = 100, timeout: float = None, other_lines: list = None,
+                stderr_lines: list = None):
+    """
+    The stream_ping function runs ping against a target and yields every reply as soon as ping prints it.
 
     :param target: str: Specify the target of the ping
     :param number_of_packets: int: Specify the number of packets to send
-    :return: A dictionary with the following keys:
-        (packet_loss, minimum_latency, average_latency, max_latency, standard_deviation_latency)
+    :param timeout: float: Seconds to let ping run before killing it. Runs until ping exits if not specified
+    :param other_lines: list: If given, every line that is not a reply, such as the summary, is appended to it
+    :param stderr_lines: list: If given, the last lines ping writes to stderr are appended to it
+    :return: A generator of PingSample objects. Raises ProcessTimedOut once ping is killed for running too long
     """
-    logger.info("Determining platform...")
     if CURRENT_PLATFORM == "Windows":
         command = ["ping", target, "-n", str(number_of_packets)]
     else:
         command = ["ping", target, "-c", str(number_of_packets)]
+    parser = ReplyParser()
+    parse_ns = 0  # Parsing is timed line by line and recorded once, as a single stage
+    try:
+        for line in stream_lines(command, timeout=timeout, stderr_lines=stderr_lines):
+            logger.debug(f"Ping output: {line}")
+            start = perf_counter_ns()
+            sample = parser.parse(line)
+            parse_ns += perf_counter_ns() - start
+            if sample is not None:
+                yield sample
+            elif other_lines is not None:
+                other_lines.append(line)
+    finally:
+        tracer.record("ping.parse", parse_ns)
+
+
+@traced("ping.run")
+def run_ping(target: str, number_of_packets: int = 100, timeout: float = None, on_sample=None):
+    """
+    The run_ping function takes a target and an optional number of packets to send.
+    It then runs the ping command on the target with the specified number of packets,
+    and returns a PingResult containing information about packet loss, minimum latency,
+    average latency, max latency and standard deviation in latencies.
+    If ping is killed or times out before printing its summary, the results are computed from the replies received
+    up to that point.
+
+    :param target: str: Specify the target of the ping
+    :param number_of_packets: int: Specify the number of packets to send
+    :param timeout: float: Seconds to wait for the ping process before killing it. Waits forever if not specified
+    :param on_sample: Called with each PingSample and the RttSamples collected so far, as replies arrive
+    :return: A PingResult with the following metrics:
+        (packet_loss, minimum_latency, average_latency, max_latency, standard_deviation_latency, p50_latency,
+        p95_latency, p99_latency, jitter, max_loss_burst)
+    """
     logger.info(f"Platform is: {CURRENT_PLATFORM} running ping against target: {target} for {number_of_packets} "
                 f"packets...")
 
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    stdout, stderr = stdout.decode(), stderr.decode()
+    samples = RttSamples(int(number_of_packets))
+    other_lines = []
+    stderr_lines = []
+    timed_out = False
+    try:
+        for sample in stream_ping(address_or_name(target), number_of_packets, timeout=timeout,
+                                  other_lines=other_lines, stderr_lines=stderr_lines):
+            if sample.rtt is None:
+                samples.add_loss(sample.index)
+            else:
+                samples.add_reply(sample.index, sample.rtt)
+            if on_sample is not None:
+                on_sample(sample, samples)
+    except ProcessTimedOut:
+        logger.error(f"Ping against target: {target} did not complete within {timeout} seconds")
+        timed_out = True
 
     logger.info("Completed ping process, parsing output...")
-    logger.debug(f"Ping output:\n {stdout}")
-
+    summary = "\n".join(other_lines)
 
     if CURRENT_PLATFORM != "Windows":
         pattern = r"\s*(\d*|\d*.\d*)%.*\n.*min\/avg\/max\/.*dev\s*=\s*(\d*.\d*|\d*)\/(\d*.\d*|\d*)\/(\d*.\d*|\d*)\/(\d*.\d*|\d*)\s*ms"
@@ -59,33 +170,47 @@ def run_ping(target: str, number_of_packets: int = 100):
 
 
     # Search for the pattern in the text, ignoring whitespace and line breaks
-    match = re.search(pattern, stdout, re.DOTALL | re.IGNORECASE)
+    with tracer.span("ping.summary"):
+        match = None if timed_out else re.search(pattern, summary, re.DOTALL | re.IGNORECASE)
 
     if match:
-        stddev_latency = 0
+        stddev_latency = 0.0
         logger.info("Found pattern matches within ping results!")
-        packet_loss = match.group(1)
-        min_latency = match.group(2)
-        avg_latency = match.group(3)
-        max_latency = match.group(4)
+        packet_loss = float(match.group(1))
+        min_latency = float(match.group(2))
         if CURRENT_PLATFORM != "Windows":
-            stddev_latency = match.group(5)
-
-        results = {
-            "packet_loss": packet_loss,
-            "minimum_latency": min_latency,
-            "average_latency": avg_latency,
-            "max_latency": max_latency,
-            "standard_deviation_latency": stddev_latency
-        }
-
-        logger.info("Results:")
-        for metric, value in results.items():
-            unit = "millisecond(s)"
-            if metric == "packet_loss":
-                unit = "%"
-            logger.info(f"{metric}: {value} {unit}")
-        return results
+            avg_latency = float(match.group(3))
+            max_latency = float(match.group(4))
+            stddev_latency = float(match.group(5))
+        else:
+            # Windows prints Minimum, Maximum, Average in that order and no standard deviation
+            max_latency = float(match.group(3))
+            avg_latency = float(match.group(4))
+            if len(samples) > 0:
+                stddev_latency = round(standard_deviation(samples.rtts), 3)
+
+        results = PingResult(packet_loss=packet_loss, minimum_latency=min_latency, average_latency=avg_latency,
+                             max_latency=max_latency, standard_deviation_latency=stddev_latency,
+                             rtts=samples.rtts, **summarize_samples(samples))
     else:
-        logger.error("Failed to find pattern matches within ping results.")
-        raise FailedToParsePing()
+        results = samples.snapshot(partial=True)
+        if results is None:
+            logger.error("Failed to find pattern matches within ping results.")
+            if timed_out:
+                raise PingExecutionFailed(f"Ping against {target} timed out after {timeout} seconds"
+                                          f"{format_stderr(stderr_lines)}")
+            if stderr_lines:
+                raise PingExecutionFailed(f"Ping against {target} failed{format_stderr(stderr_lines)}")
+            raise FailedToParsePing()
+        logger.warning(f"Ping against target: {target} did not finish, reporting partial results from "
+                       f"{len(samples)}/{samples.observed} packet(s)")
+
+    logger.info("Results:")
+    for metric, value in results.items():
+        unit = "millisecond(s)"
+        if metric == "packet_loss":
+            unit = "%"
+        elif metric == "max_loss_burst":
+            unit = "packet(s)"
+        logger.info(f"{metric}: {value} {unit}")
+    return results
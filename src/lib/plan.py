@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+
+from lib.throughput import DEFAULT_DURATION, DEFAULT_STREAMS
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+try:
+    import yaml
+    YAML_ERRORS = (yaml.YAMLError,)
+except ImportError:
+    yaml = None
+    YAML_ERRORS = ()
+
+logger = logging.getLogger("network_health")
+
+TEST_PING = "ping"
+TEST_IPERF = "iperf"
+TEST_TYPES = [TEST_PING, TEST_IPERF]
+
+DEFAULT_INTERVALS = {TEST_PING: 60, TEST_IPERF: 300}  # Seconds between runs, the same as the command line defaults
+DEFAULT_NUMBER_OF_PACKETS = 100
+
+FIELDS = ["host", "test", "local", "number_of_packets", "interval", "timeout", "native", "port", "streams", "duration",
+          "sendfile", "tags"]
+
+
+class TestPlanError(Exception):
+    """Raised when a test plan can not be read or does not validate."""
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class PlanTarget:
+    """One target of a test plan, with every setting resolved against the plan's defaults."""
+
+    __slots__ = FIELDS
+
+    def __init__(self, host: str, test: str = TEST_PING, local: bool = False,
+                 number_of_packets: int = DEFAULT_NUMBER_OF_PACKETS, interval: float = None, timeout: float = None,
+                 native: bool = False, port: int = None, streams: int = DEFAULT_STREAMS,
+                 duration: float = DEFAULT_DURATION, sendfile: bool = False, tags: list = None):
+        """
+        :param host: str: The host to test
+        :param test: str: TEST_PING or TEST_IPERF
+        :param local: bool: Whether the results are reported as local or remote
+        :param number_of_packets: int: The number of packets of each ping test
+        :param interval: float: Seconds between runs in daemon mode. Defaults to the command line default of the test
+        :param timeout: float: Seconds the ping or iperf process may run before it is killed
+        :param native: bool: Use the built-in prober or throughput test instead of the ping or iperf binary
+        :param port: int: The iperf server port, or the reflector port native pings send UDP probes to
+        :param streams: int: The parallel streams of a native throughput test
+        :param duration: float: The seconds a native throughput test runs for
+        :param sendfile: bool: Send the data of a native throughput test with os.sendfile
+        :param tags: list: Tags such as `env:prod` attached to every series of the target
+        """
+        self.host = host
+        self.test = test
+        self.local = local
+        self.number_of_packets = number_of_packets
+        self.interval = interval if interval is not None else DEFAULT_INTERVALS[test]
+        self.timeout = timeout
+        self.native = native
+        self.port = port
+        self.streams = streams
+        self.duration = duration
+        self.sendfile = sendfile
+        self.tags = list(tags or [])
+
+    @property
+    def group_key(self):
+        # Pings that share every setting but the target and tags run as one fleet test
+        return self.local, self.number_of_packets, self.timeout, self.native, self.port
+
+    def __repr__(self):
+        return f"PlanTarget({', '.join(f'{field}={getattr(self, field)!r}' for field in FIELDS)})"
+
+
+class PlanInterval:
+    """The tests of a plan that run on the same interval: ping targets grouped into fleets, and bandwidth targets."""
+
+    def __init__(self, interval: float):
+        """
+        :param interval: float: Seconds between runs
+        """
+        self.interval = interval
+        self.ping_groups = {}  # PlanTarget.group_key to the targets sharing it
+        self.bandwidth_targets = []
+
+    def add(self, target: PlanTarget):
+        if target.test == TEST_PING:
+            self.ping_groups.setdefault(target.group_key, []).append(target)
+        else:
+            self.bandwidth_targets.append(target)
+
+
+class TestPlan:
+    """
+    A validated test plan, indexed by interval so the scheduler can run each interval's tests as one job without
+    looking at the plan's targets again.
+    """
+
+    def __init__(self, targets: list, source: str = None):
+        """
+        :param targets: list: The PlanTarget objects of the plan
+        :param source: str: Where the plan was loaded from, used in logs
+        """
+        self.targets = targets
+        self.source = source
+        self.intervals = {}
+        for target in targets:
+            if target.interval not in self.intervals:
+                self.intervals[target.interval] = PlanInterval(target.interval)
+            self.intervals[target.interval].add(target)
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def _check_positive(value, name: str, integer: bool = False):
+    kinds = (int,) if integer else (int, float)
+    if isinstance(value, bool) or not isinstance(value, kinds) or value <= 0:
+        raise TestPlanError(f"{name} must be a positive {'integer' if integer else 'number'}, not {value!r}")
+    return value
+
+
+def _check_bool(value, name: str):
+    if not isinstance(value, bool):
+        raise TestPlanError(f"{name} must be true or false, not {value!r}")
+    return value
+
+
+def _validate_fields(fields: dict, where: str):
+    """
+    The _validate_fields function checks the type and range of every setting of a target or of the defaults.
+
+    :param fields: dict: The settings as read from the plan
+    :param where: str: The location of the settings in the plan, used in errors
+    :return: The settings, converted where needed
+    """
+    if not isinstance(fields, dict):
+        raise TestPlanError(f"{where} must be a mapping, not {type(fields).__name__}")
+    unknown = sorted(set(fields) - set(FIELDS))
+    if unknown:
+        raise TestPlanError(f"{where} has unknown setting(s): {', '.join(unknown)}")
+    checked = {}
+    for name, value in fields.items():
+        field = f"{where}.{name}"
+        if name == "host":
+            if not isinstance(value, str) or not value.strip():
+                raise TestPlanError(f"{field} must be a host name or address, not {value!r}")
+            value = value.strip()
+        elif name == "test":
+            if value not in TEST_TYPES:
+                raise TestPlanError(f"{field} must be one of {', '.join(TEST_TYPES)}, not {value!r}")
+        elif name in ("local", "native", "sendfile"):
+            _check_bool(value, field)
+        elif name in ("number_of_packets", "streams"):
+            _check_positive(value, field, integer=True)
+        elif name in ("interval", "duration"):
+            value = float(_check_positive(value, field))
+        elif name == "timeout":
+            if value is not None:
+                value = float(_check_positive(value, field))
+        elif name == "port":
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int) or
+                                      not 0 < value < 65536):
+                raise TestPlanError(f"{field} must be a port number, not {value!r}")
+        elif name == "tags":
+            if not isinstance(value, list) or not all(isinstance(tag, str) and tag for tag in value):
+                raise TestPlanError(f"{field} must be a list of tags such as `env:prod`, not {value!r}")
+        checked[name] = value
+    return checked
+
+
+def parse_plan(document, source: str = "plan"):
+    """
+    The parse_plan function validates a plan already read into dictionaries and lists. Targets inherit every setting
+    they do not set from the plan's `defaults`, and tags from both are combined.
+
+    :param document: The plan, a mapping with a `targets` list and optional `defaults`
+    :param source: str: Where the plan was read from, used in errors
+    :return: A TestPlan. Raises TestPlanError naming the first invalid setting
+    """
+    if not isinstance(document, dict):
+        raise TestPlanError(f"{source}: a plan must be a mapping with a `targets` list")
+    unknown = sorted(set(document) - {"defaults", "targets"})
+    if unknown:
+        raise TestPlanError(f"{source}: unknown section(s): {', '.join(unknown)}")
+    try:
+        defaults = _validate_fields(document.get("defaults", {}), "defaults")
+        if "host" in defaults:
+            raise TestPlanError("defaults can not set a host")
+        entries = document.get("targets")
+        if not isinstance(entries, list) or len(entries) == 0:
+            raise TestPlanError("targets must be a non-empty list")
+        targets = []
+        for index, entry in enumerate(entries):
+            where = f"targets[{index}]"
+            if isinstance(entry, str):
+                entry = {"host": entry}  # A bare host takes every setting from the defaults
+            fields = _validate_fields(entry, where)
+            if "host" not in fields:
+                raise TestPlanError(f"{where} has no host")
+            settings = {**defaults, **fields}
+            settings["tags"] = defaults.get("tags", []) + fields.get("tags", [])
+            targets.append(PlanTarget(**settings))
+    except TestPlanError as e:
+        raise TestPlanError(f"{source}: {e}")
+    return TestPlan(targets, source=source)
+
+
+def load_plan(path: str):
+    """
+    The load_plan function reads and validates a test plan. The format is picked by the file extension: `.json`,
+    `.toml`, or `.yaml`/`.yml` when PyYAML is installed.
+
+    :param path: str: The plan file
+    :return: A TestPlan. Raises TestPlanError if the file can not be read or does not validate
+    """
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, "rb") as plan_file:
+            if extension == ".json":
+                document = json.load(plan_file)
+            elif extension == ".toml":
+                if tomllib is None:
+                    raise TestPlanError(f"{path}: TOML plans need Python 3.11 or later")
+                document = tomllib.load(plan_file)
+            elif extension in (".yaml", ".yml"):
+                if yaml is None:
+                    raise TestPlanError(f"{path}: YAML plans need PyYAML, `pip install pyyaml`")
+                document = yaml.safe_load(plan_file)
+            else:
+                raise TestPlanError(f"{path}: unknown plan format, expected .json, .toml, .yaml or .yml")
+    except OSError as e:
+        raise TestPlanError(f"{path}: {e.strerror}")
+    except (ValueError, *YAML_ERRORS) as e:
+        # json.JSONDecodeError and tomllib.TOMLDecodeError are both ValueErrors
+        raise TestPlanError(f"{path}: {e}")
+    test_plan = parse_plan(document, source=path)
+    logger.info(f"Loaded test plan {path}: {len(test_plan)} target(s) on {len(test_plan.intervals)} interval(s)")
+    return test_plan
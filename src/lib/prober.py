@@ -0,0 +1,374 @@
+import errno
+import itertools
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from lib.dns import ResolutionFailed, resolve
+from lib.ping import PingExecutionFailed
+from lib.results import PingResult
+from lib.stats import RttSamples, standard_deviation, summarize_samples
+from lib.tracing import traced
+
+logger = logging.getLogger("network_health")
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_HEADER = struct.Struct("!BBHHH")  # type, code, checksum, identifier, sequence
+UDP_PROBE_HEADER = struct.Struct("!4sH")  # magic, sequence
+UDP_PROBE_MAGIC = b"NHP1"
+
+DEFAULT_UDP_PORT = 33434  # Traditional traceroute base port, normally closed so the host answers with port unreachable
+DEFAULT_PAYLOAD_SIZE = 56
+DEFAULT_INTERVAL = 1.0
+DEFAULT_TIMEOUT = 2.0
+
+MODE_RAW = "raw"  # Privileged raw ICMP socket
+MODE_DGRAM = "dgram"  # Unprivileged ICMP datagram socket (Linux ping_group_range, macOS)
+MODE_UDP = "udp"  # UDP probes, replied to by an echo service or an ICMP port unreachable
+
+_identifiers = itertools.count()  # Numbers the Probers of this process, so each gets its own ICMP identifier
+_identifiers_lock = threading.Lock()
+
+
+class ProberUnavailable(Exception):
+    """Raised when no socket type usable for probing can be opened."""
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+def checksum(data: bytes):
+    """
+    The checksum function computes the RFC 1071 internet checksum used by ICMP.
+
+    :param data: bytes: The ICMP header and payload with the checksum field set to zero
+    :return: The 16 bit checksum
+    """
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def build_echo_request(identifier: int, sequence: int, payload: bytes):
+    header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    return ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum(header + payload), identifier, sequence) + payload
+
+
+def open_icmp_socket(mode: str = None):
+    """
+    The open_icmp_socket function opens the most capable ICMP socket available. A raw socket is tried first, then an
+    unprivileged datagram socket. Passing a mode only tries that socket type.
+
+    :param mode: str: Force MODE_RAW or MODE_DGRAM
+    :return: The socket and the mode it was opened in
+    """
+    modes = [mode] if mode is not None else [MODE_RAW, MODE_DGRAM]
+    for each_mode in modes:
+        sock_type = socket.SOCK_RAW if each_mode == MODE_RAW else socket.SOCK_DGRAM
+        try:
+            sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+        except (PermissionError, OSError) as e:
+            logger.debug(f"Unable to open {each_mode} ICMP socket: {e!r}")
+            continue
+        sock.setblocking(False)
+        return sock, each_mode
+    raise ProberUnavailable("Unable to open a raw or datagram ICMP socket")
+
+
+def summarize(samples: RttSamples):
+    """
+    The summarize function turns the samples of a target into the same PingResult run_ping returns.
+
+    :param samples: RttSamples: The replies collected for the target
+    :return: A PingResult with the metrics:
+        (packet_loss, minimum_latency, average_latency, max_latency, standard_deviation_latency, p50_latency,
+        p95_latency, p99_latency, jitter, max_loss_burst)
+    """
+    rtts = samples.rtts
+    packet_loss = 100.0 * (samples.sent - len(rtts)) / samples.sent if samples.sent else 100.0
+    return PingResult(packet_loss=round(packet_loss, 3),
+                      minimum_latency=round(min(rtts), 3),
+                      average_latency=round(sum(rtts) / len(rtts), 3),
+                      max_latency=round(max(rtts), 3),
+                      standard_deviation_latency=round(standard_deviation(rtts), 3),
+                      rtts=rtts, **summarize_samples(samples))
+
+
+class _Target:
+    """Book-keeping for one probed target."""
+
+    __slots__ = ("name", "address", "sock", "outstanding", "samples")
+
+    def __init__(self, name: str, address: str, number_of_packets: int):
+        self.name = name
+        self.address = address
+        self.sock = None  # Only used in UDP mode, where every target gets its own connected socket
+        self.outstanding = {}  # sequence -> (index within the run, perf_counter_ns at send time)
+        self.samples = RttSamples(number_of_packets)
+
+
+class Prober:
+    """
+    Sends echo probes to many targets at once from a single thread. ICMP probes share one socket, and replies are
+    matched to targets by identifier, source address and sequence number. Every send and receive is timestamped with
+    time.perf_counter_ns.
+    """
+
+    def __init__(self, mode: str = None, payload_size: int = DEFAULT_PAYLOAD_SIZE, udp_port: int = DEFAULT_UDP_PORT):
+        self.udp_port = udp_port
+        self.payload = bytes(range(256)) * (payload_size // 256 + 1)
+        self.payload = self.payload[:payload_size]
+        with _identifiers_lock:
+            instance = next(_identifiers)
+        # Probers running at the same time share the host's raw ICMP traffic, so each needs an identifier of its own
+        self.identifier = (os.getpid() ^ instance * 0x9E37) & 0xFFFF
+        self.sock = None
+        if mode == MODE_UDP:
+            self.mode = MODE_UDP
+        else:
+            try:
+                self.sock, self.mode = open_icmp_socket(mode)
+            except ProberUnavailable:
+                if mode is not None:
+                    raise
+                logger.info("ICMP sockets are unavailable, falling back to UDP probes")
+                self.mode = MODE_UDP
+        logger.info(f"Prober using {self.mode} sockets")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _send(self, target: _Target, index: int):
+        sequence = index & 0xFFFF
+        if self.mode == MODE_UDP:
+            packet = UDP_PROBE_HEADER.pack(UDP_PROBE_MAGIC, sequence) + self.payload
+            sock, address = target.sock, None
+        else:
+            packet = build_echo_request(self.identifier, sequence, self.payload)
+            sock, address = self.sock, (target.address, 0)
+        target.outstanding[sequence] = (index, time.perf_counter_ns())
+        try:
+            if address is None:
+                sock.send(packet)
+            else:
+                sock.sendto(packet, address)
+        except OSError as e:
+            if e.errno not in (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH):
+                raise
+            # An error from an earlier probe surfaced on this send; the probe itself counts as lost
+            logger.debug(f"Send to {target.name} failed: {e!r}")
+
+    @staticmethod
+    def _record(target: _Target, sequence: int, received_at: int):
+        sent = target.outstanding.pop(sequence, None)
+        if sent is not None:
+            index, sent_at = sent
+            target.samples.add_reply(index, (received_at - sent_at) / 1_000_000)
+
+    def _receive_icmp(self, by_address: dict):
+        while True:
+            try:
+                packet, (address, _) = self.sock.recvfrom(65535)
+            except BlockingIOError:
+                return
+            received_at = time.perf_counter_ns()
+            if self.mode == MODE_RAW:
+                packet = packet[(packet[0] & 0x0F) * 4:]  # Strip the IP header
+            if len(packet) < ICMP_HEADER.size:
+                continue
+            icmp_type, _, _, identifier, sequence = ICMP_HEADER.unpack_from(packet)
+            # The kernel rewrites the identifier of datagram sockets and only hands us our own replies
+            if icmp_type != ICMP_ECHO_REPLY or (self.mode == MODE_RAW and identifier != self.identifier):
+                continue
+            target = by_address.get(address)
+            if target is not None:
+                self._record(target, sequence, received_at)
+
+    def _receive_udp(self, target: _Target):
+        while True:
+            try:
+                packet = target.sock.recv(65535)
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:
+                # Port unreachable from the target. It does not carry our sequence, so it answers the oldest probe.
+                received_at = time.perf_counter_ns()
+                if target.outstanding:
+                    oldest = min(target.outstanding, key=lambda sequence: target.outstanding[sequence][0])
+                    self._record(target, oldest, received_at)
+                continue
+            except OSError as e:
+                logger.debug(f"UDP probe to {target.name} failed: {e!r}")
+                return
+            received_at = time.perf_counter_ns()
+            if len(packet) >= UDP_PROBE_HEADER.size:
+                magic, sequence = UDP_PROBE_HEADER.unpack_from(packet)
+                if magic == UDP_PROBE_MAGIC:
+                    self._record(target, sequence, received_at)
+
+    def probe(self, targets: list, number_of_packets: int = 100, interval: float = DEFAULT_INTERVAL,
+              timeout: float = DEFAULT_TIMEOUT, max_duration: float = None):
+        """
+        The probe method sends number_of_packets probes to every target, interval seconds apart, and waits up to
+        timeout seconds after the last probe for stragglers.
+
+        :param targets: list: The targets to probe
+        :param number_of_packets: int: Specify the number of packets to send to each target
+        :param interval: float: Seconds between probes to the same target
+        :param timeout: float: Seconds to wait for a reply before a probe counts as lost
+        :param max_duration: float: Seconds after which the run is cut short, like a ping process killed by its
+            timeout. The results are computed from the probes sent up to that point
+        :return: A dictionary of target to results, and a dictionary of target to the exception it raised
+        """
+        number_of_packets = int(number_of_packets)
+        errors = {}
+        probed = []
+        for name in dict.fromkeys(targets):
+            try:
+                address = resolve(name)
+            except ResolutionFailed as e:
+                errors[name] = PingExecutionFailed(str(e))
+                continue
+            probed.append(_Target(name, address, number_of_packets))
+
+        by_address = {}
+        for target in probed:
+            # Targets resolving to the same address are only probed once and share the replies
+            by_address.setdefault(target.address, target)
+        unique = list(by_address.values())
+
+        selector = selectors.DefaultSelector()
+        if self.mode == MODE_UDP:
+            for target in unique:
+                target.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                target.sock.setblocking(False)
+                target.sock.connect((target.address, self.udp_port))
+                selector.register(target.sock, selectors.EVENT_READ, target)
+        else:
+            selector.register(self.sock, selectors.EVENT_READ, None)
+
+        logger.info(f"Probing {len(probed)} target(s) with {number_of_packets} packets each over {self.mode} "
+                    f"sockets...")
+        try:
+            start = time.perf_counter()
+            deadline = start + (number_of_packets - 1) * interval + timeout
+            if max_duration is not None:
+                deadline = min(deadline, start + max_duration)
+            next_sequence = 0
+            while True:
+                now = time.perf_counter()
+                while next_sequence < number_of_packets and start + next_sequence * interval <= now < deadline:
+                    for target in unique:
+                        self._send(target, next_sequence)
+                    next_sequence += 1
+                if now >= deadline or (next_sequence == number_of_packets and
+                                       not any(target.outstanding for target in unique)):
+                    break
+                if next_sequence < number_of_packets:
+                    wait = min(start + next_sequence * interval, deadline) - now
+                else:
+                    wait = deadline - now
+                for key, _ in selector.select(max(0.0, wait)):
+                    if key.data is None:
+                        self._receive_icmp(by_address)
+                    else:
+                        self._receive_udp(key.data)
+        finally:
+            selector.close()
+            for target in unique:
+                if target.sock is not None:
+                    target.sock.close()
+
+        cut_short = next_sequence < number_of_packets
+        if cut_short:
+            logger.warning(f"Probing did not complete within {max_duration} seconds, reporting partial results from "
+                           f"{next_sequence}/{number_of_packets} packet(s)")
+            for target in unique:
+                if next_sequence > 0:
+                    target.samples.add_loss(next_sequence - 1)  # Account for every probe sent, answered or not
+
+        results = {}
+        for target in probed:
+            shared = by_address[target.address]
+            if len(shared.samples) == 0:
+                logger.error(f"No replies received from target: {target.name}")
+                errors[target.name] = PingExecutionFailed(f"No replies received from {target.name}")
+                continue
+            results[target.name] = shared.samples.snapshot(partial=True) if cut_short else summarize(shared.samples)
+        logger.info(f"Completed probing: {len(results)} succeeded, {len(errors)} failed")
+        return results, errors
+
+
+@traced("prober.probe")
+def probe_targets(targets: list, number_of_packets: int = 100, interval: float = DEFAULT_INTERVAL,
+                  timeout: float = DEFAULT_TIMEOUT, mode: str = None, udp_port: int = None,
+                  max_duration: float = None):
+    """
+    The probe_targets function probes many targets at once from this process, without starting a ping process per
+    target.
+
+    :param targets: list: The targets to probe
+    :param number_of_packets: int: Specify the number of packets to send to each target
+    :param interval: float: Seconds between probes to the same target
+    :param timeout: float: Seconds to wait for a reply before a probe counts as lost
+    :param mode: str: Force MODE_RAW, MODE_DGRAM or MODE_UDP instead of picking the best one available
+    :param udp_port: int: Send UDP probes to this port, e.g. of a `network_health.py serve` reflector. Implies MODE_UDP
+    :param max_duration: float: Seconds after which the run is cut short and partial results are reported
+    :return: A dictionary of target to results, and a dictionary of target to the exception it raised
+    """
+    if udp_port is not None:
+        mode = MODE_UDP
+    else:
+        udp_port = DEFAULT_UDP_PORT
+    with Prober(mode=mode, udp_port=udp_port) as prober:
+        return prober.probe(targets, number_of_packets=number_of_packets, interval=interval, timeout=timeout,
+                            max_duration=max_duration)
+
+
+def run_native_ping(target: str, number_of_packets: int = 100, interval: float = DEFAULT_INTERVAL,
+                    timeout: float = DEFAULT_TIMEOUT, mode: str = None, udp_port: int = None,
+                    max_duration: float = None):
+    """
+    The run_native_ping function is an in-process replacement for run_ping and returns the same PingResult.
+
+    :param target: str: Specify the target of the ping
+    :param number_of_packets: int: Specify the number of packets to send
+    :param interval: float: Seconds between probes
+    :param timeout: float: Seconds to wait for a reply before a probe counts as lost
+    :param mode: str: Force MODE_RAW, MODE_DGRAM or MODE_UDP instead of picking the best one available
+    :param udp_port: int: Send UDP probes to this port, e.g. of a `network_health.py serve` reflector. Implies MODE_UDP
+    :param max_duration: float: Seconds after which the run is cut short and partial results are reported
+    :return: A PingResult with the following metrics:
+        (packet_loss, minimum_latency, average_latency, max_latency, standard_deviation_latency, p50_latency,
+        p95_latency, p99_latency, jitter, max_loss_burst)
+    """
+    results, errors = probe_targets([target], number_of_packets=number_of_packets, interval=interval,
+                                    timeout=timeout, mode=mode, udp_port=udp_port, max_duration=max_duration)
+    if target in errors:
+        raise errors[target]
+    results = results[target]
+    logger.info("Results:")
+    for metric, value in results.items():
+        unit = "millisecond(s)"
+        if metric == "packet_loss":
+            unit = "%"
+        elif metric == "max_loss_burst":
+            unit = "packet(s)"
+        logger.info(f"{metric}: {value} {unit}")
+    return results
@@ -0,0 +1,95 @@
+import logging
+import subprocess
+import threading
+
+from lib.tracing import tracer
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_STDERR_LINES = 20  # The last lines of stderr kept for error messages, so a chatty process can not use up memory
+STDERR_JOIN_TIMEOUT = 1.0  # Seconds to wait for the rest of stderr once the process exited or was killed
+
+
+class ProcessTimedOut(Exception):
+    """Raised when a streamed process is killed for running past its timeout."""
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+def _read_stderr(stream, stderr_lines: list, max_lines: int):
+    for line in stream:
+        line = line.rstrip("\r\n")
+        if line:
+            stderr_lines.append(line)
+            if len(stderr_lines) > max_lines:
+                del stderr_lines[0]
+
+
+def format_stderr(stderr_lines: list):
+    """
+    The format_stderr function turns the captured stderr of a process into a suffix for an error message.
+
+    :param stderr_lines: list: The lines collected by stream_lines
+    :return: The lines joined after `: `, or an empty string if the process wrote nothing to stderr
+    """
+    if not stderr_lines:
+        return ""
+    return ": " + " | ".join(stderr_lines)
+
+
+def stream_lines(command: list, timeout: float = None, stderr_lines: list = None,
+                 max_stderr_lines: int = DEFAULT_STDERR_LINES):
+    """
+    The stream_lines function runs a command and yields its stdout one line at a time as soon as each line is written,
+    instead of buffering the whole output until the process exits. The process is killed if it runs past the timeout,
+    or if the caller stops iterating early.
+
+    :param command: list: The command to run
+    :param timeout: float: Seconds to let the process run before killing it. Runs forever if not specified
+    :param stderr_lines: list: If given, the last max_stderr_lines non-empty lines the process writes to stderr are
+        appended to it. stderr is read on a thread of its own, so a process writing a lot to it can not stall
+    :param max_stderr_lines: int: The number of stderr lines kept
+    :return: A generator of output lines without their line endings. Raises ProcessTimedOut after the last line if the
+        process was killed for running too long
+    """
+    with tracer.span("process.spawn"):
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL if stderr_lines is None else subprocess.PIPE, bufsize=1,
+                                universal_newlines=True, errors="replace")
+    stderr_reader = None
+    if stderr_lines is not None:
+        stderr_reader = threading.Thread(target=_read_stderr, args=(proc.stderr, stderr_lines, max_stderr_lines),
+                                         name="process-stderr", daemon=True)
+        stderr_reader.start()
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        for line in proc.stdout:
+            yield line.rstrip("\r\n")
+        proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        if stderr_reader is not None:
+            stderr_reader.join(STDERR_JOIN_TIMEOUT)
+            if not stderr_reader.is_alive():
+                proc.stderr.close()
+    if stderr_lines:
+        logger.debug(f"`{' '.join(command)}` wrote to stderr: {stderr_lines}")
+    if timed_out.is_set():
+        raise ProcessTimedOut(f"`{' '.join(command)}` did not complete within {timeout} seconds"
+                              f"{format_stderr(stderr_lines)}")
@@ -0,0 +1,142 @@
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib.datadog import METRIC_UNITS
+from lib.sender import DEFAULT_SHUTDOWN_TIMEOUT
+from lib.sink import Sink
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_PORT = 9470
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2500.0)  # Milliseconds
+
+
+def escape_label_value(value: str):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class _Histogram:
+    """The round trip times observed for one series, bucketed as they arrive."""
+
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * (len(LATENCY_BUCKETS) + 1)))  # The last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, values):
+        for value in values:
+            self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+            self.total += value
+        self.count += len(values)
+
+    def render(self, family: str, labels: str):
+        separator = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{family}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}\n')
+        braces = f"{{{labels}}}" if labels else ""
+        lines.append(f"{family}_sum{braces} {self.total!r}\n")
+        lines.append(f"{family}_count{braces} {self.count}\n")
+        return "".join(lines).encode()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+        body = self.server.exporter.body
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Prometheus scrape from {self.address_string()}: {format % args}")
+
+
+class PrometheusExporter(Sink):
+    """
+    Serves the latest results for Prometheus to scrape at `/metrics`. Every metric of every test is a gauge holding its
+    latest value, and the round trip time of every ping reply is counted into a histogram per series. The response body
+    is rendered when results arrive, not when they are scraped, so a scrape only copies a buffer.
+    """
+
+    name = "prometheus"
+
+    def __init__(self, host: str = "0.0.0.0", port: int = DEFAULT_PORT):
+        """
+        :param host: str: The address to listen on
+        :param port: int: The port to listen on
+        """
+        self.lock = threading.Lock()
+        self.families = {}  # Family name to a dictionary of labels to the rendered samples of that series
+        self.headers = {}  # Family name to its rendered HELP and TYPE lines
+        self.histograms = {}
+        self.body = b""
+        self.server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.exporter = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="prometheus-exporter", daemon=True)
+        self.thread.start()
+        logger.info(f"Serving Prometheus metrics on {host}:{self.port}{METRICS_PATH}")
+
+    def _family(self, family: str, metric_type: str, description: str):
+        if family not in self.headers:
+            self.headers[family] = f"# HELP {family} {description}\n# TYPE {family} {metric_type}\n".encode()
+            self.families[family] = {}
+        return self.families[family]
+
+    def _update(self, data, test_type: str, target: str = None):
+        labels = f'target="{escape_label_value(target)}"' if target is not None else ""
+        braces = f"{{{labels}}}" if labels else ""
+        for metric, value in data.items():
+            family = f"network_health_{test_type}_{metric}"
+            samples = self._family(family, "gauge", f"The {metric} of the latest {test_type} test, in "
+                                                    f"{METRIC_UNITS[metric]}(s)")
+            samples[labels] = f"{family}{braces} {float(value)!r}\n".encode()
+        rtts = getattr(data, "rtts", None)
+        if rtts:
+            family = f"network_health_{test_type}_rtt_milliseconds"
+            samples = self._family(family, "histogram", f"Round trip times of the {test_type} tests")
+            histogram = self.histograms.get((family, labels))
+            if histogram is None:
+                histogram = self.histograms[(family, labels)] = _Histogram()
+            histogram.observe(rtts)
+            samples[labels] = histogram.render(family, labels)
+
+    def _render(self):
+        self.body = b"".join(self.headers[family] + b"".join(samples.values())
+                             for family, samples in sorted(self.families.items()))
+
+    def submit_ping(self, data, local: bool = True, tags: list = None):
+        with self.lock:
+            self._update(data, "ping_local" if local else "ping_remote")
+            self._render()
+
+    def submit_ping_fleet(self, results_by_target: dict, local: bool = True, tags_by_target: dict = None):
+        with self.lock:
+            for target, data in results_by_target.items():
+                self._update(data, "ping_local" if local else "ping_remote", target=target)
+            self._render()
+
+    def submit_bandwidth(self, data, local: bool = True, target: str = None, tags: list = None):
+        with self.lock:
+            self._update(data, "bandwidth_local" if local else "bandwidth_remote", target=target)
+            self._render()
+
+    def close(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        self.server.shutdown()
+        self.server.server_close()
+        return True
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import time
+
+from lib.throughput import DEFAULT_BUFFER_SIZE, DEFAULT_PORT, MEGABYTE, RECEIVED_REPORT
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_MAX_CONNECTIONS = 256
+DEFAULT_STATS_INTERVAL = 60.0
+ECHO_TIMESTAMP = struct.Struct("!Q")  # Appended to every UDP echo: the server's receive time in nanoseconds
+
+
+class ClientStats:
+    """Traffic seen from one client address."""
+
+    __slots__ = ("udp_packets", "udp_bytes", "tcp_connections", "tcp_active", "tcp_bytes", "rejected", "last_seen")
+
+    def __init__(self):
+        self.udp_packets = 0
+        self.udp_bytes = 0
+        self.tcp_connections = 0
+        self.tcp_active = 0
+        self.tcp_bytes = 0
+        self.rejected = 0
+        self.last_seen = 0.0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _EchoProtocol(asyncio.DatagramProtocol):
+    """Answers every UDP probe with its own payload followed by the server's receive timestamp."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        received_at = time.time_ns()
+        stats = self.server.client(address[0])
+        stats.udp_packets += 1
+        stats.udp_bytes += len(data)
+        self.transport.sendto(data + ECHO_TIMESTAMP.pack(received_at), address)
+
+
+class _ThroughputProtocol(asyncio.BufferedProtocol):
+    """
+    The receiving end of a throughput stream. Data is read straight into a preallocated buffer and discarded; once the
+    client stops sending, the number of bytes received is sent back.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.buffer = memoryview(bytearray(server.buffer_size))
+        self.transport = None
+        self.stats = None
+        self.address = None
+        self.received = 0
+        self.start = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        self.stats = self.server.client(self.address[0])
+        if self.server.active_connections >= self.server.max_connections:
+            self.stats.rejected += 1
+            logger.warning(f"Rejecting throughput stream from {self.address[0]}, already serving "
+                           f"{self.server.active_connections} connection(s)")
+            transport.abort()
+            self.stats = None
+            return
+        self.server.active_connections += 1
+        self.stats.tcp_connections += 1
+        self.stats.tcp_active += 1
+        self.start = time.monotonic()
+        sock = transport.get_extra_info("socket")
+        if sock is not None and self.server.socket_buffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.server.socket_buffer)
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        self.received += nbytes
+        self.stats.tcp_bytes += nbytes
+        self.stats.last_seen = time.time()
+
+    def eof_received(self):
+        self.transport.write(RECEIVED_REPORT.pack(self.received))
+        self.transport.close()
+        return True
+
+    def connection_lost(self, exc):
+        if self.stats is None:
+            return
+        self.server.active_connections -= 1
+        self.stats.tcp_active -= 1
+        elapsed = time.monotonic() - self.start
+        logger.info(f"Received {self.received / MEGABYTE:.0f} megabyte(s) from {self.address[0]}:{self.address[1]} in "
+                    f"{elapsed:.2f} second(s)")
+
+
+class ReflectorServer:
+    """
+    A target for a whole fleet of agents. On one port number it answers UDP echo probes (for `--native-ping` with
+    `--native-ping-port`) and receives TCP throughput streams (for `--native-iperf`) from many clients at once on a
+    single asyncio event loop.
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = DEFAULT_PORT,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 socket_buffer: int = None, stats_interval: float = DEFAULT_STATS_INTERVAL, stats_file: str = None):
+        """
+        :param host: str: The address to listen on
+        :param port: int: The UDP and TCP port to listen on
+        :param max_connections: int: Throughput streams served at once, beyond which new streams are rejected
+        :param buffer_size: int: Bytes read per receive on each throughput stream
+        :param socket_buffer: int: SO_RCVBUF for each throughput stream. Left to the OS if not given
+        :param stats_interval: float: Seconds between per-client stats reports
+        :param stats_file: str: If given, the per-client stats are written to this file as JSON on every report
+        """
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.buffer_size = buffer_size
+        self.socket_buffer = socket_buffer
+        self.stats_interval = stats_interval
+        self.stats_file = stats_file
+        self.clients = {}
+        self.active_connections = 0
+        self.loop = None
+        self.stopped = None
+
+    def client(self, address: str):
+        stats = self.clients.get(address)
+        if stats is None:
+            stats = self.clients[address] = ClientStats()
+        stats.last_seen = time.time()
+        return stats
+
+    def stats(self):
+        """
+        The stats function reports the traffic seen from every client so far.
+
+        :return: A dictionary of client address to a dictionary of counters
+        """
+        return {address: stats.as_dict() for address, stats in self.clients.items()}
+
+    def report_stats(self):
+        snapshot = self.stats()
+        logger.info(f"Serving {len(snapshot)} client(s), {self.active_connections} active throughput stream(s)")
+        for address, stats in snapshot.items():
+            logger.info(f"{address}: {stats}")
+        if self.stats_file is not None:
+            temporary_path = f"{self.stats_file}.tmp"
+            with open(temporary_path, "w") as stats_file:
+                json.dump({"time": time.time(), "clients": snapshot}, stats_file)
+            os.replace(temporary_path, self.stats_file)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        udp_transport, _ = await self.loop.create_datagram_endpoint(lambda: _EchoProtocol(self),
+                                                                    local_addr=(self.host, self.port))
+        tcp_server = await self.loop.create_server(lambda: _ThroughputProtocol(self), self.host, self.port,
+                                                   backlog=self.max_connections, reuse_address=True)
+        logger.info(f"Reflector listening on {self.host}:{self.port} (UDP echo and TCP throughput)")
+        try:
+            while not self.stopped.is_set():
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), timeout=self.stats_interval)
+                except asyncio.TimeoutError:
+                    self.report_stats()
+        finally:
+            udp_transport.close()
+            tcp_server.close()
+            await tcp_server.wait_closed()
+            self.report_stats()
+
+    def run(self):
+        """The run function serves until stop is called."""
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """The stop function stops the server. Safe to call from signal handlers and other threads."""
+        if self.loop is not None and self.stopped is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
@@ -0,0 +1,116 @@
+from array import array
+
+
+class _Result:
+    """
+    The common base of the typed test results. Metrics are numeric attributes, listed in METRICS in the order they are
+    reported. A metric that could not be measured is None and is left out of items.
+    """
+
+    __slots__ = ()
+    METRICS = ()
+
+    def __init__(self, **metrics):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for name, value in metrics.items():
+            setattr(self, name, value)
+
+    def items(self):
+        """
+        The items method lists the metrics that were measured.
+
+        :return: A list of (metric, value) tuples, in METRICS order
+        """
+        return [(name, getattr(self, name)) for name in self.METRICS if getattr(self, name) is not None]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __getitem__(self, name: str):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        metrics = ", ".join(f"{name}={value!r}" for name, value in self.items())
+        return f"{type(self).__name__}({metrics})"
+
+
+class PingResult(_Result):
+    """
+    The result of a ping run. Latencies are in milliseconds and packet_loss is a percentage. rtts holds the round trip
+    time of every reply in milliseconds and is not a metric.
+    """
+
+    METRICS = ("packet_loss", "minimum_latency", "average_latency", "max_latency", "standard_deviation_latency",
+               "p50_latency", "p95_latency", "p99_latency", "jitter", "max_loss_burst")
+    __slots__ = METRICS + ("rtts",)
+
+    def __init__(self, rtts=None, **metrics):
+        super().__init__(**metrics)
+        self.rtts = rtts if rtts is not None else array("d")
+
+
+class IperfResult(_Result):
+    """
+    The result of a bandwidth test. transfer_value is in megabytes, bandwidth_value in megabytes/second and
+    interval_value in seconds. intervals holds the IperfInterval of every interval report and is not a metric.
+    """
+
+    METRICS = ("transfer_value", "bandwidth_value", "interval_value")
+    __slots__ = METRICS + ("intervals",)
+
+    def __init__(self, intervals: list = None, **metrics):
+        super().__init__(**metrics)
+        self.intervals = intervals if intervals is not None else []
+
+
+class HopResult(_Result):
+    """
+    The latency and loss of one hop of a path, measured with TTL-limited probes. Latencies are in milliseconds and
+    packet_loss is a percentage. address is the router that answered, None if no probe to the hop was answered, and is
+    not a metric.
+    """
+
+    METRICS = ("packet_loss", "minimum_latency", "average_latency", "max_latency", "standard_deviation_latency")
+    __slots__ = METRICS + ("address",)
+
+    def __init__(self, address: str = None, **metrics):
+        super().__init__(**metrics)
+        self.address = address
+
+
+class PathResult(_Result):
+    """
+    The result of a path analysis against one target. hop_count is the number of hops to the target, or to the last hop
+    that answered if the target was never reached. hops holds a HopResult per hop, starting at the first, and reached
+    whether the target itself answered. Neither is a metric.
+    """
+
+    METRICS = ("hop_count",)
+    __slots__ = METRICS + ("hops", "reached")
+
+    def __init__(self, hops: list = None, reached: bool = False, **metrics):
+        super().__init__(**metrics)
+        self.hops = hops if hops is not None else []
+        self.reached = reached
+
+
+class DnsResult(_Result):
+    """
+    The result of resolving one target. lookup_time is in milliseconds, and is measured for failed lookups too. address
+    is the IPv4 address the target resolved to, None if the lookup failed, and is not a metric.
+    """
+
+    METRICS = ("lookup_time",)
+    __slots__ = METRICS + ("address",)
+
+    def __init__(self, address: str = None, **metrics):
+        super().__init__(**metrics)
+        self.address = address
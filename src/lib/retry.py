@@ -0,0 +1,205 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from lib.tracing import tracer
+
+logger = logging.getLogger("network_health")
+
+CIRCUIT_CLOSED = "closed"  # Requests flow normally
+CIRCUIT_OPEN = "open"  # Too many failures in a row, requests are refused until the reset timeout passes
+CIRCUIT_HALF_OPEN = "half-open"  # The reset timeout passed, a single trial request is let through
+
+RETRYABLE_STATUS_CODES = {408, 429}  # Along with every 5xx
+
+
+def is_retryable(response):
+    """
+    The is_retryable function decides whether a failed request is worth retrying.
+
+    :param response: The response, or None if the request failed before a response was received
+    :return: True for connection errors, timeouts, rate limiting and server errors
+    """
+    if response is None:
+        return True
+    return response.status_code in RETRYABLE_STATUS_CODES or response.status_code >= 500
+
+
+def parse_retry_after(response):
+    """
+    The parse_retry_after function reads how long the server asked us to wait from the `Retry-After` header, or from
+    Datadog's `X-RateLimit-Reset` header on rate limited responses.
+
+    :param response: The response, or None
+    :return: The number of seconds to wait, or None if the server did not say
+    """
+    if response is None:
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            logger.debug(f"Ignoring unparseable Retry-After header: {retry_after}")
+    if response.status_code == 429:
+        reset = response.headers.get("X-RateLimit-Reset")
+        if reset is not None:
+            try:
+                return max(0.0, float(reset))
+            except ValueError:
+                logger.debug(f"Ignoring unparseable X-RateLimit-Reset header: {reset}")
+    return None
+
+
+class RetryPolicy:
+    """
+    Decides when and whether to retry failed requests. Delays grow exponentially with full jitter, unless the server
+    says how long to wait. Retries are limited per attempt, per cycle (the retry budget), and a circuit breaker stops
+    sending altogether after too many failures in a row, then lets a single trial request through after a cool down.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0,
+                 retry_budget: int = 20, failure_threshold: int = 5, reset_timeout: float = 60.0,
+                 sleep=time.sleep, clock=time.monotonic):
+        """
+        :param max_attempts: int: Retries allowed for a single request
+        :param base_delay: float: Seconds the first backoff is drawn from, doubled for every later attempt
+        :param max_delay: float: The longest a single backoff may be. Requests asking for longer are given up on
+        :param retry_budget: int: Retries allowed across all requests in one cycle
+        :param failure_threshold: int: Failed requests in a row that open the circuit
+        :param reset_timeout: float: Seconds the circuit stays open before a trial request is allowed
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.sleep = sleep
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.retries_left = retry_budget
+        self.consecutive_failures = 0
+        self.state = CIRCUIT_CLOSED
+        self.opened_at = None
+
+    def start_cycle(self):
+        """The start_cycle function refills the retry budget at the start of a submission cycle."""
+        with self.lock:
+            self.retries_left = self.retry_budget
+
+    def allow_request(self):
+        """
+        The allow_request function checks the circuit breaker before a request is sent.
+
+        :return: True if the request may be sent
+        """
+        with self.lock:
+            if self.state == CIRCUIT_OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                logger.info("Circuit breaker cool down passed, allowing a trial request")
+                self.state = CIRCUIT_HALF_OPEN
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CIRCUIT_CLOSED:
+                logger.info("Trial request succeeded, closing circuit breaker")
+            self.consecutive_failures = 0
+            self.state = CIRCUIT_CLOSED
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != CIRCUIT_OPEN:
+                    logger.error(f"Opening circuit breaker after {self.consecutive_failures} failure(s) in a row, "
+                                 f"pausing requests for {self.reset_timeout} seconds")
+                self.state = CIRCUIT_OPEN
+                self.opened_at = self.clock()
+
+    def consume_retry(self):
+        """
+        The consume_retry function takes one retry from the budget of the current cycle.
+
+        :return: True if a retry was available
+        """
+        with self.lock:
+            if self.retries_left <= 0:
+                return False
+            self.retries_left -= 1
+            return True
+
+    def backoff(self, attempt: int, response=None):
+        """
+        The backoff function computes how long to wait before the next attempt.
+
+        :param attempt: int: The number of the retry about to be made, starting at 1
+        :param response: The last response, used for its Retry-After and rate limit headers
+        :return: The number of seconds to wait, or None if the server asked for a longer wait than max_delay
+        """
+        retry_after = parse_retry_after(response)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, send, response=None):
+        """
+        The call function sends a request with send, retrying failures according to this policy.
+
+        :param send: Called without arguments, returns a response or raises an OSError-based exception such as a
+            requests ConnectionError
+        :param response: The response to a first attempt the caller already made, if any
+        :return: The last response received and whether it succeeded. The response is None if no response was ever
+            received
+        """
+        first_attempt = 0
+        if response is not None:
+            first_attempt = 1
+            if response.ok:
+                self.record_success()
+                return response, True
+            if is_retryable(response):
+                self.record_failure()
+        for attempt in range(first_attempt, self.max_attempts + 1):
+            if attempt > 0:
+                if not is_retryable(response):
+                    break
+                if not self.consume_retry():
+                    logger.error("Retry budget for this cycle is exhausted, giving up")
+                    tracer.count("retry.budget_exhausted")
+                    break
+                tracer.count("retry.retries")
+                delay = self.backoff(attempt, response)
+                if delay is None:
+                    logger.error(f"Server asked to wait longer than {self.max_delay} seconds, giving up")
+                    break
+                logger.info(f"Attempting retry: {attempt}/{self.max_attempts} in {delay:.2f} seconds...")
+                self.sleep(delay)
+            if not self.allow_request():
+                logger.error("Circuit breaker is open, not sending request")
+                tracer.count("retry.circuit_rejected")
+                break
+            try:
+                response = send()
+            except OSError as e:
+                logger.error(f"Request failed: {e!r}")
+                response = None
+            if response is not None and response.ok:
+                self.record_success()
+                return response, True
+            if is_retryable(response):
+                # Rejected payloads say nothing about the health of the server
+                self.record_failure()
+            if response is not None and response.status_code == 403:
+                break
+        return response, False
@@ -0,0 +1,123 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger("network_health")
+
+PHASE_LATENCY = "latency"  # Tests that barely load the link and can all run side by side (ping)
+PHASE_BANDWIDTH = "bandwidth"  # Tests that saturate the link and would skew each other (iperf)
+
+PHASE_ORDER = [PHASE_LATENCY, PHASE_BANDWIDTH]
+
+
+class NetworkTest:
+    """A single test to run, along with what to do with its results once it completes."""
+
+    def __init__(self, name: str, func, kwargs: dict = None, phase: str = PHASE_LATENCY, on_result=None,
+                 enabled=None, targets: list = None):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs or {}
+        self.phase = phase
+        self.on_result = on_result
+        self.enabled = enabled  # If given, called when the test's phase starts, and the test is skipped unless True
+        self.targets = targets or []  # The hosts the test runs against, resolved before the cycle starts
+
+    def run(self):
+        logger.info(f"Starting {self.name} test...")
+        return self.func(**self.kwargs)
+
+
+class PhaseGate:
+    """
+    Keeps the phases of test runs that overlap, such as the jobs of a daemon, from skewing each other. Any number of
+    latency phases may run at once, while a bandwidth phase runs alone. A bandwidth phase that is waiting holds back
+    new latency phases, so pings that run back to back can not starve it.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.latency_running = 0
+        self.bandwidth_running = False
+        self.bandwidth_waiting = 0
+
+    def _latency_may_start(self):
+        return not self.bandwidth_running and self.bandwidth_waiting == 0
+
+    def _bandwidth_may_start(self):
+        return not self.bandwidth_running and self.latency_running == 0
+
+    @contextmanager
+    def phase(self, phase: str):
+        """
+        The phase function waits until the given phase may run, and holds it for the body of a with statement.
+
+        :param phase: str: PHASE_LATENCY or PHASE_BANDWIDTH
+        """
+        with self.condition:
+            if phase == PHASE_BANDWIDTH:
+                self.bandwidth_waiting += 1
+                if not self._bandwidth_may_start():
+                    logger.info("Waiting for running tests to finish before the bandwidth phase...")
+                self.condition.wait_for(self._bandwidth_may_start)
+                self.bandwidth_waiting -= 1
+                self.bandwidth_running = True
+            else:
+                if not self._latency_may_start():
+                    logger.info("Waiting for bandwidth tests to finish before the latency phase...")
+                self.condition.wait_for(self._latency_may_start)
+                self.latency_running += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                if phase == PHASE_BANDWIDTH:
+                    self.bandwidth_running = False
+                else:
+                    self.latency_running -= 1
+                self.condition.notify_all()
+
+
+def run_tests_concurrently(tests: list, max_bandwidth_concurrency: int = 1, gate: PhaseGate = None):
+    """
+    The run_tests_concurrently function runs the given tests in phases. Every latency test runs in parallel, then the
+    bandwidth tests run with at most max_bandwidth_concurrency of them at a time so they do not compete for the link.
+    Each test's on_result callback is called from the calling thread as soon as that test completes.
+
+    :param tests: list: The NetworkTest objects to run
+    :param max_bandwidth_concurrency: int: The maximum number of bandwidth tests allowed to run at the same time
+    :param gate: PhaseGate: Shared with other runs that may overlap this one, so their phases are kept apart
+    :return: A dictionary of test name to results, and a dictionary of test name to the exception it raised
+    """
+    results = {}
+    errors = {}
+    for phase in PHASE_ORDER:
+        phase_tests = [test for test in tests if test.phase == phase and (test.enabled is None or test.enabled())]
+        if len(phase_tests) == 0:
+            continue
+        if phase == PHASE_BANDWIDTH:
+            max_workers = max(1, min(max_bandwidth_concurrency, len(phase_tests)))
+        else:
+            max_workers = len(phase_tests)
+        with gate.phase(phase) if gate is not None else nullcontext():
+            logger.info(f"Running {len(phase_tests)} {phase} test(s) with {max_workers} worker(s)...")
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{phase}-test") as executor:
+                futures = {executor.submit(test.run): test for test in phase_tests}
+                for future in as_completed(futures):
+                    test = futures[future]
+                    try:
+                        test_results = future.result()
+                    except Exception as e:
+                        logger.error(f"{test.name} test failed: {e!r}")
+                        errors[test.name] = e
+                        continue
+                    logger.info(f"Completed {test.name} test.")
+                    results[test.name] = test_results
+                    if test.on_result is not None:
+                        try:
+                            test.on_result(test_results)
+                        except Exception as e:
+                            logger.error(f"Handling the results of the {test.name} test failed: {e!r}")
+                            errors[test.name] = e
+    return results, errors
@@ -0,0 +1,138 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("network_health")
+
+
+class ScheduledJob:
+    """A function run every interval seconds, delayed by up to jitter seconds each time."""
+
+    def __init__(self, name: str, func, interval: float, jitter: float = 0.0, next_run: float = None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.slot = next_run if next_run is not None else time.monotonic()  # The start of the run before jitter
+        self.next_run = self.slot
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+
+    def schedule_next(self, now: float):
+        # Stay on the original cadence, skipping any slots that were missed while the job was running. Jitter delays
+        # each run without moving the slots, so it does not add up over time.
+        while self.slot <= now:
+            self.slot += self.interval
+        self.next_run = self.slot + random.uniform(0, self.jitter)
+
+
+class Scheduler:
+    """
+    Runs jobs on their own intervals until stopped. A job is never started while its previous run is still going, so
+    a slow test skips its next slot instead of stacking up runs.
+    """
+
+    def __init__(self, max_workers: int = 4, clock=time.monotonic):
+        """
+        :param max_workers: int: The maximum number of jobs running at the same time
+        :param clock: Returns the current time in seconds
+        """
+        self.clock = clock
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scheduled-job")
+
+    def add_job(self, name: str, func, interval: float, jitter: float = 0.0, run_immediately: bool = True):
+        """
+        The add_job function adds a job to the schedule.
+
+        :param name: str: Name of the job, used in logs
+        :param func: The function to run, called without arguments
+        :param interval: float: Seconds between the start of each run
+        :param jitter: float: Up to this many seconds are randomly added to every start, so hosts do not run in step
+        :param run_immediately: bool: Run the job as soon as the scheduler starts instead of after the first interval
+        :return: The ScheduledJob that was added
+        """
+        job = ScheduledJob(name, func, interval, jitter, next_run=self.clock())
+        if not run_immediately:
+            job.slot += interval
+        job.next_run = job.slot + random.uniform(0, jitter)
+        with self.lock:
+            self.jobs.append(job)
+        self.wake_event.set()
+        logger.info(f"Scheduled job: {name} every {interval} seconds with up to {jitter} seconds of jitter")
+        return job
+
+    def remove_job(self, job: ScheduledJob):
+        """
+        The remove_job function takes a job off the schedule. A run that is already going is left to finish.
+
+        :param job: ScheduledJob: The job, as returned by add_job
+        """
+        with self.lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+        self.wake_event.set()
+        logger.info(f"Unscheduled job: {job.name}")
+
+    def _run_job(self, job: ScheduledJob):
+        start = self.clock()
+        try:
+            job.func()
+        except Exception as e:
+            logger.exception(f"Scheduled job: {job.name} failed: {e!r}")
+        finally:
+            with self.lock:
+                job.running = False
+                job.runs += 1
+            logger.info(f"Scheduled job: {job.name} finished in {self.clock() - start:.2f} seconds")
+
+    def run_pending(self):
+        """
+        The run_pending function starts every job that is due, skipping those whose previous run is still going, and
+        schedules their next runs.
+
+        :return: The time the next job is due, or None if there are no jobs
+        """
+        now = self.clock()
+        with self.lock:
+            for job in self.jobs:
+                if job.next_run > now:
+                    continue
+                if job.running:
+                    job.skipped += 1
+                    logger.warning(f"Scheduled job: {job.name} is still running, skipping this run "
+                                   f"({job.skipped} skipped so far)")
+                else:
+                    job.running = True
+                    self.executor.submit(self._run_job, job)
+                job.schedule_next(now)
+            if len(self.jobs) == 0:
+                return None
+            return min(job.next_run for job in self.jobs)
+
+    def run_forever(self):
+        """
+        The run_forever function starts jobs as they become due until stop is called, then waits for running jobs to
+        finish.
+        """
+        logger.info("Scheduler started.")
+        try:
+            while not self.stop_event.is_set():
+                next_run = self.run_pending()
+                wait = None if next_run is None else max(0.0, next_run - self.clock())
+                self.wake_event.wait(wait)
+                self.wake_event.clear()
+        finally:
+            logger.info("Scheduler stopping, waiting for running jobs to finish...")
+            self.executor.shutdown(wait=True)
+            logger.info("Scheduler stopped.")
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
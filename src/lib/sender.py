@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("network_health")
+
+POLICY_DROP_OLDEST = "drop-oldest"  # A full queue drops its oldest batch to make room
+POLICY_BLOCK = "block"  # A full queue makes the caller wait for room
+POLICY_SPILL = "spill"  # A full queue writes the batch to the client's spool, to be replayed on a later delivery
+BACKPRESSURE_POLICIES = [POLICY_DROP_OLDEST, POLICY_BLOCK, POLICY_SPILL]
+
+DEFAULT_MAX_QUEUE_SIZE = 100
+DEFAULT_SHUTDOWN_TIMEOUT = 30.0
+
+
+class BackgroundSender:
+    """
+    Sends series to Datadog from a background thread, so callers only pay for putting them on a bounded queue. Each
+    queued batch is delivered with the client's retries and spool. What happens when the queue is full is decided by the
+    backpressure policy.
+    """
+
+    def __init__(self, client, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE, policy: str = POLICY_DROP_OLDEST):
+        """
+        :param client: DatadogClient: The client that delivers the series
+        :param max_queue_size: int: The number of batches that may wait to be sent
+        :param policy: str: One of BACKPRESSURE_POLICIES
+        """
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        if policy == POLICY_SPILL and client.spool is None:
+            raise ValueError(f"The {POLICY_SPILL} backpressure policy needs a client with a spool")
+        self.client = client
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.closing = False
+        self.busy = False
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name="datadog-sender", daemon=True)
+        self.thread.start()
+
+    def enqueue(self, series: list):
+        """
+        The enqueue function hands series to the background thread and returns straight away, unless the queue is full
+        and the policy is to block.
+
+        :param series: list: The series to send
+        """
+        if len(series) == 0:
+            return
+        with self.condition:
+            if self.closing:
+                raise RuntimeError("Can not enqueue series, the sender is closed")
+            if len(self.queue) >= self.max_queue_size:
+                if self.policy == POLICY_BLOCK:
+                    self.condition.wait_for(lambda: len(self.queue) < self.max_queue_size or self.closing)
+                elif self.policy == POLICY_DROP_OLDEST:
+                    dropped = self.queue.popleft()
+                    self.dropped += len(dropped)
+                    logger.warning(f"Submission queue is full, dropped {len(dropped)} of the oldest series")
+                else:
+                    self.client.spool.append(series)
+                    logger.warning(f"Submission queue is full, spilled {len(series)} series to the spool")
+                    return
+            self.queue.append(series)
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.closing)
+                if not self.queue:
+                    return
+                series = self.queue.popleft()
+                self.busy = True
+                self.condition.notify_all()
+            try:
+                self.client.retry_policy.start_cycle()
+                self.client.deliver_series(series)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Background submission of {len(series)} series failed: {e}")
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def close(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        """
+        The close function stops accepting series and waits up to timeout seconds for the queue to drain. Whatever is
+        still queued at the deadline is written to the spool if the client has one, and dropped otherwise.
+
+        :param timeout: float: Seconds to wait for the queue to drain
+        :return: True if everything queued was delivered successfully
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: not self.queue and not self.busy,
+                                    timeout=max(0.0, deadline - time.monotonic()))
+            leftover = list(self.queue)
+            self.queue.clear()
+        if leftover:
+            count = sum(len(series) for series in leftover)
+            if self.client.spool is not None:
+                for series in leftover:
+                    self.client.spool.append(series)
+                logger.warning(f"Shutdown deadline passed, kept {count} unsent series in the spool")
+            else:
+                self.dropped += count
+                logger.error(f"Shutdown deadline passed, dropped {count} unsent series")
+        self.thread.join(max(0.0, deadline - time.monotonic()))
+        return self.failed == 0 and not leftover
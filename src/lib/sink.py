@@ -0,0 +1,165 @@
+import logging
+from abc import ABC, abstractmethod
+
+from lib.datadog import DatadogClient
+from lib.sender import DEFAULT_SHUTDOWN_TIMEOUT
+from lib.store import TimeSeriesStore
+
+logger = logging.getLogger("network_health")
+
+
+class Sink(ABC):
+    """
+    Where test results go. Every output backend implements the submit methods for ping and bandwidth results; the
+    tests hand each result to every configured sink as soon as the test completes. The other methods default to doing
+    nothing.
+    """
+
+    name = "sink"
+
+    @abstractmethod
+    def submit_ping(self, data, local: bool = True, tags: list = None):
+        """
+        The submit_ping function takes the result of a single ping test.
+
+        :param data: PingResult: The result of the test
+        :param local: bool: Whether the test was run against a local or a remote target
+        :param tags: list: Tags from a test plan, such as `env:prod`, for sinks that support them
+        """
+
+    @abstractmethod
+    def submit_ping_fleet(self, results_by_target: dict, local: bool = True, tags_by_target: dict = None):
+        """
+        The submit_ping_fleet function takes the results of a ping test run against many targets.
+
+        :param results_by_target: dict: A dictionary of target to PingResult
+        :param local: bool: Whether the targets are local or remote
+        :param tags_by_target: dict: A dictionary of target to its tags from a test plan
+        """
+
+    @abstractmethod
+    def submit_bandwidth(self, data, local: bool = True, target: str = None, tags: list = None):
+        """
+        The submit_bandwidth function takes the result of a bandwidth test.
+
+        :param data: IperfResult: The result of the test
+        :param local: bool: Whether the test was run against a local or a remote target
+        :param target: str: The target, when bandwidth is tested against many targets and their results must be told
+            apart
+        :param tags: list: Tags from a test plan, such as `env:prod`, for sinks that support them
+        """
+
+    def submit_path(self, results_by_target: dict):
+        """
+        The submit_path function takes the results of a path analysis. Sinks without a way to keep per-hop series
+        ignore them.
+
+        :param results_by_target: dict: A dictionary of target to PathResult
+        """
+
+    def submit_dns(self, results_by_target: dict):
+        """
+        The submit_dns function takes the time every target took to resolve, for the lookups made since the last cycle.
+        Sinks without a way to keep them ignore them.
+
+        :param results_by_target: dict: A dictionary of target to DnsResult
+        """
+
+    def submit_self_metrics(self, metrics: dict):
+        """
+        The submit_self_metrics function takes the stats the process collected about its own runs since the last
+        cycle. Sinks that have nowhere to put them ignore them.
+
+        :param metrics: dict: Metric name to a tuple of value, unit and kind, from tracing.snapshot_metrics
+        """
+
+    def flush(self):
+        """The flush function is called once all of the tests of a cycle have completed."""
+
+    def drain(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        """
+        The drain function is called once before the process exits, before close. It waits for results still being
+        sent in the background, and the sink must accept and flush results synchronously afterwards.
+
+        :param timeout: float: Seconds the sink may take to finish sending
+        :return: True if every result was handled
+        """
+        return True
+
+    def close(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        """
+        The close function is called once before the process exits.
+
+        :param timeout: float: Seconds the sink may take to finish sending
+        :return: True if every result was handled
+        """
+        return True
+
+
+class DatadogSink(Sink):
+    """Sends results to Datadog through a DatadogClient."""
+
+    name = "datadog"
+
+    def __init__(self, client: DatadogClient):
+        """
+        :param client: DatadogClient: The validated client
+        """
+        self.client = client
+
+    def submit_ping(self, data, local: bool = True, tags: list = None):
+        self.client.submit_ping_network_health(data, local=local, tags=tags)
+
+    def submit_ping_fleet(self, results_by_target: dict, local: bool = True, tags_by_target: dict = None):
+        self.client.submit_ping_fleet(results_by_target, local=local, tags_by_target=tags_by_target)
+
+    def submit_bandwidth(self, data, local: bool = True, target: str = None, tags: list = None):
+        if target is not None:
+            tags = [f"target:{target}"] + list(tags or [])
+        self.client.submit_bandwidth_data(data, local=local, tags=tags)
+
+    def submit_path(self, results_by_target: dict):
+        self.client.submit_path_analysis(results_by_target)
+
+    def submit_dns(self, results_by_target: dict):
+        self.client.submit_dns(results_by_target)
+
+    def submit_self_metrics(self, metrics: dict):
+        self.client.submit_self_metrics(metrics)
+
+    def flush(self):
+        self.client.flush()
+
+    def drain(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        return self.client.stop_background_sender(timeout=timeout)
+
+    def close(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        return self.client.close(timeout=timeout)
+
+
+class StoreSink(Sink):
+    """Keeps results in a local TimeSeriesStore."""
+
+    name = "local store"
+
+    def __init__(self, store: TimeSeriesStore):
+        """
+        :param store: TimeSeriesStore: The store to keep results in
+        """
+        self.store = store
+
+    def submit_ping(self, data, local: bool = True, tags: list = None):
+        self.store.record_ping(data, local=local)
+
+    def submit_ping_fleet(self, results_by_target: dict, local: bool = True, tags_by_target: dict = None):
+        self.store.record_ping_fleet(results_by_target, local=local)
+
+    def submit_bandwidth(self, data, local: bool = True, target: str = None, tags: list = None):
+        self.store.record_bandwidth(data, local=local, target=target)
+
+    def submit_self_metrics(self, metrics: dict):
+        self.store.append_many([(name, value) for name, (value, _, _) in metrics.items()])
+
+    def close(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        self.store.rollup()
+        return True
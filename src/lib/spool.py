@@ -0,0 +1,317 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from lib.tracing import tracer
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger("network_health")
+
+SEGMENT_SUFFIX = ".jsonl"
+ACTIVE_SUFFIX = ".active"
+CREATING_SUFFIX = ".creating"  # A new active segment, until its writer holds the lock on it
+REWRITING_SUFFIX = ".rewriting"  # The unsent tail of a partly replayed segment, until it replaces the segment
+REPLAY_LOCK_NAME = "replay.lock"
+
+DEFAULT_SPOOL_DIR = os.path.join(os.path.expanduser("~"), ".network_health", "spool")
+DEFAULT_MAX_SEGMENT_BYTES = 1_000_000
+DEFAULT_MAX_TOTAL_BYTES = 100_000_000
+DEFAULT_MAX_AGE_SECONDS = 3600  # Datadog drops points more than an hour old, so older segments are not worth sending
+DEFAULT_FSYNC_EVERY = 100  # Records written between fsyncs
+DEFAULT_FSYNC_INTERVAL = 5.0  # Seconds between fsyncs
+
+
+def _try_lock(lock_file):
+    """
+    The _try_lock function takes an exclusive lock on an open file without waiting. The lock is shared by nothing else,
+    not even other opens of the same file in this process, and is released when the file is closed.
+
+    :param lock_file: The open file
+    :return: True if the lock was taken
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class MetricSpool:
+    """
+    An append-only store of series waiting to be sent. Series are written one per line into JSON-lines segment files.
+    The segment being written to ends in `.active`; sealing it makes it ready to be replayed. Segments are replayed
+    oldest first and deleted once they are sent, so data survives both unreachable endpoints and process restarts.
+
+    Several processes, such as overlapping cron runs, may share a directory. Each one holds a lock on its active
+    segment for as long as it writes to it, so only the segments of processes that are gone are recovered, and a
+    lock file lets one process at a time replay.
+    """
+
+    def __init__(self, directory: str = DEFAULT_SPOOL_DIR, max_segment_bytes: int = DEFAULT_MAX_SEGMENT_BYTES,
+                 max_total_bytes: int = DEFAULT_MAX_TOTAL_BYTES, max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS,
+                 fsync_every: int = DEFAULT_FSYNC_EVERY, fsync_interval: float = DEFAULT_FSYNC_INTERVAL):
+        """
+        :param directory: str: Where the segment files are kept
+        :param max_segment_bytes: int: Size at which the active segment is sealed and a new one started
+        :param max_total_bytes: int: Total size of all segments, beyond which the oldest segments are deleted
+        :param max_age_seconds: float: Age beyond which segments are deleted without being sent
+        :param fsync_every: int: Number of records written between fsyncs
+        :param fsync_interval: float: Seconds between fsyncs, whichever comes first
+        """
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_age_seconds = max_age_seconds
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.lock = threading.RLock()  # Guards the active segment
+        self.replay_lock = threading.Lock()  # Only one replay at a time, without blocking appends while it sends
+        self.active_file = None
+        self.active_path = None
+        self.unsynced_records = 0
+        self.last_fsync = time.monotonic()
+        self.last_segment_id = 0
+        os.makedirs(self.directory, exist_ok=True)
+        # Segments left active by a previous process that exited uncleanly are sealed so they get replayed
+        for name in os.listdir(self.directory):
+            if name.endswith(ACTIVE_SUFFIX):
+                self._recover(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _recover(path: str):
+        """
+        The _recover function seals an active segment whose writer is gone. A segment still locked by a running process
+        is left alone. Windows refuses to rename a file another process has open, which has the same effect there.
+
+        :param path: str: Path to the active segment
+        """
+        sealed_path = path[:-len(ACTIVE_SUFFIX)]
+        try:
+            if fcntl is not None:
+                with open(path, "rb") as segment:
+                    if not _try_lock(segment):
+                        return
+                    os.replace(path, sealed_path)
+            else:
+                os.replace(path, sealed_path)
+        except (FileNotFoundError, PermissionError):
+            return  # Recovered by another process first, or still open on Windows
+        logger.info(f"Recovered spool segment: {os.path.basename(path)}")
+
+    def _new_segment_path(self):
+        # Names sort in creation order, which is the order segments are replayed in
+        segment_id = max(time.time_ns(), self.last_segment_id + 1)
+        self.last_segment_id = segment_id
+        return os.path.join(self.directory, f"{segment_id:020d}{SEGMENT_SUFFIX}{ACTIVE_SUFFIX}")
+
+    def _open_segment(self):
+        path = self._new_segment_path()
+        if fcntl is None:
+            return path, open(path, "ab")
+        # The segment only appears under its active name once it is locked, so it is never mistaken for an abandoned one
+        creating_path = path + CREATING_SUFFIX
+        segment = open(creating_path, "ab")
+        _try_lock(segment)
+        os.replace(creating_path, path)
+        return path, segment
+
+    def _fsync(self):
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+        self.unsynced_records = 0
+        self.last_fsync = time.monotonic()
+
+    def append(self, series: list):
+        """
+        The append function writes series to the active segment. Data is fsynced in batches rather than per record.
+
+        :param series: list: The series to store, encoded by SeriesEncoder or as dictionaries
+        """
+        with self.lock, tracer.span("spool.append"):
+            if self.active_file is None:
+                self.active_path, self.active_file = self._open_segment()
+            for each_series in series:
+                if not isinstance(each_series, (bytes, bytearray)):
+                    each_series = json.dumps(each_series, separators=(",", ":")).encode()
+                self.active_file.write(each_series)
+                self.active_file.write(b"\n")
+            self.unsynced_records += len(series)
+            if (self.unsynced_records >= self.fsync_every or
+                    time.monotonic() - self.last_fsync >= self.fsync_interval):
+                self._fsync()
+            if self.active_file.tell() >= self.max_segment_bytes:
+                self.seal()
+
+    def seal(self):
+        """The seal function fsyncs and closes the active segment so it can be replayed."""
+        with self.lock:
+            if self.active_file is None:
+                return
+            self._fsync()
+            sealed_path = self.active_path[:-len(ACTIVE_SUFFIX)]
+            try:
+                if fcntl is not None:
+                    os.replace(self.active_path, sealed_path)  # Still locked, so no other process can recover it
+                else:
+                    self.active_file.close()  # Windows does not rename open files
+                    os.replace(self.active_path, sealed_path)
+            except FileNotFoundError:
+                logger.warning(f"Spool segment {os.path.basename(self.active_path)} was already sealed")
+            finally:
+                self.active_file.close()
+            self.active_file = None
+            self.active_path = None
+
+    def segments(self):
+        """
+        The segments function lists the sealed segments.
+
+        :return: A list of segment paths, oldest first
+        """
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def evict(self):
+        """
+        The evict function deletes sealed segments that are older than max_age_seconds, then the oldest segments until
+        the spool is no larger than max_total_bytes.
+
+        :return: The number of segments deleted
+        """
+        with self.lock:
+            evicted = 0
+            now = time.time()
+            sizes = []
+            for path in self.segments():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime > self.max_age_seconds:
+                    os.remove(path)
+                    evicted += 1
+                else:
+                    sizes.append((path, stat.st_size))
+            total = sum(size for _, size in sizes)
+            for path, size in sizes:
+                if total <= self.max_total_bytes:
+                    break
+                os.remove(path)
+                total -= size
+                evicted += 1
+            if evicted > 0:
+                logger.warning(f"Evicted {evicted} spool segment(s) that were too old or over the size limit")
+            return evicted
+
+    @staticmethod
+    def read_segment(path: str):
+        """
+        The read_segment function reads the series stored in a segment, skipping a last line left incomplete by a crash.
+        Series are returned encoded, as they are sent, without being parsed.
+
+        :param path: str: Path to the segment
+        :return: A list of encoded series
+        """
+        series = []
+        with open(path, "rb") as segment:
+            for line in segment:
+                if not line.endswith(b"\n"):
+                    logger.warning(f"Skipping incomplete record in spool segment: {path}")
+                    continue
+                if len(line) > 1:
+                    series.append(line[:-1])
+        return series
+
+    @staticmethod
+    def _rewrite_segment(path: str, series: list):
+        """
+        The _rewrite_segment function replaces a segment with the given series. The new contents are written beside it
+        and renamed over it, so a crash leaves either the old or the new segment.
+
+        :param path: str: Path to the segment
+        :param series: list: The encoded series to keep
+        """
+        rewriting_path = path + REWRITING_SUFFIX
+        with open(rewriting_path, "wb") as segment:
+            for each_series in series:
+                segment.write(each_series)
+                segment.write(b"\n")
+            segment.flush()
+            os.fsync(segment.fileno())
+        os.replace(rewriting_path, path)
+
+    def replay(self, send):
+        """
+        The replay function sends every sealed segment, oldest first, deleting each one once send returns. Replay stops
+        at the first segment send raises on, leaving it and every newer segment for the next replay. If the exception
+        has a `sent` attribute, that many series from the start of the segment got through and are dropped from it, so
+        they are not sent twice. If another replay is already running, in this process or another one sharing the
+        directory, this one returns straight away and the running replay picks up the new segments.
+
+        :param send: Called with the list of series of one segment
+        :return: The number of series sent
+        """
+        if not self.replay_lock.acquire(blocking=False):
+            return 0
+        lock_file = None
+        locked = False
+        try:
+            lock_file = open(os.path.join(self.directory, REPLAY_LOCK_NAME), "ab")
+            locked = _try_lock(lock_file)
+            if not locked:
+                return 0
+            self.evict()
+            sent = 0
+            replayed = set()
+            while True:
+                pending = [path for path in self.segments() if path not in replayed]
+                if len(pending) == 0:
+                    return sent
+                for path in pending:
+                    try:
+                        series = self.read_segment(path)
+                    except FileNotFoundError:
+                        continue  # Evicted while we were sending
+                    if series:
+                        try:
+                            send(series)
+                        except Exception as e:
+                            sent_before_failure = getattr(e, "sent", 0)
+                            if 0 < sent_before_failure < len(series):
+                                self._rewrite_segment(path, series[sent_before_failure:])
+                                logger.info(f"Kept the {len(series) - sent_before_failure} unsent series of spool "
+                                            f"segment: {os.path.basename(path)}")
+                            raise
+                    replayed.add(path)
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    sent += len(series)
+        finally:
+            if lock_file is not None:
+                if locked:
+                    _unlock(lock_file)
+                lock_file.close()
+            self.replay_lock.release()
+
+    def close(self):
+        self.seal()
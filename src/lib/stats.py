@@ -0,0 +1,165 @@
+import math
+from array import array
+from itertools import islice
+
+from lib.results import PingResult
+
+JITTER_GAIN = 16  # RFC 3550 section 6.4.1 smoothing factor
+
+
+class RttSamples:
+    """
+    Collects the round trip time of every reply of a ping run. RTTs are kept in a compact array of doubles in arrival
+    order, and which packets were answered is kept in one byte per packet, so a 10k packet run costs about 90KB.
+    Running totals are kept as replies arrive so the aggregates are available while the run is still going.
+    """
+
+    __slots__ = ("rtts", "received", "sent", "observed", "total", "total_squares", "minimum", "maximum")
+
+    def __init__(self, number_of_packets: int = 0):
+        self.rtts = array("d")
+        self.received = bytearray(number_of_packets)
+        self.sent = number_of_packets
+        self.observed = 0  # Number of packets accounted for so far, answered or lost
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def _grow(self, index: int):
+        if index >= len(self.received):
+            self.received.extend(bytes(index + 1 - len(self.received)))
+            self.sent = max(self.sent, index + 1)
+        self.observed = max(self.observed, index + 1)
+
+    def add_reply(self, index: int, rtt: float):
+        """
+        The add_reply method records a reply.
+
+        :param index: int: Zero based position of the packet within the run
+        :param rtt: float: Round trip time in milliseconds
+        """
+        self._grow(index)
+        self.received[index] = 1
+        self.rtts.append(rtt)
+        self.total += rtt
+        self.total_squares += rtt * rtt
+        self.minimum = min(self.minimum, rtt)
+        self.maximum = max(self.maximum, rtt)
+
+    def add_loss(self, index: int):
+        """
+        The add_loss method records a packet that was not answered, for outputs that report losses explicitly.
+
+        :param index: int: Zero based position of the packet within the run
+        """
+        self._grow(index)
+
+    def snapshot(self, partial: bool = False):
+        """
+        The snapshot method computes the result dictionary from the replies received so far.
+
+        :param partial: bool: Compute the packet loss over the packets accounted for so far instead of every packet
+            that was meant to be sent, for runs that are still going or were cut short
+        :return: A PingResult, or None if nothing was answered yet
+        """
+        received = len(self.rtts)
+        if received == 0:
+            return None
+        sent = self.observed if partial else self.sent
+        packet_loss = 100.0 * (sent - received) / sent if sent else 0.0
+        mean = self.total / received
+        return PingResult(packet_loss=round(packet_loss, 3),
+                          minimum_latency=round(self.minimum, 3),
+                          average_latency=round(mean, 3),
+                          max_latency=round(self.maximum, 3),
+                          standard_deviation_latency=round(
+                              math.sqrt(max(0.0, self.total_squares / received - mean * mean)), 3),
+                          rtts=self.rtts, **summarize_samples(self, partial=partial))
+
+    def __len__(self):
+        return len(self.rtts)
+
+
+def percentile(sorted_values, fraction: float):
+    """
+    The percentile function interpolates a percentile from values that are already sorted.
+
+    :param sorted_values: A sorted sequence of numbers
+    :param fraction: float: The percentile as a fraction, e.g. 0.95
+    :return: The interpolated value
+    """
+    position = (len(sorted_values) - 1) * fraction
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def jitter(rtts):
+    """
+    The jitter function computes the RFC 3550 interarrival jitter estimate over consecutive round trip times.
+
+    :param rtts: The round trip times in arrival order
+    :return: The smoothed jitter, in the same unit as the round trip times
+    """
+    estimate = 0.0
+    if len(rtts) < 2:
+        return estimate
+    previous = rtts[0]
+    for current in islice(rtts, 1, None):
+        estimate += (abs(current - previous) - estimate) / JITTER_GAIN
+        previous = current
+    return estimate
+
+
+def max_loss_burst(received: bytearray):
+    """
+    The max_loss_burst function finds the longest run of consecutive lost packets.
+
+    :param received: bytearray: One byte per packet, non-zero when the packet was answered
+    :return: The length of the longest run of lost packets
+    """
+    longest = current = 0
+    for answered in received:
+        if answered:
+            current = 0
+        else:
+            current += 1
+            longest = max(longest, current)
+    return longest
+
+
+def summarize_samples(samples: RttSamples, partial: bool = False):
+    """
+    The summarize_samples function computes the distribution metrics of a ping run from its samples.
+
+    :param samples: RttSamples: The samples collected during the run
+    :param partial: bool: Only count losses among the packets accounted for so far
+    :return: A dictionary with the keys: (p50_latency, p95_latency, p99_latency, jitter, max_loss_burst), in
+        milliseconds and packets
+    """
+    received = samples.received[:samples.observed] if partial else samples.received
+    results = {"max_loss_burst": max_loss_burst(received)}
+    if len(samples) == 0:
+        return results
+    sorted_rtts = sorted(samples.rtts)
+    results.update({
+        "p50_latency": round(percentile(sorted_rtts, 0.50), 3),
+        "p95_latency": round(percentile(sorted_rtts, 0.95), 3),
+        "p99_latency": round(percentile(sorted_rtts, 0.99), 3),
+        "jitter": round(jitter(samples.rtts), 3)
+    })
+    return results
+
+
+def standard_deviation(rtts):
+    """
+    The standard_deviation function computes the population standard deviation the way ping reports it as `mdev`.
+
+    :param rtts: The round trip times
+    :return: The standard deviation, in the same unit as the round trip times
+    """
+    if len(rtts) == 0:
+        return 0.0
+    mean = sum(rtts) / len(rtts)
+    return math.sqrt(max(0.0, sum(rtt * rtt for rtt in rtts) / len(rtts) - mean * mean))
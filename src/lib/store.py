@@ -0,0 +1,383 @@
+import fnmatch
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+from lib.stats import percentile
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser("~"), ".network_health", "store")
+DEFAULT_RAW_RETENTION = 7 * 24 * 3600  # Seconds raw samples are kept; rollups cover anything older
+DEFAULT_MINUTE_RETENTION = 30 * 24 * 3600  # Seconds 1m rollups are kept; 1h rollups are kept forever
+DEFAULT_ROLLUP_INTERVAL = 60.0  # Seconds between background rollups
+
+RAW_SUFFIX = ".raw"
+STORE_LOCK_NAME = "store.lock"  # Held while writing, so processes sharing the store do not lose each other's records
+RESOLUTION_RAW = "raw"
+RESOLUTION_MINUTE = "1m"
+RESOLUTION_HOUR = "1h"
+RESOLUTIONS = [RESOLUTION_RAW, RESOLUTION_MINUTE, RESOLUTION_HOUR]
+BUCKET_SECONDS = {RESOLUTION_MINUTE: 60, RESOLUTION_HOUR: 3600}
+
+RAW_RECORD = struct.Struct("<qd")  # timestamp, value
+ROLLUP_RECORD = struct.Struct("<qqddd")  # bucket start, count, minimum, maximum, total
+
+
+def series_key(test_type: str, metric: str, target: str = None):
+    """
+    The series_key function names a stored series the way it is named in Datadog, with the target as a tag.
+
+    :param test_type: str: The test type, such as `ping_remote`
+    :param metric: str: The metric within the test, such as `average_latency`
+    :param target: str: The target, for tests run against many targets
+    :return: The key, e.g. `ping_remote.average_latency{target:8.8.8.8}`
+    """
+    key = f"{test_type}.{metric}"
+    if target is not None:
+        key += f"{{target:{target}}}"
+    return key
+
+
+class _Column:
+    """
+    A read-only view of one append-only file of fixed-width records. The file is memory-mapped, and a record torn by
+    a crash at the end of the file is ignored.
+    """
+
+    def __init__(self, path: str, record: struct.Struct):
+        self.record = record
+        self.mapping = None
+        self.count = 0
+        try:
+            with open(path, "rb") as column_file:
+                size = os.fstat(column_file.fileno()).st_size
+                self.count = size // record.size
+                if self.count > 0:
+                    self.mapping = mmap.mmap(column_file.fileno(), self.count * record.size, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int):
+        return self.record.unpack_from(self.mapping, index * self.record.size)
+
+    def timestamp(self, index: int):
+        return struct.unpack_from("<q", self.mapping, index * self.record.size)[0]
+
+    def bisect(self, timestamp: int):
+        """
+        The bisect method finds the first record at or after timestamp, relying on records being appended in time
+        order.
+
+        :param timestamp: int: Seconds since the epoch
+        :return: The index of the record
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, start: int = 0, end: int = None):
+        """
+        The records method reads the records between two indexes straight from the mapping.
+
+        :return: A generator of record tuples
+        """
+        end = self.count if end is None else end
+        if self.mapping is None or start >= end:
+            return iter(())
+        return self.record.iter_unpack(memoryview(self.mapping)[start * self.record.size:end * self.record.size])
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TimeSeriesStore:
+    """
+    A local store of every result, kept so incidents can be investigated without Datadog. Each series is an
+    append-only file of fixed-width (timestamp, value) records. Rollups downsample the raw samples into 1 minute and
+    1 hour buckets of count, minimum, maximum and total, and old raw samples are dropped once they are rolled up.
+    Queries read the files through mmap without loading or parsing them. Writers, in this process or others sharing
+    the directory, take turns through a lock file.
+    """
+
+    def __init__(self, directory: str = DEFAULT_STORE_DIR, raw_retention: float = DEFAULT_RAW_RETENTION,
+                 minute_retention: float = DEFAULT_MINUTE_RETENTION):
+        """
+        :param directory: str: Where the series files are kept
+        :param raw_retention: float: Seconds raw samples are kept
+        :param minute_retention: float: Seconds 1 minute rollups are kept
+        """
+        self.directory = directory
+        self.raw_retention = raw_retention
+        self.minute_retention = minute_retention
+        self.lock = threading.Lock()  # Guards writes to every file of the store
+        os.makedirs(self.directory, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """
+        The _locked function holds the store for writing, against the other threads of this process and against other
+        processes, such as overlapping cron runs, sharing the directory.
+        """
+        with self.lock, open(os.path.join(self.directory, STORE_LOCK_NAME), "ab") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def path(self, key: str, resolution: str = RESOLUTION_RAW):
+        suffix = RAW_SUFFIX if resolution == RESOLUTION_RAW else f".{resolution}"
+        return os.path.join(self.directory, quote(key, safe="") + suffix)
+
+    def keys(self, pattern: str = "*"):
+        """
+        The keys function lists the stored series.
+
+        :param pattern: str: A shell-style pattern the keys must match
+        :return: A sorted list of keys
+        """
+        keys = [unquote(name[:-len(RAW_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(RAW_SUFFIX)]
+        return sorted(key for key in keys if fnmatch.fnmatchcase(key, pattern))
+
+    def append(self, key: str, value: float, timestamp: int = None):
+        """
+        The append function stores one sample.
+
+        :param key: str: The series, see series_key
+        :param value: float: The sample
+        :param timestamp: int: Seconds since the epoch. Defaults to now
+        """
+        self.append_many([(key, value)], timestamp)
+
+    @staticmethod
+    def _append_record(path: str, value: float, timestamp: int):
+        with open(path, "a+b") as column_file:
+            size = column_file.seek(0, os.SEEK_END)
+            aligned = size - size % RAW_RECORD.size
+            if aligned != size:
+                column_file.truncate(aligned)  # Drop a record torn by a crash, so the records after it stay aligned
+            if aligned > 0:
+                column_file.seek(aligned - RAW_RECORD.size)
+                timestamp = max(timestamp, RAW_RECORD.unpack(column_file.read(RAW_RECORD.size))[0])
+            column_file.write(RAW_RECORD.pack(timestamp, float(value)))
+
+    def append_many(self, samples: list, timestamp: int = None):
+        """
+        The append_many function stores samples that were taken at the same time. Columns are kept in time order, which
+        queries and rollups rely on: a sample older than the last one of its series, such as one taken before the clock
+        was stepped back, is stored at the time of that last sample.
+
+        :param samples: list: (key, value) tuples
+        :param timestamp: int: Seconds since the epoch. Defaults to now, read once the store is held
+        """
+        with self._locked():
+            if timestamp is None:
+                timestamp = int(time.time())
+            for key, value in samples:
+                self._append_record(self.path(key), value, timestamp)
+
+    def record(self, data, test_type: str, target: str = None, timestamp: int = None):
+        """
+        The record function stores every metric of a test result.
+
+        :param data: The PingResult or IperfResult of the test
+        :param test_type: str: The test type, such as `ping_local`
+        :param target: str: The target, for tests run against many targets
+        :param timestamp: int: Seconds since the epoch. Defaults to now
+        """
+        self.append_many([(series_key(test_type, metric, target), value) for metric, value in data.items()
+                          if value is not None], timestamp)
+
+    def record_ping(self, data, local: bool = True):
+        self.record(data, "ping_local" if local else "ping_remote")
+
+    def record_ping_fleet(self, results_by_target: dict, local: bool = True):
+        timestamp = int(time.time())
+        for target, data in results_by_target.items():
+            self.record(data, "ping_local" if local else "ping_remote", target=target, timestamp=timestamp)
+
+    def record_bandwidth(self, data, local: bool = True, target: str = None):
+        self.record(data, "bandwidth_local" if local else "bandwidth_remote", target=target)
+
+    @staticmethod
+    def _roll(records, bucket_seconds: int, rollup: bool):
+        # Folds time ordered raw or rollup records into buckets of bucket_seconds
+        bucket = None
+        for record in records:
+            if rollup:
+                timestamp, count, minimum, maximum, total = record
+            else:
+                timestamp, value = record
+                count, minimum, maximum, total = 1, value, value, value
+            start = timestamp - timestamp % bucket_seconds
+            if bucket is not None and bucket[0] == start:
+                bucket[1] += count
+                bucket[2] = min(bucket[2], minimum)
+                bucket[3] = max(bucket[3], maximum)
+                bucket[4] += total
+            else:
+                if bucket is not None:
+                    yield bucket
+                bucket = [start, count, minimum, maximum, total]
+        if bucket is not None:
+            yield bucket
+
+    def _rollup_series(self, key: str, resolution: str, source: str, now: int):
+        bucket_seconds = BUCKET_SECONDS[resolution]
+        with _Column(self.path(key, resolution), ROLLUP_RECORD) as rollups:
+            done = rollups.timestamp(len(rollups) - 1) + bucket_seconds if len(rollups) > 0 else 0
+        record = RAW_RECORD if source == RESOLUTION_RAW else ROLLUP_RECORD
+        complete = now - now % bucket_seconds  # Only buckets that can not receive more samples are written
+        with _Column(self.path(key, source), record) as column:
+            first, last = column.bisect(done), column.bisect(complete)
+            buckets = list(self._roll(column.records(first, last), bucket_seconds, source != RESOLUTION_RAW))
+        if buckets:
+            with open(self.path(key, resolution), "ab") as rollup_file:
+                rollup_file.write(b"".join(ROLLUP_RECORD.pack(*bucket) for bucket in buckets))
+        return len(buckets)
+
+    def _expire(self, path: str, record: struct.Struct, cutoff: int):
+        # Rewrites a column without the records older than cutoff. The caller holds the store, so no other process can
+        # append to the column between the read and the replace
+        with _Column(path, record) as column:
+            first = column.bisect(cutoff)
+            if first == 0:
+                return 0
+            kept = bytes(column.mapping[first * record.size:]) if first < len(column) else b""
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as column_file:
+            column_file.write(kept)
+        os.replace(temporary_path, path)
+        return first
+
+    def rollup(self, now: int = None):
+        """
+        The rollup function downsamples the samples stored since the last rollup into 1 minute and 1 hour buckets,
+        then drops raw samples and 1 minute buckets past their retention. It only reads what is new, so it is cheap to
+        call often.
+
+        :param now: int: Seconds since the epoch. Defaults to now
+        :return: The number of buckets written
+        """
+        now = int(time.time()) if now is None else now
+        written = 0
+        with self._locked():
+            for key in self.keys():
+                written += self._rollup_series(key, RESOLUTION_MINUTE, RESOLUTION_RAW, now)
+                written += self._rollup_series(key, RESOLUTION_HOUR, RESOLUTION_MINUTE, now)
+                # Samples are only expired once the rollups covering them have been written
+                self._expire(self.path(key), RAW_RECORD, min(now - self.raw_retention, now - now % 60))
+                self._expire(self.path(key, RESOLUTION_MINUTE), ROLLUP_RECORD,
+                             min(now - self.minute_retention, now - now % 3600))
+        if written > 0:
+            logger.debug(f"Wrote {written} rollup bucket(s)")
+        return written
+
+    def query(self, key: str, start: int = None, end: int = None, resolution: str = RESOLUTION_RAW):
+        """
+        The query function summarizes one series over a time range.
+
+        :param key: str: The series, see series_key
+        :param start: int: Seconds since the epoch of the start of the range. Defaults to the first sample
+        :param end: int: Seconds since the epoch of the end of the range, exclusive. Defaults to now
+        :param resolution: str: Read raw samples, or the 1m or 1h rollups. Rollups reach further back than raw
+            samples but have no percentiles
+        :return: A dictionary with the keys: (count, minimum, average, maximum, p50, p95, p99), or None if there are
+            no samples in the range
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        start = 0 if start is None else start
+        end = int(time.time()) + 1 if end is None else end
+        if resolution == RESOLUTION_RAW:
+            with _Column(self.path(key), RAW_RECORD) as column:
+                values = sorted(value for _, value in column.records(column.bisect(start), column.bisect(end)))
+            if not values:
+                return None
+            return {
+                "count": len(values),
+                "minimum": values[0],
+                "average": sum(values) / len(values),
+                "maximum": values[-1],
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99)
+            }
+        bucket_seconds = BUCKET_SECONDS[resolution]
+        with _Column(self.path(key, resolution), ROLLUP_RECORD) as column:
+            # Buckets that start inside the range are counted whole
+            buckets = list(column.records(column.bisect(start - start % bucket_seconds), column.bisect(end)))
+        if not buckets:
+            return None
+        count = sum(bucket[1] for bucket in buckets)
+        return {
+            "count": count,
+            "minimum": min(bucket[2] for bucket in buckets),
+            "average": sum(bucket[4] for bucket in buckets) / count,
+            "maximum": max(bucket[3] for bucket in buckets),
+            "p50": None,
+            "p95": None,
+            "p99": None
+        }
+
+
+def parse_time(text: str, now: float = None):
+    """
+    The parse_time function reads a point in time given on the command line.
+
+    :param text: str: Seconds since the epoch, a time ago such as `90s`, `15m`, `6h` or `2d` (optionally written with
+        a leading `-`), or an ISO 8601 date and time
+    :param now: float: Seconds since the epoch that relative times count back from. Defaults to now
+    :return: Seconds since the epoch
+    """
+    now = time.time() if now is None else now
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text[-1:] in units:
+        try:
+            return int(now - abs(float(text[:-1])) * units[text[-1]])
+        except ValueError:
+            pass
+    try:
+        return int(float(text))
+    except ValueError:
+        pass
+    try:
+        return int(datetime.fromisoformat(text).timestamp())
+    except ValueError:
+        raise ValueError(f"Unable to read time: {text}")
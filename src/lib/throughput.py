@@ -0,0 +1,185 @@
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from lib.dns import address_or_name
+from lib.iperf import IperfExecutionFailed, IperfInterval
+from lib.results import IperfResult
+from lib.tracing import traced
+
+logger = logging.getLogger("network_health")
+
+DEFAULT_PORT = 5301
+DEFAULT_DURATION = 10.0
+DEFAULT_STREAMS = 1
+DEFAULT_REPORT_INTERVAL = 1.0
+DEFAULT_BUFFER_SIZE = 128 * 1024
+CONNECT_TIMEOUT = 5.0
+RESULT_TIMEOUT = 5.0  # Seconds to wait for the server to report how much it received
+JOIN_GRACE = 1.0  # Seconds on top of RESULT_TIMEOUT a stream may take to finish before it is abandoned
+
+MEGABYTE = 1024 * 1024  # iperf's `-f M` unit
+RECEIVED_REPORT = struct.Struct("!Q")  # Sent by the server once a stream ends: the number of bytes it received
+
+
+class _Stream:
+    """One TCP connection of a throughput test."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sent = 0
+        self.received = None  # As reported by the server
+        self.error = None
+
+
+def _send_stream(stream: _Stream, buffer: memoryview, deadline: float, sendfile_file=None):
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # A send never blocks past the deadline, even when the server stops reading and the window stays full
+            stream.sock.settimeout(remaining)
+            try:
+                if sendfile_file is not None:
+                    stream.sent += stream.sock.sendfile(sendfile_file, 0, len(buffer))
+                else:
+                    stream.sent += stream.sock.send(buffer)
+            except socket.timeout:
+                break
+        stream.sock.shutdown(socket.SHUT_WR)
+        stream.sock.settimeout(RESULT_TIMEOUT)
+        report = bytearray(RECEIVED_REPORT.size)
+        view = memoryview(report)
+        read = 0
+        while read < len(report):
+            count = stream.sock.recv_into(view[read:])
+            if count == 0:
+                break
+            read += count
+        if read == len(report):
+            stream.received = RECEIVED_REPORT.unpack(report)[0]
+    except OSError as e:
+        stream.error = e
+    finally:
+        stream.sock.close()
+
+
+def _finish_streams(connections: list, threads: list):
+    """
+    The _finish_streams function waits for every stream to collect the server's report once the sending is over. A
+    stream still running after RESULT_TIMEOUT and JOIN_GRACE seconds is shut down and counted as failed, so a server
+    that stalls can not hold up the test.
+
+    :param connections: list: The _Stream objects
+    :param threads: list: The thread sending each stream
+    """
+    join_deadline = time.monotonic() + RESULT_TIMEOUT + JOIN_GRACE
+    for stream, thread in zip(connections, threads):
+        thread.join(max(0.0, join_deadline - time.monotonic()))
+        if thread.is_alive():
+            logger.error(f"Throughput stream {thread.name} did not finish, abandoning it")
+            stream.error = TimeoutError(f"{thread.name} did not finish within {RESULT_TIMEOUT + JOIN_GRACE} seconds")
+            try:
+                stream.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+@traced("throughput.run")
+def run_throughput(target: str, port: int = None, duration: float = DEFAULT_DURATION, streams: int = DEFAULT_STREAMS,
+                   report_interval: float = DEFAULT_REPORT_INTERVAL, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                   use_sendfile: bool = False):
+    """
+    The run_throughput function measures bandwidth to a server started with `network_health.py serve`, without
+    needing iperf installed. Data is sent over one or more parallel TCP streams from a single preallocated
+    buffer, optionally with os.sendfile so it never passes through Python.
+
+    :param target: str: Specify the target ip address
+    :param port: int: Specify the port of the throughput server
+    :param duration: float: Seconds to send data for
+    :param streams: int: Number of parallel TCP connections
+    :param report_interval: float: Seconds between interval samples
+    :param buffer_size: int: Bytes handed to the kernel per send call
+    :param use_sendfile: bool: Send with os.sendfile from a file of zeros instead of socket.send
+    :return: An IperfResult with the metrics: (transfer_value, bandwidth_value, interval_value). Its intervals hold
+        one IperfInterval per report_interval
+    """
+    port = int(port) if port is not None else DEFAULT_PORT
+    logger.info(f"Starting native throughput test with target: {target}:{port}, {streams} stream(s) for {duration} "
+                f"seconds...")
+    buffer = memoryview(bytearray(buffer_size))
+    sendfile_file = None
+    if use_sendfile:
+        if not hasattr(os, "sendfile"):
+            logger.info("os.sendfile is not available on this platform, using socket.send")
+        else:
+            sendfile_file = tempfile.TemporaryFile()
+            sendfile_file.truncate(buffer_size)
+
+    address = address_or_name(target)
+    connections = []
+    try:
+        for _ in range(streams):
+            sock = socket.create_connection((address, port), timeout=CONNECT_TIMEOUT)
+            connections.append(_Stream(sock))
+    except OSError as e:
+        for stream in connections:
+            stream.sock.close()
+        if sendfile_file is not None:
+            sendfile_file.close()
+        logger.error(f"Failed to connect to throughput server: {target}:{port}: {e!r}")
+        raise IperfExecutionFailed(f"Failed to connect to {target}:{port}: {e}")
+
+    start = time.monotonic()
+    deadline = start + duration
+    threads = [threading.Thread(target=_send_stream, args=(stream, buffer, deadline, sendfile_file),
+                                name=f"throughput-stream-{index}", daemon=True)
+               for index, stream in enumerate(connections)]
+    for thread in threads:
+        thread.start()
+
+    intervals = []
+    last_time, last_sent = start, 0
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(max(0.0, min(last_time + report_interval, deadline) - time.monotonic()))
+        now = time.monotonic()
+        if now >= last_time + report_interval or now >= deadline:
+            sent = sum(stream.sent for stream in connections)
+            transfer = (sent - last_sent) / MEGABYTE
+            elapsed = now - last_time
+            intervals.append(IperfInterval(round(last_time - start, 2), round(now - start, 2), transfer,
+                                           transfer / elapsed if elapsed else 0.0))
+            logger.debug(f"Interval: {intervals[-1]}")
+            last_time, last_sent = now, sent
+            if now >= deadline:
+                _finish_streams(connections, threads)
+                break
+    elapsed = time.monotonic() - start
+    if sendfile_file is not None:
+        sendfile_file.close()
+
+    errors = [stream.error for stream in connections if stream.error is not None]
+    if len(errors) == len(connections):
+        logger.error(f"Every throughput stream to {target}:{port} failed: {errors[0]!r}")
+        raise IperfExecutionFailed(f"Throughput test to {target}:{port} failed: {errors[0]}")
+    # Prefer what the server says it received over what we handed to the kernel
+    transferred = sum(stream.received if stream.received is not None else stream.sent for stream in connections)
+    transfer = transferred / MEGABYTE
+
+    results = IperfResult(transfer_value=round(transfer, 3), bandwidth_value=round(transfer / elapsed, 3),
+                          interval_value=round(elapsed, 3), intervals=intervals)
+
+    logger.info("Results:")
+    for metric, value in results.items():
+        unit = "megabyte(s)"
+        if metric == "interval_value":
+            unit = "second(s)"
+        logger.info(f"{metric}: {value} {unit}")
+    return results
+
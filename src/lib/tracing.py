@@ -0,0 +1,224 @@
+import cProfile
+import functools
+import logging
+import pstats
+import sys
+import threading
+from contextlib import contextmanager
+from time import perf_counter_ns
+
+logger = logging.getLogger("network_health")
+
+KIND_DURATION = "duration"  # Nanoseconds spent in a stage, reported in milliseconds
+KIND_COUNTER = "counter"  # Events such as retries, reported as the number since the last report
+KIND_SIZE = "size"  # Observed sizes such as payload bytes
+
+METRIC_PREFIX = "self"  # Stats are reported as network_health.self.$NAME.$STAT
+
+
+class _Stat:
+    """Running count, total and maximum of one stage, counter or size since the last drain."""
+
+    __slots__ = ("kind", "unit", "count", "total", "maximum")
+
+    def __init__(self, kind: str, unit: str = None):
+        self.kind = kind
+        self.unit = unit
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+
+class Tracer:
+    """
+    Collects how long each stage of a run takes, how often events such as retries happen and how large payloads are.
+    Recording is one perf_counter_ns call on each side of a stage and a few additions under a lock, so it is cheap
+    enough to leave on all the time. The collected stats are drained once per cycle and reported as metrics.
+    """
+
+    def __init__(self, clock=perf_counter_ns):
+        """
+        :param clock: Returns the current time in nanoseconds
+        """
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _add(self, name: str, kind: str, value, unit: str = None):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = _Stat(kind, unit)
+            stat.add(value)
+
+    def record(self, name: str, elapsed_ns: int):
+        """
+        The record function adds the duration of one run of a stage.
+
+        :param name: str: The stage, such as `ping.run`
+        :param elapsed_ns: int: The nanoseconds the stage took
+        """
+        self._add(name, KIND_DURATION, elapsed_ns, "millisecond")
+
+    def count(self, name: str, value: int = 1):
+        """
+        The count function adds to a counter, such as `datadog.retries`.
+
+        :param name: str: The counter
+        :param value: int: The number of events
+        """
+        self._add(name, KIND_COUNTER, value)
+
+    def observe(self, name: str, value, unit: str = "byte"):
+        """
+        The observe function adds one observed size, such as the bytes of a request body.
+
+        :param name: str: What was observed
+        :param value: The size
+        :param unit: str: The Datadog unit of the size
+        """
+        self._add(name, KIND_SIZE, value, unit)
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        The span function times the body of a with statement as one run of a stage. Time spent in a body that raises
+        is recorded too.
+
+        :param name: str: The stage
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - start)
+
+    def traced(self, name: str):
+        """
+        The traced function is a decorator that times every call of the decorated function as one run of a stage.
+
+        :param name: str: The stage
+        :return: The decorator
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = self.clock()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, self.clock() - start)
+            return wrapper
+        return decorator
+
+    def drain(self):
+        """
+        The drain function takes every stat collected since the last drain.
+
+        :return: A dictionary of name to _Stat
+        """
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+
+def snapshot_metrics(stats: dict):
+    """
+    The snapshot_metrics function turns drained stats into metric values. Stages report their count and their average
+    and maximum duration in milliseconds, counters their total, and sizes their count, average, maximum and total.
+
+    :param stats: dict: Stats from Tracer.drain
+    :return: A dictionary of metric name, such as `self.ping.run.avg`, to a tuple of value, unit and kind
+    """
+    metrics = {}
+    for name, stat in sorted(stats.items()):
+        base = f"{METRIC_PREFIX}.{name}"
+        if stat.kind == KIND_COUNTER:
+            metrics[base] = (stat.total, stat.unit, stat.kind)
+            continue
+        scale = 1e6 if stat.kind == KIND_DURATION else 1
+        metrics[f"{base}.count"] = (stat.count, None, KIND_COUNTER)
+        metrics[f"{base}.avg"] = (stat.total / stat.count / scale, stat.unit, stat.kind)
+        metrics[f"{base}.max"] = (stat.maximum / scale, stat.unit, stat.kind)
+        if stat.kind == KIND_SIZE:
+            metrics[f"{base}.total"] = (stat.total, stat.unit, stat.kind)
+    return metrics
+
+
+def log_stats(stats: dict):
+    """The log_stats function logs one line per stage with its count, average and maximum duration."""
+    for name, stat in sorted(stats.items()):
+        if stat.kind == KIND_DURATION:
+            logger.info(f"Timing {name}: {stat.count} run(s), avg {stat.total / stat.count / 1e6:.3f}ms, "
+                        f"max {stat.maximum / 1e6:.3f}ms")
+        elif stat.kind == KIND_COUNTER:
+            logger.info(f"Count {name}: {stat.total}")
+        else:
+            logger.info(f"Size {name}: {stat.count} observed, avg {stat.total / stat.count:.0f}, max {stat.maximum} "
+                        f"{stat.unit}(s)")
+
+
+# Before 3.12 a cProfile profiler only sees the thread it was enabled on. From 3.12 it is built on sys.monitoring, which
+# sees every thread and allows a single active profiler
+PER_THREAD_PROFILERS = sys.version_info < (3, 12)
+
+
+class Profiler:
+    """
+    Runs cProfile over the main thread and every thread started while it is running, such as the test workers and the
+    background sender, and writes their combined stats to one file that `python -m pstats` or snakeviz can read. Before
+    Python 3.12 every new thread gets its own profiler; from 3.12 one profiler covers them all.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: str: The file the stats are written to
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    def _profile_thread(self, frame, event, arg):
+        # Installed as the profile hook of every new thread, it is replaced on its first call by the thread's own
+        # profiler
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiler is already active, so this thread is left unprofiled rather than failing
+            sys.setprofile(None)
+            logger.debug(f"Not profiling thread {threading.current_thread().name}: {e}")
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        if PER_THREAD_PROFILERS:
+            threading.setprofile(self._profile_thread)
+        profile.enable()
+        logger.info(f"Profiling, stats will be written to {self.path}")
+
+    def stop(self):
+        """The stop function stops profiling and writes the combined stats."""
+        self.profiles[0].disable()
+        if PER_THREAD_PROFILERS:
+            threading.setprofile(None)
+            sys.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(self.path)
+        logger.info(f"Wrote profile of {len(profiles)} thread(s) to {self.path}")
+
+
+tracer = Tracer()  # Shared by every module, drained once per cycle
+span = tracer.span
+traced = tracer.traced
@@ -1,7 +1,14 @@
 import argparse
+import atexit
+import functools
+import json
 import os
+import signal
+import sys
+import threading
 from lib.logger import generate_logger
-from lib import datadog, iperf, ping
+from lib import (adaptive, datadog, dns, fleet, iperf, path, ping, plan, prober, prometheus, reflector, runner,
+                 scheduler, sender, sink, spool, store, throughput, tracing)
 from sys import exit
 
 logger = generate_logger("network_health")
@@ -14,6 +21,12 @@ You must have $DATADOG_API_KEY set as an environment variable to authenticate wi
 `export DATADOG_API_KEY=$API_KEY`
 
 Specify `-h` to see available tests
+
+To act as the target of other agents' native ping and throughput tests instead, run:
+`network_health.py serve`
+
+To summarize the results kept with `--local-store`, run:
+`network_health.py query METRIC`
 """
 
 
@@ -25,15 +38,52 @@ def parse_opts():
     parser.add_argument("--remote-iperf-host", dest="remote_iperf_host", required=False, default=None,
                         help="Specify a remote host address to run an iperf test against. If not specified, the test "
                              "will not run.")
-    parser.add_argument("--ping-host", dest="ping_host", required=False, default=None,
-                        help="Specify a local host address to run a ping test against. If not specified, the test will "
-                             "not run.")
+    parser.add_argument("--ping-host", dest="ping_host", required=False, default=None, action="append",
+                        help="Specify a local host address to run a ping test against. Can be repeated to ping many "
+                             "hosts. If not specified, the test will not run.")
     parser.add_argument("--remote-ping-host", dest="remote_ping_host", required=False, default=None,
-                        help="Specify a remote host address to run a ping test against. If not specified, the test "
-                             "will not run.")
-    parser.add_argument("-n", "--number-of-packets", dest="number_of_packets", required=False, default=100,
+                        action="append",
+                        help="Specify a remote host address to run a ping test against. Can be repeated to ping many "
+                             "hosts. If not specified, the test will not run.")
+    parser.add_argument("--ping-targets-file", dest="ping_targets_file", default=None,
+                        help="Specify a file with one local host address per line to run ping tests against.")
+    parser.add_argument("--remote-ping-targets-file", dest="remote_ping_targets_file", default=None,
+                        help="Specify a file with one remote host address per line to run ping tests against.")
+    parser.add_argument("--max-ping-workers", dest="max_ping_workers", type=int, default=fleet.DEFAULT_MAX_WORKERS,
+                        help="Specify the maximum number of ping tests running at the same time when pinging many "
+                             "hosts. Not used with --native-ping, which probes every host from one thread. "
+                             f"Default = {fleet.DEFAULT_MAX_WORKERS}")
+    parser.add_argument("--ping-timeout", dest="ping_timeout", type=float, default=None,
+                        help="Specify the number of seconds to wait for each ping test. With --native-ping, the "
+                             "probing is cut short after this many seconds and partial results are reported. "
+                             "Default = one second per packet plus 10 seconds")
+    parser.add_argument("--path-host", dest="path_host", default=None, action="append",
+                        help="Specify a host to trace the path to, measuring the loss and latency of every hop. Can "
+                             "be repeated to trace many paths. If not specified, the test will not run.")
+    parser.add_argument("--path-rounds", dest="path_rounds", type=int, default=path.DEFAULT_ROUNDS,
+                        help="Specify the number of probes sent to every hop of a path, one second apart. "
+                             f"Default = {path.DEFAULT_ROUNDS}")
+    parser.add_argument("--path-max-ttl", dest="path_max_ttl", type=int, default=path.DEFAULT_MAX_TTL,
+                        help=f"Specify the most hops a path is traced for. Default = {path.DEFAULT_MAX_TTL}")
+    parser.add_argument("--path-cache-ttl", dest="path_cache_ttl", type=float, default=path.DEFAULT_CACHE_TTL,
+                        help="Specify the number of seconds a discovered path is reused before it is discovered "
+                             f"again. Default = {path.DEFAULT_CACHE_TTL}")
+    parser.add_argument("--dns-cache-ttl", dest="dns_cache_ttl", type=float, default=dns.DEFAULT_CACHE_TTL,
+                        help="Specify the number of seconds a resolved target address is reused before the target is "
+                             f"resolved again. 0 resolves it in every test. Default = {dns.DEFAULT_CACHE_TTL}")
+    parser.add_argument("--test-plan", dest="test_plan", default=None,
+                        help="Specify a JSON, TOML or YAML test plan listing targets with their own settings, run "
+                             "alongside any hosts given on the command line. Reloaded on SIGHUP in daemon mode.")
+    parser.add_argument("-n", "--number-of-packets", dest="number_of_packets", type=int, required=False, default=100,
                         help="Specify a number of packets to use for the ping tests. This value is the same for both "
                              "local and remote ping tests. Default = 100 packets")
+    parser.add_argument("--native-ping", dest="native_ping", default=False, action="store_true",
+                        help="Specify this argument to send the ping probes from this process instead of running the "
+                             "system `ping` command. Uses ICMP sockets when permitted, UDP probes otherwise. "
+                             "Default = False")
+    parser.add_argument("--native-ping-port", dest="native_ping_port", type=int, default=None,
+                        help="Specify the port of a `network_health.py serve` reflector on the ping targets to send "
+                             "UDP probes to, instead of ICMP. Implies --native-ping. Default = None")
     parser.add_argument("-dd", "--disable-datadog-submit", default=False, dest="disable_datadog_submit",
                         action="store_true", help="Specify this argument to bypass submitting the results to Datadog."
                                                   " Default = False")
@@ -41,59 +91,621 @@ def parse_opts():
                         help="Specify the port to use for the local iperf test. Default = None")
     parser.add_argument("--remote-iperf-port", dest="remote_iperf_port", default=None,
                        help="Specify the port to use for the remote iperf test. Default = None")
+    parser.add_argument("--native-iperf", dest="native_iperf", default=False, action="store_true",
+                        help="Specify this argument to measure bandwidth with the built-in throughput test instead of "
+                             "iperf. The target must run `network_health.py serve`. Default = False")
+    parser.add_argument("--iperf-streams", dest="iperf_streams", type=int, default=throughput.DEFAULT_STREAMS,
+                        help="Specify the number of parallel streams for the built-in throughput test. "
+                             f"Default = {throughput.DEFAULT_STREAMS}")
+    parser.add_argument("--iperf-duration", dest="iperf_duration", type=float, default=throughput.DEFAULT_DURATION,
+                        help="Specify the number of seconds the built-in throughput test runs for. "
+                             f"Default = {throughput.DEFAULT_DURATION}")
+    parser.add_argument("--iperf-sendfile", dest="iperf_sendfile", default=False, action="store_true",
+                        help="Specify this argument to send the built-in throughput test's data with os.sendfile, so "
+                             "it is never copied through Python. Default = False")
+    parser.add_argument("--max-bandwidth-concurrency", dest="max_bandwidth_concurrency", type=int, default=1,
+                        help="Specify how many iperf tests may run at the same time. Ping tests always run in "
+                             "parallel, iperf tests run after them so they do not skew each other. Default = 1")
+    parser.add_argument("--compression", dest="compression", default=None, choices=datadog.COMPRESSION_TYPES,
+                        help="Specify a compression to use for the requests sent to Datadog. Default = None")
+    parser.add_argument("--spool-dir", dest="spool_dir", default=spool.DEFAULT_SPOOL_DIR,
+                        help="Specify the directory where results are kept until Datadog accepts them. "
+                             f"Default = {spool.DEFAULT_SPOOL_DIR}")
+    parser.add_argument("--spool-max-bytes", dest="spool_max_bytes", type=int,
+                        default=spool.DEFAULT_MAX_TOTAL_BYTES,
+                        help="Specify the size the spool may grow to before the oldest results are dropped. "
+                             f"Default = {spool.DEFAULT_MAX_TOTAL_BYTES}")
+    parser.add_argument("--spool-max-age", dest="spool_max_age", type=float, default=spool.DEFAULT_MAX_AGE_SECONDS,
+                        help="Specify the number of seconds results are kept in the spool before they are dropped. "
+                             f"Default = {spool.DEFAULT_MAX_AGE_SECONDS}")
+    parser.add_argument("--disable-spool", dest="disable_spool", default=False, action="store_true",
+                        help="Specify this argument to send results to Datadog without keeping them on disk first. "
+                             "Results that fail to send are lost. Default = False")
+    parser.add_argument("--submit-queue-size", dest="submit_queue_size", type=int,
+                        default=sender.DEFAULT_MAX_QUEUE_SIZE,
+                        help="Specify the number of result batches that may wait to be sent to Datadog in the "
+                             f"background. Default = {sender.DEFAULT_MAX_QUEUE_SIZE}")
+    parser.add_argument("--submit-backpressure", dest="submit_backpressure", default=sender.POLICY_DROP_OLDEST,
+                        choices=sender.BACKPRESSURE_POLICIES,
+                        help="Specify what happens when the background queue is full: drop the oldest batch, block "
+                             "the tests until there is room, or spill the batch to the spool. "
+                             f"Default = {sender.POLICY_DROP_OLDEST}")
+    parser.add_argument("--shutdown-timeout", dest="shutdown_timeout", type=float,
+                        default=sender.DEFAULT_SHUTDOWN_TIMEOUT,
+                        help="Specify the number of seconds to wait for queued results to be sent before exiting. "
+                             f"Default = {sender.DEFAULT_SHUTDOWN_TIMEOUT}")
+    parser.add_argument("--disable-self-metrics", dest="disable_self_metrics", default=False, action="store_true",
+                        help="Specify this argument to stop submitting the network_health.self.* metrics that time "
+                             "each stage of a run. Timings are still logged. Default = False")
+    parser.add_argument("--profile", dest="profile", default=None,
+                        help="Specify a file to write cProfile stats of the whole run to, for `python -m pstats`. "
+                             "Default = None")
+    parser.add_argument("--local-store", dest="local_store", default=False, action="store_true",
+                        help="Specify this argument to also keep every result in a local time-series store, to be "
+                             "read with `network_health.py query`. Default = False")
+    parser.add_argument("--store-dir", dest="store_dir", default=store.DEFAULT_STORE_DIR,
+                        help=f"Specify the directory of the local time-series store. "
+                             f"Default = {store.DEFAULT_STORE_DIR}")
+    parser.add_argument("--store-raw-retention", dest="store_raw_retention", type=float,
+                        default=store.DEFAULT_RAW_RETENTION,
+                        help="Specify the number of seconds raw results are kept in the local store before only "
+                             f"their 1m and 1h rollups remain. Default = {store.DEFAULT_RAW_RETENTION}")
+    parser.add_argument("--prometheus-port", dest="prometheus_port", type=int, default=None,
+                        help=f"Specify a port, such as {prometheus.DEFAULT_PORT}, to serve the latest results on at "
+                             "`/metrics` for Prometheus to scrape. Meant for daemon mode. Default = None")
+    parser.add_argument("--prometheus-host", dest="prometheus_host", default="0.0.0.0",
+                        help="Specify the address the Prometheus exporter listens on. Default = 0.0.0.0")
+    parser.add_argument("--adaptive", dest="adaptive", default=False, action="store_true",
+                        help="Specify this argument to send each ping target a short heartbeat instead of a full ping, "
+                             "and only run full pings and iperf tests while a target's loss or latency looks wrong. "
+                             "Default = False")
+    parser.add_argument("--heartbeat-packets", dest="heartbeat_packets", type=int,
+                        default=adaptive.DEFAULT_HEARTBEAT_PACKETS,
+                        help="Specify the number of packets of each adaptive heartbeat. "
+                             f"Default = {adaptive.DEFAULT_HEARTBEAT_PACKETS}")
+    parser.add_argument("--escalate-loss", dest="escalate_loss", type=float, default=adaptive.DEFAULT_LOSS_THRESHOLD,
+                        help="Specify the packet loss, in percent, at which an adaptive target is escalated to full "
+                             f"tests. Default = {adaptive.DEFAULT_LOSS_THRESHOLD}")
+    parser.add_argument("--escalate-latency", dest="escalate_latency", type=float, default=None,
+                        help="Specify the average latency, in milliseconds, at which an adaptive target is escalated "
+                             "to full tests. Default = None")
+    parser.add_argument("--escalate-change", dest="escalate_change", type=float, default=adaptive.DEFAULT_CHANGE_RATIO,
+                        help="Specify how far, as a fraction of its baseline, an adaptive target's latency may move "
+                             f"before it is escalated to full tests. Default = {adaptive.DEFAULT_CHANGE_RATIO}")
+    parser.add_argument("--calm-runs", dest="calm_runs", type=int, default=adaptive.DEFAULT_CALM_RUNS,
+                        help="Specify the number of healthy full runs in a row before an escalated adaptive target "
+                             f"backs off to heartbeats. Default = {adaptive.DEFAULT_CALM_RUNS}")
+    parser.add_argument("--daemon", dest="daemon", default=False, action="store_true",
+                        help="Specify this argument to keep running and repeat the tests on a schedule instead of "
+                             "running them once. Default = False")
+    parser.add_argument("--ping-interval", dest="ping_interval", type=float, default=60,
+                        help="Specify the number of seconds between ping tests in daemon mode. Default = 60")
+    parser.add_argument("--iperf-interval", dest="iperf_interval", type=float, default=300,
+                        help="Specify the number of seconds between iperf tests in daemon mode. Default = 300")
+    parser.add_argument("--schedule-jitter", dest="schedule_jitter", type=float, default=5,
+                        help="Specify the maximum number of seconds randomly added to each scheduled test in daemon "
+                             "mode, so many hosts do not test at the same moment. Default = 5")
 
     return parser.parse_args()
 
 
+def parse_serve_opts(argv: list):
+    parser = argparse.ArgumentParser(prog="network_health.py serve",
+                                     description="Answer UDP echo probes and receive throughput streams from other "
+                                                 "agents' native ping and bandwidth tests.")
+    parser.add_argument("--host", dest="host", default="0.0.0.0",
+                        help="Specify the address to listen on. Default = 0.0.0.0")
+    parser.add_argument("--port", dest="port", type=int, default=throughput.DEFAULT_PORT,
+                        help="Specify the UDP and TCP port to listen on. "
+                             f"Default = {throughput.DEFAULT_PORT}")
+    parser.add_argument("--max-connections", dest="max_connections", type=int,
+                        default=reflector.DEFAULT_MAX_CONNECTIONS,
+                        help="Specify the number of throughput streams served at the same time. Further streams are "
+                             f"rejected. Default = {reflector.DEFAULT_MAX_CONNECTIONS}")
+    parser.add_argument("--buffer-size", dest="buffer_size", type=int, default=throughput.DEFAULT_BUFFER_SIZE,
+                        help="Specify the number of bytes read at a time from each throughput stream. "
+                             f"Default = {throughput.DEFAULT_BUFFER_SIZE}")
+    parser.add_argument("--socket-buffer", dest="socket_buffer", type=int, default=None,
+                        help="Specify the kernel receive buffer size (SO_RCVBUF) of each throughput stream. "
+                             "Default = chosen by the OS")
+    parser.add_argument("--stats-interval", dest="stats_interval", type=float,
+                        default=reflector.DEFAULT_STATS_INTERVAL,
+                        help="Specify the number of seconds between per-client stats reports. "
+                             f"Default = {reflector.DEFAULT_STATS_INTERVAL}")
+    parser.add_argument("--stats-file", dest="stats_file", default=None,
+                        help="Specify a file to write the per-client stats to as JSON on every report. Default = None")
+    return parser.parse_args(argv)
+
+
+def run_server(args):
+    """
+    The run_server function runs the reflector until SIGINT or SIGTERM.
+
+    :param args: The parsed `serve` arguments
+    """
+    server = reflector.ReflectorServer(host=args.host, port=args.port, max_connections=args.max_connections,
+                                       buffer_size=args.buffer_size, socket_buffer=args.socket_buffer,
+                                       stats_interval=args.stats_interval, stats_file=args.stats_file)
+
+    def handle_stop_signal(signum, frame):
+        logger.info(f"Received signal {signum}, stopping...")
+        server.stop()
+
+    signal.signal(signal.SIGINT, handle_stop_signal)
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    server.run()
+
+
+def parse_query_opts(argv: list):
+    parser = argparse.ArgumentParser(prog="network_health.py query",
+                                     description="Summarize the results kept in the local time-series store.")
+    parser.add_argument("metric", nargs="?", default="*",
+                        help="Specify the metric to summarize, e.g. `ping_remote.average_latency`. Shell-style "
+                             "wildcards select many metrics. Default = every metric")
+    parser.add_argument("--start", dest="start", default="1h",
+                        help="Specify the start of the time range: seconds since the epoch, an ISO 8601 time, or a "
+                             "time ago such as 15m, 6h or 2d. Default = 1h")
+    parser.add_argument("--end", dest="end", default=None,
+                        help="Specify the end of the time range, in the same formats as --start. Default = now")
+    parser.add_argument("--resolution", dest="resolution", default=store.RESOLUTION_RAW, choices=store.RESOLUTIONS,
+                        help="Specify whether to read the raw results, or the 1m or 1h rollups which reach further "
+                             f"back but have no percentiles. Default = {store.RESOLUTION_RAW}")
+    parser.add_argument("--store-dir", dest="store_dir", default=store.DEFAULT_STORE_DIR,
+                        help=f"Specify the directory of the local time-series store. "
+                             f"Default = {store.DEFAULT_STORE_DIR}")
+    parser.add_argument("--json", dest="json", default=False, action="store_true",
+                        help="Specify this argument to print the summaries as JSON. Default = False")
+    return parser.parse_args(argv)
+
+
+def run_query(args):
+    """
+    The run_query function prints the summary of every stored metric matching the query.
+
+    :param args: The parsed `query` arguments
+    :return: The number of metrics with results in the time range
+    """
+    local_store = store.TimeSeriesStore(args.store_dir)
+    start = store.parse_time(args.start)
+    end = store.parse_time(args.end) if args.end is not None else None
+    summaries = {}
+    for key in local_store.keys(args.metric):
+        summary = local_store.query(key, start, end, resolution=args.resolution)
+        if summary is not None:
+            summaries[key] = summary
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+    else:
+        for key, summary in summaries.items():
+            print(f"{key}: " + " ".join(f"{name}={value:g}" for name, value in summary.items() if value is not None))
+    return len(summaries)
+
+
+def submission(sinks: list, method: str, **kwargs):
+    """
+    The submission function creates the on_result callback of a test, which hands its results to every sink.
+
+    :param sinks: list: The Sink objects results are sent to
+    :param method: str: The Sink method to call, such as `submit_ping`
+    :param kwargs: Passed on to the Sink method
+    :return: The callback, or None if there are no sinks
+    """
+    if len(sinks) == 0:
+        return None
+
+    def on_result(results):
+        for each_sink in sinks:
+            getattr(each_sink, method)(results, **kwargs)
+    return on_result
+
+
+def build_tests(args, sinks: list, ping_targets: list, remote_ping_targets: list):
+    """
+    The build_tests function creates the tests requested on the command line. Each test hands its results to every
+    sink when it completes. With --adaptive, the pings of each side are run by an AdaptiveMonitor, and the iperf test
+    of that side only runs while one of its targets is escalated.
+
+    :param args: The parsed command line arguments
+    :param sinks: list: The Sink objects results are sent to
+    :param ping_targets: list: The local ping targets
+    :param remote_ping_targets: list: The remote ping targets
+    :return: A list of NetworkTest objects
+    """
+    native_ping = args.native_ping or args.native_ping_port is not None
+    tests = []
+    monitors = {}  # Whether the targets are local to the AdaptiveMonitor testing them
+    for name, targets, local in [("local ping", ping_targets, True), ("remote ping", remote_ping_targets, False)]:
+        if args.adaptive and len(targets) > 0:
+            monitor = monitors[local] = adaptive.AdaptiveMonitor(
+                functools.partial(fleet.run_ping_fleet, max_workers=args.max_ping_workers, timeout=args.ping_timeout,
+                                  native=native_ping, udp_port=args.native_ping_port),
+                heartbeat_packets=args.heartbeat_packets, loss_threshold=args.escalate_loss,
+                latency_threshold=args.escalate_latency, change_ratio=args.escalate_change,
+                calm_runs=args.calm_runs, bandwidth_interval=args.iperf_interval)
+
+            def on_result(results, monitor=monitor, local=local):
+                for each_sink in sinks:
+                    each_sink.submit_ping_fleet(results, local=local, tags_by_target=monitor.mode_tags(results))
+
+            tests.append(runner.NetworkTest(
+                f"adaptive {name}", lambda monitor=monitor, **kwargs: monitor.run(**kwargs)[0],
+                kwargs={"targets": targets, "number_of_packets": args.number_of_packets},
+                on_result=on_result if len(sinks) > 0 else None, targets=targets))
+        elif len(targets) == 1:
+            ping_timeout = args.ping_timeout
+            if ping_timeout is None:
+                ping_timeout = int(args.number_of_packets) + fleet.TIMEOUT_GRACE_SECONDS
+            if native_ping:
+                ping_test = prober.run_native_ping
+                ping_kwargs = {"udp_port": args.native_ping_port, "max_duration": ping_timeout}
+            else:
+                ping_test = ping.run_ping
+                ping_kwargs = {"timeout": ping_timeout}
+            tests.append(runner.NetworkTest(
+                name, ping_test,
+                kwargs={"target": targets[0], "number_of_packets": args.number_of_packets, **ping_kwargs},
+                on_result=submission(sinks, "submit_ping", local=local), targets=targets))
+        elif len(targets) > 1:
+            tests.append(runner.NetworkTest(
+                f"{name} fleet", lambda **kwargs: fleet.run_ping_fleet(**kwargs)[0],
+                kwargs={"targets": targets, "number_of_packets": args.number_of_packets,
+                        "max_workers": args.max_ping_workers, "timeout": args.ping_timeout,
+                        "native": native_ping, "udp_port": args.native_ping_port},
+                on_result=submission(sinks, "submit_ping_fleet", local=local), targets=targets))
+
+    if args.path_host:
+        tests.append(runner.NetworkTest(
+            "path analysis", lambda **kwargs: path.run_path_analysis(**kwargs)[0],
+            kwargs={"targets": args.path_host, "rounds": args.path_rounds, "max_ttl": args.path_max_ttl,
+                    "cache": path.PathCache(ttl=args.path_cache_ttl)},
+            on_result=submission(sinks, "submit_path"), targets=args.path_host))
+
+    if args.native_iperf:
+        bandwidth_test = throughput.run_throughput
+        bandwidth_kwargs = {"duration": args.iperf_duration, "streams": args.iperf_streams,
+                            "use_sendfile": args.iperf_sendfile}
+    else:
+        bandwidth_test = iperf.run_iperf
+        bandwidth_kwargs = {}
+
+    if args.iperf_host is not None:
+        tests.append(runner.NetworkTest(
+            "local iperf", bandwidth_test,
+            kwargs={"target": args.iperf_host, "port": args.local_iperf_port, **bandwidth_kwargs},
+            phase=runner.PHASE_BANDWIDTH,
+            on_result=submission(sinks, "submit_bandwidth"),
+            enabled=monitors[True].bandwidth_due if True in monitors else None, targets=[args.iperf_host]))
+
+    if args.remote_iperf_host is not None:
+        tests.append(runner.NetworkTest(
+            "remote iperf", bandwidth_test,
+            kwargs={"target": args.remote_iperf_host, "port": args.remote_iperf_port, **bandwidth_kwargs},
+            phase=runner.PHASE_BANDWIDTH,
+            on_result=submission(sinks, "submit_bandwidth", local=False),
+            enabled=monitors[False].bandwidth_due if False in monitors else None, targets=[args.remote_iperf_host]))
+    return tests
+
+
+def report_dns_metrics(sinks: list):
+    """
+    The report_dns_metrics function hands the time every target took to resolve, for the lookups made since the last
+    report, to every sink as `network_health.dns.lookup_time` metrics. Targets served from the cache are not reported.
+
+    :param sinks: list: The Sink objects results are sent to
+    """
+    lookups = dns.resolver.drain()
+    if len(lookups) == 0:
+        return
+    for each_sink in sinks:
+        each_sink.submit_dns(lookups)
+
+
+def report_self_metrics(args, sinks: list):
+    """
+    The report_self_metrics function logs how long each stage took since the last report and hands the timings, retry
+    counts and payload sizes to every sink as `network_health.self.*` metrics.
+
+    :param args: The parsed command line arguments
+    :param sinks: list: The Sink objects results are sent to
+    """
+    stats = tracing.tracer.drain()
+    if len(stats) == 0:
+        return
+    tracing.log_stats(stats)
+    if args.disable_self_metrics:
+        return
+    metrics = tracing.snapshot_metrics(stats)
+    for each_sink in sinks:
+        each_sink.submit_self_metrics(metrics)
+
+
+def build_plan_tests(args, sinks: list, interval_plan: plan.PlanInterval):
+    """
+    The build_plan_tests function creates the tests of one interval of a test plan. Ping targets that share their
+    settings run as one fleet test, and every bandwidth target is a test of its own, reported with a target tag.
+
+    :param args: The parsed command line arguments
+    :param sinks: list: The Sink objects results are sent to
+    :param interval_plan: PlanInterval: The targets to test
+    :return: A list of NetworkTest objects
+    """
+    tests = []
+    for index, ((local, number_of_packets, timeout, native, port), targets) in enumerate(
+            interval_plan.ping_groups.items()):
+        hosts = [target.host for target in targets]
+        tests.append(runner.NetworkTest(
+            f"plan {'local' if local else 'remote'} ping {index + 1} every {interval_plan.interval:g}s",
+            lambda **kwargs: fleet.run_ping_fleet(**kwargs)[0],
+            kwargs={"targets": hosts, "number_of_packets": number_of_packets, "max_workers": args.max_ping_workers,
+                    "timeout": timeout, "native": native or port is not None, "udp_port": port},
+            on_result=submission(sinks, "submit_ping_fleet", local=local,
+                                 tags_by_target={target.host: target.tags for target in targets if target.tags}),
+            targets=hosts))
+
+    for target in interval_plan.bandwidth_targets:
+        if target.native:
+            bandwidth_test = throughput.run_throughput
+            bandwidth_kwargs = {"duration": target.duration, "streams": target.streams,
+                                "use_sendfile": target.sendfile}
+        else:
+            bandwidth_test = iperf.run_iperf
+            bandwidth_kwargs = {"timeout": target.timeout}
+        tests.append(runner.NetworkTest(
+            f"plan {'local' if target.local else 'remote'} iperf {target.host}:{target.port or 'default'} every "
+            f"{interval_plan.interval:g}s", bandwidth_test,
+            kwargs={"target": target.host, "port": target.port, **bandwidth_kwargs},
+            phase=runner.PHASE_BANDWIDTH,
+            on_result=submission(sinks, "submit_bandwidth", local=target.local, target=target.host,
+                                 tags=target.tags),
+            targets=[target.host]))
+    return tests
+
+
+def run_cycle(args, tests: list, sinks: list, gate: runner.PhaseGate = None):
+    """
+    The run_cycle function resolves the targets of the given tests, runs the tests once, then flushes every sink, so
+    Datadog receives all of their results together. The stats collected about the process itself go out in the same
+    flush; the time spent sending is only known afterwards, so it is reported with the next cycle, or by shut_down
+    after the last one.
+
+    :param args: The parsed command line arguments
+    :param tests: list: The tests to run
+    :param sinks: list: The Sink objects results are sent to
+    :param gate: PhaseGate: Shared by cycles that may overlap, so a bandwidth phase never runs alongside another phase
+    :return: A dictionary of test name to the exception it raised, for the tests that failed
+    """
+    dns.resolver.prefetch(target for test in tests for target in test.targets)
+    _, errors = runner.run_tests_concurrently(tests, max_bandwidth_concurrency=args.max_bandwidth_concurrency,
+                                              gate=gate)
+    report_dns_metrics(sinks)
+    report_self_metrics(args, sinks)
+    errors.update(flush_sinks(sinks))
+    return errors
+
+
+def flush_sinks(sinks: list):
+    """
+    The flush_sinks function flushes every sink.
+
+    :param sinks: list: The Sink objects to flush
+    :return: A dictionary of `$SINK submission` to the exception it raised, for the sinks that failed
+    """
+    errors = {}
+    for each_sink in sinks:
+        try:
+            each_sink.flush()
+        except (datadog.DatadogFailedMetricsUpdate, datadog.DatadogAuthenticationError) as e:
+            logger.error(f"Failed to submit results to {each_sink.name}: {e}")
+            errors[f"{each_sink.name} submission"] = e
+    return errors
+
+
+def shut_down(args, sinks: list):
+    """
+    The shut_down function waits for every sink to send what it holds, then reports the stats of that last send,
+    which no cycle could include, before closing the sinks. Without a next cycle, as in the default one-shot mode, the
+    HTTP timings and retry counts of a run would otherwise never be reported. They are sent synchronously, and the
+    stats of that final send are only logged.
+
+    :param args: The parsed command line arguments
+    :param sinks: list: The Sink objects to shut down
+    :return: A dictionary of `$SINK submission` to the exception it raised, for the sinks that failed
+    """
+    errors = {}
+    for each_sink in sinks:
+        if not each_sink.drain(timeout=args.shutdown_timeout):
+            logger.error(f"Not every result could be sent to {each_sink.name}")
+            errors[f"{each_sink.name} submission"] = datadog.DatadogFailedMetricsUpdate(
+                f"Not every result was sent to {each_sink.name}")
+    report_self_metrics(args, sinks)
+    for name, error in flush_sinks(sinks).items():
+        errors.setdefault(name, error)
+    for each_sink in sinks:
+        each_sink.close(timeout=args.shutdown_timeout)
+    tracing.log_stats(tracing.tracer.drain())
+    return errors
+
+
+def run_daemon(args, tests: list, sinks: list, local_store=None, test_plan: plan.TestPlan = None):
+    """
+    The run_daemon function repeats the ping and iperf tests on their own intervals until the process is told to stop.
+    The logger and sinks, such as the validated Datadog client, are set up once and kept for the life of the process.
+    The local store, if there is one, is rolled up in the background.
+
+    Each interval of the test plan is a job of its own. SIGHUP reloads the plan: the tests of every interval are
+    swapped in place, so jobs keep their cadence and tests already running finish against the old plan. A plan that
+    fails to load or validate is logged and the current one is kept.
+
+    Jobs run on their own schedules and may overlap, but they share a PhaseGate: pings of any job run side by side,
+    while bandwidth tests wait for them and run alone, so a saturated link never skews a latency measurement.
+
+    :param args: The parsed command line arguments
+    :param tests: list: The tests to repeat
+    :param sinks: list: The Sink objects results are sent to
+    :param local_store: TimeSeriesStore: The local store, or None if results are not kept locally
+    :param test_plan: TestPlan: The test plan loaded from --test-plan, or None
+    """
+    test_scheduler = scheduler.Scheduler()
+    gate = runner.PhaseGate()
+    # Bandwidth tests gated by an adaptive monitor run right after the pings that may escalate them
+    latency_tests = [test for test in tests if test.phase == runner.PHASE_LATENCY or test.enabled is not None]
+    bandwidth_tests = [test for test in tests if test.phase == runner.PHASE_BANDWIDTH and test.enabled is None]
+    if len(latency_tests) > 0:
+        test_scheduler.add_job("ping", lambda: run_cycle(args, latency_tests, sinks, gate),
+                               interval=args.ping_interval, jitter=args.schedule_jitter)
+    if len(bandwidth_tests) > 0:
+        test_scheduler.add_job("iperf", lambda: run_cycle(args, bandwidth_tests, sinks, gate),
+                               interval=args.iperf_interval, jitter=args.schedule_jitter)
+    plan_lock = threading.Lock()
+    plan_jobs = {}  # Interval to its ScheduledJob
+    plan_tests = {}  # Interval to the tests it runs, replaced as a whole on reload
+
+    def run_plan_interval(interval):
+        interval_tests = plan_tests.get(interval)
+        if interval_tests is not None:
+            run_cycle(args, interval_tests, sinks, gate)
+
+    def schedule_plan(new_plan: plan.TestPlan):
+        with plan_lock:
+            new_tests = {interval: build_plan_tests(args, sinks, interval_plan)
+                         for interval, interval_plan in new_plan.intervals.items()}
+            plan_tests.clear()
+            plan_tests.update(new_tests)
+            for interval in new_tests:
+                if interval not in plan_jobs:
+                    plan_jobs[interval] = test_scheduler.add_job(
+                        f"plan {interval:g}s", lambda interval=interval: run_plan_interval(interval),
+                        interval=interval, jitter=args.schedule_jitter)
+            for interval in list(plan_jobs):
+                if interval not in new_tests:
+                    test_scheduler.remove_job(plan_jobs.pop(interval))
+
+    def reload_plan():
+        logger.info(f"Reloading test plan {args.test_plan}...")
+        try:
+            schedule_plan(plan.load_plan(args.test_plan))
+        except plan.TestPlanError as e:
+            logger.error(f"Failed to reload the test plan, keeping the current one: {e}")
+
+    if test_plan is not None:
+        schedule_plan(test_plan)
+    if local_store is not None:
+        test_scheduler.add_job("rollup", local_store.rollup, interval=store.DEFAULT_ROLLUP_INTERVAL,
+                               run_immediately=False)
+
+    def handle_stop_signal(signum, frame):
+        logger.info(f"Received signal {signum}, stopping...")
+        test_scheduler.stop()
+
+    def handle_reload_signal(signum, frame):
+        # Reload outside of the signal handler, which may have interrupted the scheduler while it held its lock
+        threading.Thread(target=reload_plan, name="plan-reload", daemon=True).start()
+
+    signal.signal(signal.SIGINT, handle_stop_signal)
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    if test_plan is not None and hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, handle_reload_signal)
+    test_scheduler.run_forever()
+
+
 if __name__ == "__main__":
-    dd_client = None
+    sinks = []
     results = {}
     DATADOG_API_KEY = os.getenv("DATADOG_API_KEY", None)
 
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        run_server(parse_serve_opts(sys.argv[2:]))
+        logger.info("Completed.")
+        exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        try:
+            found = run_query(parse_query_opts(sys.argv[2:]))
+        except ValueError as e:
+            logger.error(f"{e}. Exiting..")
+            exit(1)
+        exit(0 if found > 0 else 1)
+
     args = parse_opts()
 
+    dns.resolver.ttl = args.dns_cache_ttl
+
+    if args.profile is not None:
+        profiler = tracing.Profiler(args.profile)
+        profiler.start()
+        atexit.register(profiler.stop)
+
     if not args.disable_datadog_submit:
         if DATADOG_API_KEY is None:
             logger.error(f"Failed to find $DATADOG_API_KEY environment variable. Exiting..")
             exit(255)
 
-    specified_tests = [test for test in [args.iperf_host, args.remote_iperf_host, args.ping_host, args.remote_ping_host]
-                       if test is not None]  # Count the number of test that are to run.
+    ping_targets = list(args.ping_host or [])
+    if args.ping_targets_file is not None:
+        ping_targets.extend(fleet.load_targets(args.ping_targets_file))
+    remote_ping_targets = list(args.remote_ping_host or [])
+    if args.remote_ping_targets_file is not None:
+        remote_ping_targets.extend(fleet.load_targets(args.remote_ping_targets_file))
+
+    test_plan = None
+    if args.test_plan is not None:
+        try:
+            test_plan = plan.load_plan(args.test_plan)
+        except plan.TestPlanError as e:
+            logger.error(f"{e}. Exiting..")
+            exit(1)
+
+    specified_tests = [test for test in [args.iperf_host, args.remote_iperf_host] if test is not None]
+    specified_tests.extend(ping_targets + remote_ping_targets)  # Count the number of test that are to run.
+    specified_tests.extend(args.path_host or [])
+    if test_plan is not None:
+        specified_tests.extend(test_plan.targets)
     if len(specified_tests) == 0:
         print(USAGE_MESSAGE)
         exit(1)
 
+    if args.submit_backpressure == sender.POLICY_SPILL and args.disable_spool:
+        logger.error(f"`--submit-backpressure {sender.POLICY_SPILL}` can not be used with `--disable-spool`. Exiting..")
+        exit(1)
+
     if not args.disable_datadog_submit:
         logger.info(f"Creating Datadog client.")
-        dd_client = datadog.DatadogClient(DATADOG_API_KEY)
+        metric_spool = None
+        if not args.disable_spool:
+            metric_spool = spool.MetricSpool(args.spool_dir, max_total_bytes=args.spool_max_bytes,
+                                             max_age_seconds=args.spool_max_age)
+        dd_client = datadog.DatadogClient(DATADOG_API_KEY, batch=True, compression=args.compression,
+                                          spool=metric_spool)
         logger.info("Validating provided credentials...")
         dd_client.validate_credentials()
         logger.info("Successfully validated provided Datadog credentials.")
+        dd_client.start_background_sender(max_queue_size=args.submit_queue_size, policy=args.submit_backpressure)
+        sinks.append(sink.DatadogSink(dd_client))
     else:
         logger.info("Datadog submission is disabled.")
 
-    if args.ping_host is not None:
-        logger.info("Starting local ping test...")
-        ping_results = ping.run_ping(args.ping_host, number_of_packets=args.number_of_packets)
-        if dd_client is not None:
-            dd_client.submit_ping_network_health(ping_results)
+    local_store = None
+    if args.local_store:
+        local_store = store.TimeSeriesStore(args.store_dir, raw_retention=args.store_raw_retention)
+        sinks.append(sink.StoreSink(local_store))
 
-    if args.remote_ping_host is not None:
-        logger.info(f"Starting remote ping test...")
-        remote_ping_results = ping.run_ping(args.remote_ping_host, number_of_packets=args.number_of_packets)
-        if dd_client is not None:
-            dd_client.submit_ping_network_health(remote_ping_results, local=False)
+    if args.prometheus_port is not None:
+        sinks.append(prometheus.PrometheusExporter(host=args.prometheus_host, port=args.prometheus_port))
 
-    if args.iperf_host is not None:
-        logger.info("Starting local iperf test...")
-        local_iperf_results = iperf.run_iperf(args.iperf_host, port=args.local_iperf_port)
-        if dd_client is not None:
-            dd_client.submit_bandwidth_data(local_iperf_results)
+    tests = build_tests(args, sinks, ping_targets, remote_ping_targets)
+    if args.daemon:
+        run_daemon(args, tests, sinks, local_store, test_plan)
+        errors = {}
+    else:
+        if test_plan is not None:
+            for interval_plan in test_plan.intervals.values():
+                tests.extend(build_plan_tests(args, sinks, interval_plan))
+        errors = run_cycle(args, tests, sinks)
 
-    if args.remote_iperf_host is not None:
-        logger.info("Starting remote iperf test...")
-        remote_iperf_results = iperf.run_iperf(args.remote_iperf_host, port=args.remote_iperf_port)
-        if dd_client is not None:
-            dd_client.submit_bandwidth_data(remote_iperf_results, local=False)
+    for name, error in shut_down(args, sinks).items():
+        errors.setdefault(name, error)
+    if len(errors) > 0:
+        logger.error(f"{len(errors)} failure(s): {', '.join(errors)}")
+        exit(1)
 
     logger.info("Completed.")
@@ -0,0 +1,132 @@
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+class FakeDatadog:
+    """
+    A local stand-in for the Datadog API. Requests are answered with the queued responses in order, then with
+    default_status, and every request is recorded.
+    """
+
+    def __init__(self, default_status: int = 202):
+        self.default_status = default_status
+        self.responses = []  # (status, headers) tuples, answered first
+        self.requests = []  # (method, path, headers, body) tuples
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.fake = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def respond(self, status: int, headers: dict = None):
+        with self.lock:
+            self.responses.append((status, headers or {}))
+
+    def next_response(self, method: str, path: str, headers, body: bytes):
+        with self.lock:
+            self.requests.append((method, path, headers, body))
+            if self.responses:
+                return self.responses.pop(0)
+            return self.default_status, {}
+
+    def posts(self):
+        with self.lock:
+            return [request for request in self.requests if request[0] == "POST"]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _handle(self, method: str):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, headers = self.server.fake.next_response(method, self.path, self.headers, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_datadog():
+    fake = FakeDatadog()
+    fake.thread.start()
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+@pytest.fixture
+def datadog_client(fake_datadog):
+    from lib import datadog
+    from lib.retry import RetryPolicy
+
+    client = datadog.DatadogClient("key", host="test-host", retry_policy=RetryPolicy(base_delay=0.01, max_delay=0.05))
+    client.base_url = fake_datadog.url
+    client.validate_credentials()
+    yield client
+    client.close(timeout=1)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def server_port():
+    from lib import reflector
+
+    port = free_port()
+    server = reflector.ReflectorServer(host="127.0.0.1", port=port, stats_interval=60)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    yield port
+    server.stop()
+    thread.join(5)
+
+
+@pytest.fixture
+def fake_command(tmp_path, monkeypatch):
+    """Puts executables written in Python first on the PATH, standing in for ping and iperf."""
+    if sys.platform == "win32":
+        pytest.skip("fake commands are POSIX scripts")
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ.get('PATH', '')}")
+
+    def install(name: str, source: str):
+        path = tmp_path / name
+        path.write_text(f"#!{sys.executable}\nimport sys\n{source}\n")
+        path.chmod(0o755)
+        return str(path)
+
+    return install
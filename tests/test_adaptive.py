@@ -0,0 +1,72 @@
+from lib import adaptive
+from lib.ping import FailedToParsePing
+from lib.results import PingResult
+
+
+class FakeFleet:
+    """Stands in for fleet.run_ping_fleet, answering from a dictionary of target to PingResult or exception."""
+
+    def __init__(self, outcomes: dict):
+        self.outcomes = outcomes
+        self.calls = []
+
+    def __call__(self, targets, number_of_packets):
+        self.calls.append((list(targets), number_of_packets))
+        results, errors = {}, {}
+        for target in targets:
+            outcome = self.outcomes[target]
+            if isinstance(outcome, Exception):
+                errors[target] = outcome
+            else:
+                results[target] = outcome
+        return results, errors
+
+
+def healthy():
+    return PingResult(packet_loss=0.0, average_latency=10.0)
+
+
+def test_healthy_target_stays_on_heartbeats():
+    fleet = FakeFleet({"a": healthy()})
+    monitor = adaptive.AdaptiveMonitor(fleet, heartbeat_packets=5)
+    for _ in range(3):
+        results, errors = monitor.run(["a"], number_of_packets=100)
+        assert results == {"a": healthy()} and errors == {}
+    assert fleet.calls == [(["a"], 5)] * 3
+    assert not monitor.bandwidth_due()
+
+
+def test_unreachable_target_is_escalated():
+    # A heartbeat that gets no reply at all raises instead of returning a result
+    fleet = FakeFleet({"a": FailedToParsePing(), "b": healthy()})
+    monitor = adaptive.AdaptiveMonitor(fleet, heartbeat_packets=5, calm_runs=2, bandwidth_interval=300)
+    for run in range(3):
+        results, errors = monitor.run(["a", "b"], number_of_packets=100)
+        assert list(errors) == ["a"] and list(results) == ["b"]
+        assert monitor.state("a").escalated
+        assert monitor.state("a").mode == adaptive.MODE_FULL
+        assert not monitor.state("b").escalated
+        assert monitor.bandwidth_due() == (run == 0)
+    assert fleet.calls[:2] == [(["a", "b"], 5), (["a"], 100)]
+    assert fleet.calls[2:] == [(["b"], 5), (["a"], 100)] * 2
+
+    # Once it answers again it backs off after calm_runs healthy full runs, and not before
+    fleet.outcomes["a"] = healthy()
+    monitor.run(["a", "b"], number_of_packets=100)
+    assert monitor.state("a").escalated
+    monitor.run(["a", "b"], number_of_packets=100)
+    assert not monitor.state("a").escalated
+    assert not monitor.bandwidth_due()
+
+
+def test_failure_while_escalated_resets_calm_runs():
+    fleet = FakeFleet({"a": PingResult(packet_loss=50.0, average_latency=10.0)})
+    monitor = adaptive.AdaptiveMonitor(fleet, calm_runs=2)
+    monitor.run(["a"], number_of_packets=100)
+    fleet.outcomes["a"] = healthy()
+    monitor.run(["a"], number_of_packets=100)
+    assert monitor.state("a").calm_runs == 1
+    fleet.outcomes["a"] = FailedToParsePing()
+    monitor.run(["a"], number_of_packets=100)
+    assert monitor.state("a").calm_runs == 0
+    assert monitor.state("a").escalated
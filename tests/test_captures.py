@@ -0,0 +1,31 @@
+import json
+import os
+
+import pytest
+
+from lib import ping
+
+CAPTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "captures")
+
+with open(os.path.join(CAPTURES_DIR, "expected.json")) as expected_file:
+    CAPTURES = json.load(expected_file)
+
+
+@pytest.mark.parametrize("capture", CAPTURES, ids=[capture["file"] for capture in CAPTURES])
+def test_capture(fake_command, monkeypatch, capture):
+    # The transcript is replayed byte for byte by a stand-in ping, so line endings and stderr go through stream_lines
+    stdout_path = os.path.join(CAPTURES_DIR, capture["file"])
+    stderr_path = os.path.join(CAPTURES_DIR, capture["stderr"]) if "stderr" in capture else None
+    fake_command("ping", f"sys.stdout.buffer.write(open({stdout_path!r}, 'rb').read())\n"
+                         f"if {stderr_path!r} is not None:\n"
+                         f"    sys.stderr.buffer.write(open({stderr_path!r}, 'rb').read())\n"
+                         f"sys.exit({0 if 'result' in capture else 1})")
+    monkeypatch.setattr(ping, "CURRENT_PLATFORM", capture["platform"])
+    if "error" in capture:
+        with pytest.raises(getattr(ping, capture["error"])):
+            ping.run_ping("127.0.0.1", number_of_packets=capture["packets"])
+        return
+    result = ping.run_ping("127.0.0.1", number_of_packets=capture["packets"])
+    assert len(result.rtts) == capture["replies"]
+    for metric, value in capture["result"].items():
+        assert result[metric] == value, metric
@@ -0,0 +1,55 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import pytest
+
+import network_health
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="SIGHUP is POSIX only")
+def test_sighup_reloads_the_plan(tmp_path, monkeypatch, caplog):
+    plan_path = tmp_path / "plan.json"
+    plan_path.write_text(json.dumps({"targets": [{"host": "192.0.2.1", "interval": 3600}]}))
+    args = argparse.Namespace(test_plan=str(plan_path), schedule_jitter=0.0, max_ping_workers=4)
+    cycles = []
+    monkeypatch.setattr(network_health, "run_cycle",
+                        lambda args, tests, sinks, gate: cycles.append([test.kwargs["targets"] for test in tests]))
+
+    def wait_for(condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    checks = {}
+
+    def drive():
+        try:
+            checks["first plan ran"] = wait_for(lambda: cycles == [[["192.0.2.1"]]])
+            # A plan that does not validate is reported and the current one is kept
+            plan_path.write_text(json.dumps({"targets": [{"host": "192.0.2.2", "interval": -1}]}))
+            os.kill(os.getpid(), signal.SIGHUP)
+            checks["bad plan rejected"] = wait_for(lambda: "keeping the current one" in caplog.text)
+            # A valid plan swaps the tests in, and its new interval runs straight away
+            plan_path.write_text(json.dumps({"targets": [{"host": "192.0.2.3", "interval": 1800}]}))
+            os.kill(os.getpid(), signal.SIGHUP)
+            checks["new plan ran"] = wait_for(lambda: cycles[-1:] == [[["192.0.2.3"]]])
+        finally:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)}
+    driver = threading.Thread(target=drive)
+    try:
+        driver.start()
+        network_health.run_daemon(args, [], [], test_plan=network_health.plan.load_plan(str(plan_path)))
+    finally:
+        driver.join(10)
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    assert checks == {"first plan ran": True, "bad plan rejected": True, "new plan ran": True}
+    assert cycles == [[["192.0.2.1"]], [["192.0.2.3"]]]
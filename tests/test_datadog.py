@@ -0,0 +1,151 @@
+import gzip
+import json
+import math
+import zlib
+
+import pytest
+
+from lib import datadog
+from lib.results import HopResult, IperfResult, PathResult, PingResult
+from lib.tracing import KIND_COUNTER, KIND_DURATION
+
+RESOURCES = [{"name": "test-host", "type": "host"}]
+
+
+@pytest.fixture
+def encoder():
+    return datadog.SeriesEncoder("test-host")
+
+
+def decode(series):
+    return [json.loads(each_series) for each_series in series]
+
+
+def test_encode(encoder):
+    result = PingResult(packet_loss=0.0, average_latency=12.5, max_loss_burst=2, p99_latency=None)
+    series = decode(encoder.encode(result, "ping_local", tags=["env:prod"], timestamp=1_700_000_000))
+    assert series == [
+        {"metric": "network_health.ping_local.packet_loss", "resources": RESOURCES, "type": datadog.METRIC_TYPE_COUNT,
+         "unit": "percent", "points": [{"timestamp": 1_700_000_000, "value": 0.0}], "tags": ["env:prod"]},
+        {"metric": "network_health.ping_local.average_latency", "resources": RESOURCES,
+         "type": datadog.METRIC_TYPE_RATE, "unit": "millisecond",
+         "points": [{"timestamp": 1_700_000_000, "value": 12.5}], "tags": ["env:prod"]},
+        {"metric": "network_health.ping_local.max_loss_burst", "resources": RESOURCES,
+         "type": datadog.METRIC_TYPE_COUNT, "unit": "packet",
+         "points": [{"timestamp": 1_700_000_000, "value": 2.0}], "tags": ["env:prod"]},
+    ]
+
+
+def test_encode_without_tags_or_samples(encoder):
+    result = IperfResult(intervals=[object()], transfer_value=10, bandwidth_value=1.0)
+    series = decode(encoder.encode(result, "bandwidth_remote", timestamp=0))
+    assert [each_series["metric"] for each_series in series] == [
+        "network_health.bandwidth_remote.transfer_value", "network_health.bandwidth_remote.bandwidth_value"]
+    assert all("tags" not in each_series for each_series in series)
+    # Dictionaries are accepted too, and the per-interval samples are not metrics
+    assert len(encoder.encode({"transfer_value": 1.0, "intervals": []}, "bandwidth_remote")) == 1
+
+
+@pytest.mark.parametrize("value", [math.nan, math.inf, -math.inf])
+def test_encode_skips_values_json_can_not_carry(encoder, value):
+    series = decode(encoder.encode({"jitter": value, "average_latency": 1.0}, "ping_local", timestamp=0))
+    assert [each_series["metric"] for each_series in series] == ["network_health.ping_local.average_latency"]
+
+
+def test_prefixes_are_rendered_once_per_metric(encoder):
+    first = encoder.prefix("ping_local", "average_latency")
+    assert encoder.prefix("ping_local", "average_latency") is first
+    assert encoder.prefix("ping_remote", "average_latency") != first
+    assert first.startswith(b'{"metric":"network_health.ping_local.average_latency",')
+    assert first.endswith(b'"points":[{"timestamp":')
+    assert set(encoder.prefixes) == {("ping_local", "average_latency"), ("ping_remote", "average_latency")}
+
+
+def test_hostname_is_escaped():
+    series = decode(datadog.SeriesEncoder('host "quoted"').encode({"jitter": 1.0}, "ping_local", timestamp=0))
+    assert series[0]["resources"] == [{"name": 'host "quoted"', "type": "host"}]
+
+
+def test_encode_fleet(encoder):
+    results = {"8.8.8.8": PingResult(average_latency=10.0), "1.1.1.1": PingResult(average_latency=20.0)}
+    series = decode(encoder.encode_fleet(results, "ping_remote", tags_by_target={"1.1.1.1": ["role:dns"]}))
+    assert [(each_series["tags"], each_series["points"][0]["value"]) for each_series in series] == [
+        (["target:8.8.8.8"], 10.0), (["target:1.1.1.1", "role:dns"], 20.0)]
+    # Every target's points carry the same timestamp
+    assert len({each_series["points"][0]["timestamp"] for each_series in series}) == 1
+
+
+def test_encode_path(encoder):
+    results = {"8.8.8.8": PathResult(hop_count=2, hops=[HopResult(address="192.0.2.1", packet_loss=0.0),
+                                                          HopResult(packet_loss=100.0)])}
+    series = decode(encoder.encode_path(results))
+    assert [(each_series["metric"], each_series["tags"]) for each_series in series] == [
+        ("network_health.path.hop_count", ["target:8.8.8.8"]),
+        ("network_health.path.hop.packet_loss", ["target:8.8.8.8", "hop:1", "hop_address:192.0.2.1"]),
+        ("network_health.path.hop.packet_loss", ["target:8.8.8.8", "hop:2"]),
+    ]
+    assert series[0]["type"] == datadog.METRIC_TYPE_GAUGE and series[0]["unit"] == "hop"
+
+
+def test_encode_self_metrics(encoder):
+    metrics = {"self.ping.run.avg": (1.5, "millisecond", KIND_DURATION), "self.ping.run.count": (3, None, KIND_COUNTER)}
+    series = decode(encoder.encode_self_metrics(metrics, timestamp=1_700_000_000))
+    assert series == [
+        {"metric": "network_health.self.ping.run.avg", "resources": RESOURCES, "type": datadog.METRIC_TYPE_GAUGE,
+         "unit": "millisecond", "points": [{"timestamp": 1_700_000_000, "value": 1.5}]},
+        # A metric without a unit leaves the key out instead of sending null
+        {"metric": "network_health.self.ping.run.count", "resources": RESOURCES, "type": datadog.METRIC_TYPE_COUNT,
+         "points": [{"timestamp": 1_700_000_000, "value": 3.0}]},
+    ]
+
+
+def test_encode_series_chunks(encoder):
+    series = encoder.encode_fleet({f"192.0.2.{index}": PingResult(average_latency=float(index))
+                                   for index in range(100)}, "ping_remote")
+    counts = []
+    chunks = datadog.encode_series_chunks(series, max_payload_bytes=2000, counts=counts)
+    assert len(chunks) > 1
+    assert all(len(body) <= 2000 for body in chunks)
+    assert sum(counts) == 100
+    decoded = [json.loads(body)["series"] for body in chunks]
+    assert [len(chunk_series) for chunk_series in decoded] == counts
+    # Split without losing, repeating or reordering any series
+    assert [each_series for chunk_series in decoded for each_series in chunk_series] == decode(series)
+
+
+def test_encode_series_chunks_fits_as_many_as_it_can():
+    each_series = b'{"a":1}'
+    body_size = len(b'{"series":[]}') + 3 * len(each_series) + 2
+    assert [len(body) for body in datadog.encode_series_chunks([each_series] * 3, body_size)] == [body_size]
+    assert len(datadog.encode_series_chunks([each_series] * 3, body_size - 1)) == 2
+
+
+def test_encode_series_chunks_keeps_an_oversized_series():
+    # A series larger than the limit still goes out, in a request of its own
+    chunks = datadog.encode_series_chunks([b'{"a":1}', {"b": "x" * 100}, b'{"c":3}'], max_payload_bytes=50)
+    assert [json.loads(body) for body in chunks] == [
+        {"series": [{"a": 1}]}, {"series": [{"b": "x" * 100}]}, {"series": [{"c": 3}]}]
+
+
+def test_encode_series_chunks_of_nothing():
+    counts = []
+    assert datadog.encode_series_chunks([], counts=counts) == []
+    assert counts == []
+
+
+@pytest.mark.parametrize("compression, decompress", [
+    (datadog.COMPRESSION_GZIP, gzip.decompress),
+    (datadog.COMPRESSION_DEFLATE, zlib.decompress),
+])
+def test_compress_body_round_trip(encoder, compression, decompress):
+    series = encoder.encode_fleet({f"192.0.2.{index}": PingResult(average_latency=1.0) for index in range(50)},
+                                  "ping_remote")
+    [body] = datadog.encode_series_chunks(series)
+    compressed = datadog.compress_body(body, compression)
+    assert len(compressed) < len(body)
+    assert decompress(compressed) == body
+    assert json.loads(decompress(compressed))["series"] == decode(series)
+
+
+def test_compress_body_without_compression():
+    assert datadog.compress_body(b'{"series":[]}', None) == b'{"series":[]}'
@@ -0,0 +1,167 @@
+import socket
+import threading
+
+import pytest
+
+from lib import dns
+from lib.tracing import tracer
+
+HOSTS = {"gateway.example": "192.0.2.1", "probe.example": "192.0.2.2", "dns.example": "192.0.2.3"}
+
+
+class FakeClock:
+    """Stands in for time.monotonic, so cached lookups only expire when a test advances it."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeGetaddrinfo:
+    """Stands in for socket.getaddrinfo, answering from HOSTS and counting the lookups of every name."""
+
+    def __init__(self):
+        self.hosts = dict(HOSTS)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, host, port, family=0, type=0, *args):
+        assert family == socket.AF_INET
+        with self.lock:
+            self.calls.append(host)
+        if host not in self.hosts:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, type, socket.IPPROTO_TCP, "", (self.hosts[host], 0))]
+
+    def count(self, host):
+        return self.calls.count(host)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def getaddrinfo(monkeypatch):
+    fake = FakeGetaddrinfo()
+    monkeypatch.setattr(socket, "getaddrinfo", fake)
+    return fake
+
+
+@pytest.fixture
+def resolver(clock, getaddrinfo):
+    return dns.Resolver(ttl=300.0, negative_ttl=30.0, clock=clock)
+
+
+def counts(stats, name):
+    return stats[name].total if name in stats else 0
+
+
+def test_lookups_are_cached_for_the_ttl(resolver, clock, getaddrinfo):
+    tracer.drain()
+    assert resolver.resolve("gateway.example") == "192.0.2.1"
+    clock.now += 299
+    assert resolver.resolve("gateway.example") == "192.0.2.1"
+    assert getaddrinfo.count("gateway.example") == 1
+
+    # Once the TTL is over the name is looked up again, and picks up a changed address
+    getaddrinfo.hosts["gateway.example"] = "192.0.2.10"
+    clock.now += 1
+    assert resolver.resolve("gateway.example") == "192.0.2.10"
+    assert getaddrinfo.count("gateway.example") == 2
+    stats = tracer.drain()
+    assert counts(stats, "dns.lookups") == 2
+    assert counts(stats, "dns.cache_hits") == 1
+
+
+def test_addresses_are_not_looked_up(resolver, getaddrinfo):
+    assert resolver.resolve("192.0.2.50") == "192.0.2.50"
+    assert resolver.resolve("2001:db8::1") == "2001:db8::1"
+    assert getaddrinfo.calls == []
+
+
+def test_zero_ttl_looks_up_every_time(clock, getaddrinfo):
+    resolver = dns.Resolver(ttl=0, clock=clock)
+    for _ in range(3):
+        assert resolver.resolve("gateway.example") == "192.0.2.1"
+    assert getaddrinfo.count("gateway.example") == 3
+
+
+def test_failures_are_cached_for_the_negative_ttl(resolver, clock, getaddrinfo):
+    tracer.drain()
+    for _ in range(2):
+        with pytest.raises(dns.ResolutionFailed, match="missing.example"):
+            resolver.resolve("missing.example")
+    assert getaddrinfo.count("missing.example") == 1
+    assert counts(tracer.drain(), "dns.failures") == 1
+
+    # The name starts resolving: it is picked up after the negative TTL, well before the positive one
+    getaddrinfo.hosts["missing.example"] = "192.0.2.20"
+    clock.now += 29
+    with pytest.raises(dns.ResolutionFailed):
+        resolver.resolve("missing.example")
+    clock.now += 1
+    assert resolver.resolve("missing.example") == "192.0.2.20"
+    assert getaddrinfo.count("missing.example") == 2
+
+
+def test_negative_ttl_is_at_most_the_ttl(clock, getaddrinfo):
+    resolver = dns.Resolver(ttl=10.0, negative_ttl=30.0, clock=clock)
+    with pytest.raises(dns.ResolutionFailed):
+        resolver.resolve("missing.example")
+    clock.now += 10
+    with pytest.raises(dns.ResolutionFailed):
+        resolver.resolve("missing.example")
+    assert getaddrinfo.count("missing.example") == 2
+
+
+def test_address_or_name(resolver):
+    assert resolver.address_or_name("probe.example") == "192.0.2.2"
+    # A name that does not resolve is handed to the tool as it is, e.g. an IPv6-only host
+    assert resolver.address_or_name("missing.example") == "missing.example"
+
+
+def test_prefetch_resolves_every_name_once(resolver, getaddrinfo):
+    names = ["gateway.example", "probe.example", "gateway.example", "192.0.2.50", "missing.example"]
+    resolver.prefetch(names)
+    assert sorted(getaddrinfo.calls) == ["gateway.example", "missing.example", "probe.example"]
+
+    # Every test after the prefetch finds its address in the cache, including the failures
+    assert resolver.resolve("gateway.example") == "192.0.2.1"
+    assert resolver.resolve("probe.example") == "192.0.2.2"
+    with pytest.raises(dns.ResolutionFailed):
+        resolver.resolve("missing.example")
+    assert len(getaddrinfo.calls) == 3
+
+
+def test_prefetch_skips_fresh_names(resolver, clock, getaddrinfo):
+    resolver.resolve("gateway.example")
+    resolver.prefetch(["gateway.example", "dns.example"])
+    assert getaddrinfo.count("gateway.example") == 1
+    assert getaddrinfo.count("dns.example") == 1
+
+    clock.now += 300
+    resolver.prefetch(["gateway.example", "dns.example"])
+    assert getaddrinfo.count("gateway.example") == 2
+    assert getaddrinfo.count("dns.example") == 2
+
+
+def test_drain_takes_the_lookups_since_the_last_drain(resolver, clock):
+    resolver.prefetch(["gateway.example", "missing.example"])
+    resolver.resolve("gateway.example")  # A cache hit is not a lookup
+    lookups = resolver.drain()
+    assert sorted(lookups) == ["gateway.example", "missing.example"]
+    assert lookups["gateway.example"].address == "192.0.2.1"
+    assert lookups["missing.example"].address is None
+    assert all(lookup.lookup_time >= 0 for lookup in lookups.values())
+    assert resolver.drain() == {}
+
+    # Only the latest lookup of a target is kept
+    clock.now += 300
+    resolver.resolve("gateway.example")
+    clock.now += 300
+    resolver.resolve("gateway.example")
+    assert list(resolver.drain()) == ["gateway.example"]
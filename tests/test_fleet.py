@@ -0,0 +1,156 @@
+import argparse
+import json
+import socket
+import sys
+import time
+
+import pytest
+
+import network_health
+from lib import fleet, ping, plan, prober, sink
+
+
+def test_probe_localhost():
+    # Raw or unprivileged ICMP where the host allows it, UDP probes answered with port unreachable otherwise
+    results, errors = prober.probe_targets(["127.0.0.1"], number_of_packets=5, interval=0.05, timeout=1.0)
+    assert errors == {}
+    result = results["127.0.0.1"]
+    assert result.packet_loss == 0.0
+    assert len(result.rtts) == 5
+    assert 0 <= result.minimum_latency <= result.average_latency <= result.max_latency
+
+
+def test_probe_reflector(server_port):
+    results, errors = prober.probe_targets(["127.0.0.1", "localhost"], number_of_packets=5, interval=0.05,
+                                           timeout=1.0, udp_port=server_port)
+    assert errors == {}
+    assert set(results) == {"127.0.0.1", "localhost"}
+    assert results["127.0.0.1"].packet_loss == 0.0
+
+
+def test_native_fleet_honours_timeout(server_port):
+    start = time.monotonic()
+    results, errors = fleet.run_ping_fleet(["127.0.0.1"], number_of_packets=100, timeout=1.5, native=True,
+                                           udp_port=server_port)
+    assert time.monotonic() - start < 5
+    assert errors == {}
+    result = results["127.0.0.1"]
+    # Only the probes sent before the timeout count, so the run is not reported as mostly lost
+    assert result.packet_loss == 0.0
+    assert 1 <= len(result.rtts) <= 3
+
+
+def test_native_fleet_times_out_silent_target():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:
+        silent.bind(("127.0.0.1", 0))
+        start = time.monotonic()
+        results, errors = fleet.run_ping_fleet(["127.0.0.1"], number_of_packets=100, timeout=0.5, native=True,
+                                               udp_port=silent.getsockname()[1])
+    assert time.monotonic() - start < 3
+    assert results == {}
+    assert isinstance(errors["127.0.0.1"], prober.PingExecutionFailed)
+
+
+def test_native_ping_honours_max_duration(server_port):
+    start = time.monotonic()
+    result = prober.run_native_ping("127.0.0.1", number_of_packets=100, udp_port=server_port, max_duration=1.5)
+    assert time.monotonic() - start < 5
+    assert result.packet_loss == 0.0
+    assert 1 <= len(result.rtts) <= 3
+
+
+def test_single_target_ping_is_given_the_timeout(monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["network_health.py", "--ping-timeout", "7"])
+    args = network_health.parse_opts()
+    [test] = network_health.build_tests(args, [], ["127.0.0.1"], [])
+    assert test.func is ping.run_ping
+    assert test.kwargs["timeout"] == 7
+
+    monkeypatch.setattr(sys, "argv", ["network_health.py", "--native-ping", "--number-of-packets", "20"])
+    args = network_health.parse_opts()
+    [test] = network_health.build_tests(args, [], ["127.0.0.1"], [])
+    assert test.func is prober.run_native_ping
+    assert test.kwargs["max_duration"] == 20 + fleet.TIMEOUT_GRACE_SECONDS
+
+
+def test_probers_use_their_own_identifier():
+    # Raw sockets see every echo reply on the host, so concurrent probers tell theirs apart by identifier
+    probers = [prober.Prober(mode=prober.MODE_UDP) for _ in range(64)]
+    identifiers = {each.identifier for each in probers}
+    assert len(identifiers) == len(probers)
+    assert all(0 <= identifier <= 0xFFFF for identifier in identifiers)
+    request = prober.build_echo_request(probers[0].identifier, 1, b"")
+    assert prober.ICMP_HEADER.unpack_from(request)[3] == probers[0].identifier
+
+
+FAKE_PING = """
+import time
+target, count = sys.argv[1], int(sys.argv[3])
+if target == "192.0.2.9":
+    print("ping: connect: Network is unreachable", file=sys.stderr)
+    sys.exit(2)
+if target == "192.0.2.8":
+    time.sleep(30)
+rtt = float(target.rsplit(".", 1)[1])
+print(f"PING {target} ({target}) 56(84) bytes of data.")
+for seq in range(1, count + 1):
+    print(f"64 bytes from {target}: icmp_seq={seq} ttl=64 time={rtt:.3f} ms", flush=True)
+print()
+print(f"--- {target} ping statistics ---")
+print(f"{count} packets transmitted, {count} received, 0% packet loss, time {count}ms")
+print(f"rtt min/avg/max/mdev = {rtt:.3f}/{rtt:.3f}/{rtt:.3f}/0.000 ms")
+"""
+
+
+@pytest.fixture
+def fake_ping(fake_command, monkeypatch):
+    fake_command("ping", FAKE_PING)
+    monkeypatch.setattr(ping, "CURRENT_PLATFORM", "Linux")
+
+
+def test_fleet_of_ping_processes(fake_ping):
+    targets = ["192.0.2.1", "192.0.2.2", "192.0.2.9", "192.0.2.1"]
+    results, errors = fleet.run_ping_fleet(targets, number_of_packets=3, max_workers=2, timeout=10)
+    # Duplicates are pinged once, and a failing target does not hold back the others
+    assert sorted(results) == ["192.0.2.1", "192.0.2.2"]
+    assert results["192.0.2.2"].average_latency == 2.0
+    assert len(results["192.0.2.1"].rtts) == 3
+    assert list(errors) == ["192.0.2.9"]
+    assert isinstance(errors["192.0.2.9"], ping.PingExecutionFailed)
+
+
+def test_fleet_timeout_applies_per_target(fake_ping):
+    start = time.monotonic()
+    results, errors = fleet.run_ping_fleet(["192.0.2.1", "192.0.2.8"], number_of_packets=3, timeout=1)
+    assert time.monotonic() - start < 10
+    assert list(results) == ["192.0.2.1"]
+    assert list(errors) == ["192.0.2.8"]
+
+
+def test_fleet_of_nothing():
+    assert fleet.run_ping_fleet([]) == ({}, {})
+
+
+def test_load_targets(tmp_path):
+    path = tmp_path / "targets.txt"
+    path.write_text("# Gateways\n192.0.2.1\n\n  192.0.2.2  \n#192.0.2.3\nprobe.example.com\n")
+    assert fleet.load_targets(str(path)) == ["192.0.2.1", "192.0.2.2", "probe.example.com"]
+    (tmp_path / "empty.txt").write_text("\n# Nothing yet\n")
+    assert fleet.load_targets(str(tmp_path / "empty.txt")) == []
+
+
+def test_plan_tags_reach_each_target_series(fake_ping, fake_datadog, datadog_client):
+    interval_plan = plan.parse_plan({
+        "defaults": {"number_of_packets": 2, "tags": ["env:prod"]},
+        "targets": [{"host": "192.0.2.1", "tags": ["role:gateway"]}, "192.0.2.2"],
+    }).intervals[60.0]
+    args = argparse.Namespace(max_ping_workers=4)
+    [test] = network_health.build_plan_tests(args, [sink.DatadogSink(datadog_client)], interval_plan)
+    test.on_result(test.func(**test.kwargs))
+
+    tags = {}
+    for _, _, _, body in fake_datadog.posts():
+        for series in json.loads(body)["series"]:
+            if series["metric"] == "network_health.ping_remote.average_latency":
+                tags[series["points"][0]["value"]] = series["tags"]
+    assert tags == {1.0: ["target:192.0.2.1", "env:prod", "role:gateway"], 2.0: ["target:192.0.2.2", "env:prod"]}
@@ -0,0 +1,41 @@
+import pytest
+
+from lib import iperf
+
+
+def report(start: float, end: float, transfer: float, bandwidth: float):
+    return f"[  1] {start:.2f}-{end:.2f} sec  {transfer:g} MBytes  {bandwidth:g} MBytes/sec"
+
+
+def run_with_output(monkeypatch, lines):
+    monkeypatch.setattr(iperf, "stream_lines", lambda command, timeout=None, stderr_lines=None: iter(lines))
+    return iperf.run_iperf("127.0.0.1")
+
+
+@pytest.mark.parametrize("ends", [[1.0], [1.0, 1.5], [1.0, 2.0, 3.0], [0.5]])
+def test_summary_of_short_runs(monkeypatch, ends):
+    lines = ["Client connecting to 127.0.0.1, TCP port 5001"]
+    start = 0.0
+    for end in ends:
+        lines.append(report(start, end, 10, 10 / (end - start)))
+        start = end
+    # The final report is told apart by covering the whole run, not by its length
+    lines.append(report(0, ends[-1], 99, 42))
+    result = run_with_output(monkeypatch, lines)
+    assert result.transfer_value == 99
+    assert result.bandwidth_value == 42
+    assert result.interval_value == ends[-1]
+    assert len(result.intervals) == len(ends)
+
+
+def test_partial_results_without_summary(monkeypatch):
+    result = run_with_output(monkeypatch, [report(0, 1, 10, 10), report(1, 2, 30, 30)])
+    assert result.transfer_value == 40
+    assert result.bandwidth_value == 20
+    assert len(result.intervals) == 2
+
+
+def test_failure_includes_stderr(fake_command):
+    fake_command("iperf", "print('connect failed: Connection refused', file=sys.stderr)\nsys.exit(1)")
+    with pytest.raises(iperf.IperfExecutionFailed, match="Connection refused"):
+        iperf.run_iperf("127.0.0.1", port=1)
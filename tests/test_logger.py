@@ -0,0 +1,33 @@
+import logging
+import os
+import time
+
+from lib import logger as logger_module
+
+
+def test_log_file_rotates_daily(tmp_path, monkeypatch):
+    makedirs = os.makedirs
+
+    def no_system_logs(path, exist_ok=False):
+        if path.startswith("/var/log"):
+            raise PermissionError(path)
+        makedirs(path, exist_ok=exist_ok)
+
+    monkeypatch.setattr(os, "makedirs", no_system_logs)
+    monkeypatch.setattr(os.path, "expanduser", lambda path: str(tmp_path))
+    logger = logger_module.generate_logger("network_health_rotation_test")
+    try:
+        log_dir = tmp_path / ".logs" / "network_health_rotation_test"
+        [file_handler] = [handler for handler in logger.handlers if isinstance(handler, logging.FileHandler)]
+        logger.info("before midnight")
+        # The daemon keeps running past midnight: the day's file is moved aside and a new one started
+        file_handler.rolloverAt = time.time() - 1
+        day = time.strftime("%Y-%m-%d", time.gmtime(file_handler.rolloverAt - file_handler.interval))
+        logger.info("after midnight")
+        assert "before midnight" in (log_dir / f"{day}.log").read_text()
+        current = (log_dir / "network_health_rotation_test.log").read_text()
+        assert "after midnight" in current and "before midnight" not in current
+    finally:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
@@ -0,0 +1,223 @@
+import errno
+import selectors
+import socket
+import sys
+import time
+from collections import deque
+
+import pytest
+
+from lib import path
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="IP_RECVERR is Linux only")
+
+TARGET = "192.0.2.1"
+
+
+class FakeNetwork:
+    """
+    Stands in for the network between the prober and TARGET. Every probe is answered as it is sent, the way an ICMP
+    error socket sees it with IP_RECVERR: the error is queued on the socket's error queue, and the socket's next send
+    fails until the queue is read.
+    """
+
+    def __init__(self, routers: list):
+        """
+        :param routers: list: The address of every router before TARGET, None for a router that does not answer
+        """
+        self.routers = list(routers)
+        self.refused_at = None  # TTL of a router answering host unreachable instead of forwarding
+        self.drop = lambda ttl, attempt: False  # Whether the reply to the given attempt at a TTL is lost
+        self.probes = []  # The TTL of every probe sent, across sockets
+
+    def reply(self, address: str, ttl: int):
+        attempt = self.probes.count(ttl)
+        self.probes.append(ttl)
+        if address != TARGET or self.drop(ttl, attempt):
+            return None
+        if self.refused_at is not None and ttl >= self.refused_at:
+            return path.ICMP_DEST_UNREACHABLE, 1, self.routers[self.refused_at - 1]
+        if ttl <= len(self.routers):
+            router = self.routers[ttl - 1]
+            return (path.ICMP_TIME_EXCEEDED, 0, router) if router is not None else None
+        return path.ICMP_DEST_UNREACHABLE, path.ICMP_PORT_UNREACHABLE, TARGET
+
+    def socket(self, family, kind, *args):
+        return FakeSocket(self)
+
+
+class FakeSocket:
+    def __init__(self, network: FakeNetwork):
+        self.network = network
+        self.ttl = 64
+        self.error_queue = deque()
+        self.pending_error = False
+
+    def setblocking(self, blocking):
+        pass
+
+    def setsockopt(self, level, option, value):
+        if (level, option) == (socket.IPPROTO_IP, socket.IP_TTL):
+            self.ttl = value
+
+    def sendto(self, payload, destination):
+        if self.pending_error:
+            self.pending_error = False
+            raise ConnectionRefusedError(errno.ECONNREFUSED, "Connection refused")
+        reply = self.network.reply(destination[0], self.ttl)
+        if reply is not None:
+            icmp_type, icmp_code, offender = reply
+            data = (path.EXTENDED_ERROR.pack(errno.EHOSTUNREACH, path.SO_EE_ORIGIN_ICMP, icmp_type, icmp_code, 0, 0, 0)
+                    + path.OFFENDER.pack(socket.AF_INET, socket.inet_aton(offender)))
+            self.error_queue.append(([(socket.IPPROTO_IP, path.IP_RECVERR, data)], destination))
+            self.pending_error = True
+        return len(payload)
+
+    def recvmsg(self, bufsize, ancbufsize, flags):
+        assert flags == path.MSG_ERRQUEUE
+        if not self.error_queue:
+            raise BlockingIOError
+        ancillary, destination = self.error_queue.popleft()
+        return path.PROBE_PAYLOAD, ancillary, 0, destination
+
+    def close(self):
+        pass
+
+
+class FakeSelector:
+    """Reports the fake sockets with errors queued as readable."""
+
+    def __init__(self):
+        self.keys = []
+
+    def register(self, fileobj, events, data=None):
+        self.keys.append(selectors.SelectorKey(fileobj, len(self.keys), events, data))
+
+    def select(self, timeout=None):
+        ready = [(key, selectors.EVENT_READ) for key in self.keys if key.fileobj.error_queue]
+        if not ready:
+            time.sleep(min(timeout, 0.005))
+        return ready
+
+    def close(self):
+        pass
+
+
+class ModuleWith:
+    """A module with some of its attributes replaced, so only lib.path sees the fakes."""
+
+    def __init__(self, module, **replacements):
+        self.module = module
+        self.__dict__.update(replacements)
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+@pytest.fixture
+def network(monkeypatch):
+    network = FakeNetwork(["10.0.0.1", "10.0.0.2"])
+    monkeypatch.setattr(path, "socket", ModuleWith(socket, socket=network.socket))
+    monkeypatch.setattr(path, "selectors", ModuleWith(selectors, DefaultSelector=FakeSelector))
+    return network
+
+
+def trace(rounds: int = 3, max_ttl: int = 8, cache: path.PathCache = None):
+    return path.run_path_analysis([TARGET], rounds=rounds, max_ttl=max_ttl, interval=0.01, timeout=0.05, cache=cache,
+                                  mode=path.MODE_RECVERR)
+
+
+def test_every_hop_is_measured(network):
+    results, errors = trace()
+    assert errors == {}
+    result = results[TARGET]
+    assert result.reached and result.hop_count == 3
+    assert [hop.address for hop in result.hops] == ["10.0.0.1", "10.0.0.2", TARGET]
+    for hop in result.hops:
+        assert hop.packet_loss == 0.0
+        assert 0 <= hop.minimum_latency <= hop.average_latency <= hop.max_latency
+    # Every probe of every round is sent, although each reply makes the next send fail until it is read. Once the
+    # target has answered, later rounds stop at it.
+    assert sorted(network.probes) == sorted(list(range(1, 9)) + [1, 2, 3] * 2)
+
+
+def test_silent_and_lossy_hops(network):
+    network.routers[1] = None
+    network.drop = lambda ttl, attempt: ttl == 1 and attempt % 2 == 1
+    results, errors = trace(rounds=4)
+    hops = results[TARGET].hops
+    assert (hops[0].address, hops[0].packet_loss) == ("10.0.0.1", 50.0)
+    assert (hops[1].address, hops[1].packet_loss, hops[1].average_latency) == (None, 100.0, None)
+    assert (hops[2].address, hops[2].packet_loss) == (TARGET, 0.0)
+
+
+def test_router_refusing_to_forward_ends_the_path(network):
+    network.refused_at = 2
+    results, errors = trace()
+    result = results[TARGET]
+    assert not result.reached
+    assert result.hop_count == 2
+    assert [hop.address for hop in result.hops] == ["10.0.0.1", "10.0.0.2"]
+
+
+def test_target_out_of_reach(network):
+    network.routers = ["10.0.0.1"] * 10
+    results, errors = trace(max_ttl=5)
+    # Every hop up to the maximum TTL answered, but the target never did
+    assert not results[TARGET].reached
+    assert results[TARGET].hop_count == 5
+
+
+def test_nothing_answers(network):
+    network.drop = lambda ttl, attempt: True
+    results, errors = trace()
+    assert results == {}
+    assert isinstance(errors[TARGET], path.PathAnalysisUnavailable)
+
+
+def test_known_path_is_only_probed_up_to_the_target(network):
+    cache = path.PathCache()
+    trace(max_ttl=8, cache=cache)
+    assert max(network.probes) == 8
+
+    network.probes.clear()
+    results, _ = trace(max_ttl=8, cache=cache)
+    assert max(network.probes) == 3
+    assert results[TARGET].hop_count == 3
+
+    # The route changes: the path is probed in full again on the run after the change is seen
+    network.routers[1] = "10.0.1.2"
+    trace(max_ttl=8, cache=cache)
+    network.probes.clear()
+    results, _ = trace(max_ttl=8, cache=cache)
+    assert max(network.probes) == 8
+    assert results[TARGET].hops[1].address == "10.0.1.2"
+
+
+def test_expired_path_is_rediscovered(network):
+    clock = [0.0]
+    cache = path.PathCache(ttl=600, clock=lambda: clock[0])
+    trace(cache=cache)
+    clock[0] += 600
+    network.probes.clear()
+    trace(cache=cache)
+    assert max(network.probes) == 8
+
+
+@linux_only
+def test_trace_loopback():
+    results, errors = path.run_path_analysis(["127.0.0.1"], rounds=5, interval=0.05, timeout=0.5,
+                                             cache=path.PathCache(), mode=path.MODE_RECVERR)
+    assert errors == {}
+    result = results["127.0.0.1"]
+    assert result.reached
+    assert result.hop_count == 1
+    assert result.hops[0].address == "127.0.0.1"
+    assert result.hops[0].packet_loss == 0.0
+
+
+def test_unresolvable_target():
+    results, errors = path.run_path_analysis(["no-such-host.invalid"], rounds=1, interval=0.05, timeout=0.1,
+                                             mode=path.MODE_RECVERR)
+    assert results == {}
+    assert list(errors) == ["no-such-host.invalid"]
@@ -0,0 +1,215 @@
+import json
+
+import pytest
+
+from lib import plan
+
+PLAN = {
+    "defaults": {"number_of_packets": 20, "interval": 60, "tags": ["env:prod"]},
+    "targets": [
+        {"host": "192.168.1.1", "local": True, "interval": 15, "tags": ["role:gateway"]},
+        {"host": "8.8.8.8", "timeout": 30},
+        "1.1.1.1",
+        {"host": "probe.example.com", "test": "iperf", "native": True, "port": 5301, "streams": 4, "interval": 900},
+    ],
+}
+
+PLAN_TOML = """
+[defaults]
+number_of_packets = 20
+interval = 60
+tags = ["env:prod"]
+
+[[targets]]
+host = "192.168.1.1"
+local = true
+interval = 15
+tags = ["role:gateway"]
+
+[[targets]]
+host = "8.8.8.8"
+timeout = 30
+
+[[targets]]
+host = "1.1.1.1"
+
+[[targets]]
+host = "probe.example.com"
+test = "iperf"
+native = true
+port = 5301
+streams = 4
+interval = 900
+"""
+
+PLAN_YAML = """
+defaults:
+  number_of_packets: 20
+  interval: 60
+  tags: [env:prod]
+targets:
+  - host: 192.168.1.1
+    local: true
+    interval: 15
+    tags: [role:gateway]
+  - host: 8.8.8.8
+    timeout: 30
+  - 1.1.1.1
+  - host: probe.example.com
+    test: iperf
+    native: true
+    port: 5301
+    streams: 4
+    interval: 900
+"""
+
+
+def check_example_plan(test_plan):
+    gateway, google, cloudflare, probe = test_plan.targets
+    assert (gateway.host, gateway.local, gateway.interval, gateway.number_of_packets) == ("192.168.1.1", True, 15, 20)
+    assert gateway.tags == ["env:prod", "role:gateway"]
+    assert (google.timeout, google.interval, google.tags) == (30.0, 60.0, ["env:prod"])
+    assert (cloudflare.host, cloudflare.number_of_packets, cloudflare.timeout) == ("1.1.1.1", 20, None)
+    assert (probe.test, probe.native, probe.port, probe.streams, probe.interval) == ("iperf", True, 5301, 4, 900.0)
+    assert sorted(test_plan.intervals) == [15.0, 60.0, 900.0]
+    # Pings that share their settings are one fleet; a different timeout makes a group of its own
+    assert [[target.host for target in targets] for targets in test_plan.intervals[60.0].ping_groups.values()] == [
+        ["8.8.8.8"], ["1.1.1.1"]]
+    assert test_plan.intervals[900.0].bandwidth_targets == [probe]
+    assert len(test_plan) == 4
+
+
+def test_parse_plan():
+    check_example_plan(plan.parse_plan(PLAN))
+
+
+@pytest.mark.parametrize("extension, content", [
+    (".json", json.dumps(PLAN)),
+    (".toml", PLAN_TOML),
+    (".yaml", PLAN_YAML),
+    (".yml", PLAN_YAML),
+])
+def test_load_plan(tmp_path, extension, content):
+    if extension in (".yaml", ".yml"):
+        pytest.importorskip("yaml")
+    path = tmp_path / f"plan{extension}"
+    path.write_text(content)
+    test_plan = plan.load_plan(str(path))
+    assert test_plan.source == str(path)
+    check_example_plan(test_plan)
+
+
+def test_defaults_of_a_bare_target():
+    [ping_target, iperf_target] = plan.parse_plan({"targets": ["192.0.2.1", {"host": "192.0.2.2",
+                                                                           "test": "iperf"}]}).targets
+    assert ping_target.test == plan.TEST_PING
+    assert ping_target.interval == plan.DEFAULT_INTERVALS[plan.TEST_PING]
+    assert ping_target.number_of_packets == plan.DEFAULT_NUMBER_OF_PACKETS
+    assert (ping_target.local, ping_target.native, ping_target.timeout, ping_target.tags) == (False, False, None, [])
+    assert iperf_target.interval == plan.DEFAULT_INTERVALS[plan.TEST_IPERF]
+
+
+@pytest.mark.parametrize("fields, expected", [
+    ({"host": " 192.0.2.1 "}, {"host": "192.0.2.1"}),
+    ({"test": "iperf"}, {"test": "iperf"}),
+    ({"local": True, "native": False, "sendfile": True}, {"local": True, "native": False, "sendfile": True}),
+    ({"number_of_packets": 5, "streams": 2}, {"number_of_packets": 5, "streams": 2}),
+    ({"interval": 30, "duration": 2.5}, {"interval": 30.0, "duration": 2.5}),
+    ({"timeout": 10}, {"timeout": 10.0}),
+    ({"timeout": None, "port": None}, {"timeout": None, "port": None}),
+    ({"port": 65535}, {"port": 65535}),
+    ({"tags": ["env:prod", "team"]}, {"tags": ["env:prod", "team"]}),
+    ({}, {}),
+])
+def test_validate_fields(fields, expected):
+    checked = plan._validate_fields(fields, "targets[0]")
+    assert checked == expected
+    assert [type(value) for value in checked.values()] == [type(value) for value in expected.values()]
+
+
+@pytest.mark.parametrize("fields, message", [
+    (["192.0.2.1"], "targets[0] must be a mapping, not list"),
+    ({"hots": "192.0.2.1", "color": "red"}, "targets[0] has unknown setting(s): color, hots"),
+    ({"host": ""}, "targets[0].host must be a host name or address"),
+    ({"host": "  "}, "targets[0].host must be a host name or address"),
+    ({"host": 42}, "targets[0].host must be a host name or address"),
+    ({"test": "traceroute"}, "targets[0].test must be one of ping, iperf"),
+    ({"local": "yes"}, "targets[0].local must be true or false"),
+    ({"native": 1}, "targets[0].native must be true or false"),
+    ({"sendfile": None}, "targets[0].sendfile must be true or false"),
+    ({"number_of_packets": 0}, "targets[0].number_of_packets must be a positive integer"),
+    ({"number_of_packets": 2.5}, "targets[0].number_of_packets must be a positive integer"),
+    ({"number_of_packets": True}, "targets[0].number_of_packets must be a positive integer"),
+    ({"streams": -1}, "targets[0].streams must be a positive integer"),
+    ({"interval": 0}, "targets[0].interval must be a positive number"),
+    ({"interval": "60"}, "targets[0].interval must be a positive number"),
+    ({"duration": -2.5}, "targets[0].duration must be a positive number"),
+    ({"timeout": 0}, "targets[0].timeout must be a positive number"),
+    ({"timeout": False}, "targets[0].timeout must be a positive number"),
+    ({"port": 0}, "targets[0].port must be a port number"),
+    ({"port": 65536}, "targets[0].port must be a port number"),
+    ({"port": "5201"}, "targets[0].port must be a port number"),
+    ({"port": True}, "targets[0].port must be a port number"),
+    ({"tags": "env:prod"}, "targets[0].tags must be a list of tags"),
+    ({"tags": ["env:prod", ""]}, "targets[0].tags must be a list of tags"),
+    ({"tags": [1]}, "targets[0].tags must be a list of tags"),
+])
+def test_validate_fields_rejects(fields, message):
+    with pytest.raises(plan.TestPlanError) as error:
+        plan._validate_fields(fields, "targets[0]")
+    assert str(error.value).startswith(message)
+
+
+@pytest.mark.parametrize("document, message", [
+    (["192.0.2.1"], "plan: a plan must be a mapping with a `targets` list"),
+    ({"targets": ["192.0.2.1"], "target": []}, "plan: unknown section(s): target"),
+    ({}, "plan: targets must be a non-empty list"),
+    ({"targets": []}, "plan: targets must be a non-empty list"),
+    ({"targets": "192.0.2.1"}, "plan: targets must be a non-empty list"),
+    ({"defaults": {"host": "192.0.2.1"}, "targets": ["192.0.2.2"]}, "plan: defaults can not set a host"),
+    ({"defaults": {"interval": -1}, "targets": ["192.0.2.1"]}, "plan: defaults.interval must be a positive number"),
+    ({"defaults": [], "targets": ["192.0.2.1"]}, "plan: defaults must be a mapping"),
+    ({"targets": [{"local": True}]}, "plan: targets[0] has no host"),
+    ({"targets": ["192.0.2.1", {"host": "192.0.2.2", "port": 0}]}, "plan: targets[1].port must be a port number"),
+    ({"targets": ["192.0.2.1", 7]}, "plan: targets[1] must be a mapping, not int"),
+])
+def test_parse_plan_rejects(document, message):
+    with pytest.raises(plan.TestPlanError) as error:
+        plan.parse_plan(document)
+    assert str(error.value).startswith(message)
+
+
+@pytest.mark.parametrize("name, content, message", [
+    ("plan.json", '{"targets": [', "Expecting value"),
+    ("plan.toml", "targets = [", ""),
+    ("plan.txt", "192.0.2.1", "unknown plan format"),
+    ("plan.json", '{"targets": [{"host": "192.0.2.1", "interval": 0}]}',
+     "targets[0].interval must be a positive number"),
+])
+def test_load_plan_rejects(tmp_path, name, content, message):
+    path = tmp_path / name
+    path.write_text(content)
+    with pytest.raises(plan.TestPlanError) as error:
+        plan.load_plan(str(path))
+    assert str(error.value).startswith(f"{path}: {message}")
+
+
+def test_load_plan_rejects_invalid_yaml(tmp_path):
+    pytest.importorskip("yaml")
+    path = tmp_path / "plan.yaml"
+    path.write_text("targets: [192.0.2.1")
+    with pytest.raises(plan.TestPlanError, match="plan.yaml"):
+        plan.load_plan(str(path))
+
+
+def test_load_plan_rejects_missing_file(tmp_path):
+    with pytest.raises(plan.TestPlanError, match="No such file or directory"):
+        plan.load_plan(str(tmp_path / "missing.json"))
+
+
+def test_yaml_needs_pyyaml(tmp_path, monkeypatch):
+    monkeypatch.setattr(plan, "yaml", None)
+    path = tmp_path / "plan.yaml"
+    path.write_text(PLAN_YAML)
+    with pytest.raises(plan.TestPlanError, match="pip install pyyaml"):
+        plan.load_plan(str(path))
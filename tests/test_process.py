@@ -0,0 +1,31 @@
+import pytest
+
+from lib import ping, process
+
+
+def test_stderr_is_captured(fake_command):
+    command = fake_command("chatty", "for i in range(100000):\n    print(f'warning {i}', file=sys.stderr)\n"
+                                     "print('done')\nsys.exit(1)")
+    stderr_lines = []
+    assert list(process.stream_lines([command], timeout=10, stderr_lines=stderr_lines)) == ["done"]
+    assert len(stderr_lines) == process.DEFAULT_STDERR_LINES
+    assert stderr_lines[-1] == "warning 99999"
+
+
+def test_timeout_includes_stderr(fake_command):
+    command = fake_command("stuck", "import time\nprint('starting', file=sys.stderr, flush=True)\ntime.sleep(30)")
+    with pytest.raises(process.ProcessTimedOut, match="starting"):
+        list(process.stream_lines([command], timeout=0.5, stderr_lines=[]))
+
+
+def test_ping_failure_includes_stderr(fake_command):
+    fake_command("ping", "print('ping: connect: Network is unreachable', file=sys.stderr)\nsys.exit(2)")
+    with pytest.raises(ping.PingExecutionFailed, match="Network is unreachable"):
+        ping.run_ping("192.0.2.1", number_of_packets=3)
+
+
+def test_ping_without_replies_or_stderr_fails_to_parse(fake_command):
+    fake_command("ping", "print('--- 192.0.2.1 ping statistics ---')\n"
+                         "print('3 packets transmitted, 0 received, 100% packet loss, time 2040ms')\nsys.exit(1)")
+    with pytest.raises(ping.FailedToParsePing):
+        ping.run_ping("192.0.2.1", number_of_packets=3)
@@ -0,0 +1,94 @@
+from array import array
+
+import pytest
+import requests
+
+from lib import prometheus
+from lib.results import IperfResult, PingResult
+
+
+@pytest.fixture
+def exporter():
+    exporter = prometheus.PrometheusExporter(host="127.0.0.1", port=0)
+    yield exporter
+    exporter.close()
+
+
+def scrape(exporter):
+    response = requests.get(f"http://127.0.0.1:{exporter.port}{prometheus.METRICS_PATH}", timeout=5)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == prometheus.CONTENT_TYPE
+    return response.text
+
+
+def samples(body):
+    """Parses the exposition format into a dictionary of sample, with its labels, to value."""
+    parsed = {}
+    for line in body.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            parsed[name] = float(value)
+    return parsed
+
+
+def test_nothing_to_report_yet(exporter):
+    assert scrape(exporter) == ""
+
+
+def test_unknown_path(exporter):
+    assert requests.get(f"http://127.0.0.1:{exporter.port}/", timeout=5).status_code == 404
+
+
+def test_ping_gauges(exporter):
+    exporter.submit_ping(PingResult(packet_loss=0.0, average_latency=12.5, p99_latency=None), local=True)
+    body = scrape(exporter)
+    assert "# HELP network_health_ping_local_average_latency The average_latency of the latest ping_local test, in " \
+           "millisecond(s)\n# TYPE network_health_ping_local_average_latency gauge\n" in body
+    assert samples(body) == {"network_health_ping_local_packet_loss": 0.0,
+                             "network_health_ping_local_average_latency": 12.5}
+
+    # A gauge holds the latest value only
+    exporter.submit_ping(PingResult(packet_loss=10.0, average_latency=20.0), local=True)
+    assert samples(scrape(exporter))["network_health_ping_local_average_latency"] == 20.0
+
+
+def test_rtt_histogram(exporter):
+    family = "network_health_ping_remote_rtt_milliseconds"
+    # On a boundary counts into that bucket, as `le` means less than or equal
+    exporter.submit_ping(PingResult(average_latency=1.0, rtts=array("d", [0.4, 1.0, 3.0, 3000.0])), local=False)
+    body = scrape(exporter)
+    assert f"# TYPE {family} histogram\n" in body
+    parsed = samples(body)
+    buckets = {bound: parsed[f'{family}_bucket{{le="{bound}"}}'] for bound in prometheus.LATENCY_BUCKETS + ("+Inf",)}
+    assert buckets == {0.5: 1, 1.0: 2, 2.5: 2, 5.0: 3, 10.0: 3, 25.0: 3, 50.0: 3, 100.0: 3, 250.0: 3, 500.0: 3,
+                       1000.0: 3, 2500.0: 3, "+Inf": 4}
+    assert parsed[f"{family}_sum"] == pytest.approx(3004.4)
+    assert parsed[f"{family}_count"] == 4
+
+    # Unlike the gauges, the histogram keeps counting across runs
+    exporter.submit_ping(PingResult(average_latency=1.0, rtts=array("d", [0.1])), local=False)
+    parsed = samples(scrape(exporter))
+    assert parsed[f'{family}_bucket{{le="0.5"}}'] == 2
+    assert parsed[f"{family}_count"] == 5
+
+
+def test_fleet_and_bandwidth_labels(exporter):
+    exporter.submit_ping_fleet({"8.8.8.8": PingResult(average_latency=10.0, rtts=array("d", [10.0])),
+                                'odd"host\\': PingResult(average_latency=20.0)}, local=False)
+    exporter.submit_bandwidth(IperfResult(bandwidth_value=94.5), local=True, target="192.0.2.1")
+    parsed = samples(scrape(exporter))
+    assert parsed['network_health_ping_remote_average_latency{target="8.8.8.8"}'] == 10.0
+    assert parsed['network_health_ping_remote_average_latency{target="odd\\"host\\\\"}'] == 20.0
+    assert parsed['network_health_ping_remote_rtt_milliseconds_bucket{target="8.8.8.8",le="10.0"}'] == 1
+    assert parsed['network_health_ping_remote_rtt_milliseconds_count{target="8.8.8.8"}'] == 1
+    assert parsed['network_health_bandwidth_local_bandwidth_value{target="192.0.2.1"}'] == 94.5
+
+
+def test_families_are_sorted_and_declared_once(exporter):
+    exporter.submit_ping_fleet({"b": PingResult(jitter=1.0), "a": PingResult(jitter=2.0)}, local=False)
+    exporter.submit_ping(PingResult(jitter=3.0), local=True)
+    lines = scrape(exporter).splitlines()
+    families = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+    assert families == sorted(families) == ["network_health_ping_local_jitter", "network_health_ping_remote_jitter"]
+    assert lines[-2:] == ['network_health_ping_remote_jitter{target="b"} 1.0',
+                          'network_health_ping_remote_jitter{target="a"} 2.0']
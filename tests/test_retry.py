@@ -0,0 +1,170 @@
+import pytest
+import requests
+
+from lib import datadog
+from lib.retry import CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, RetryPolicy
+from lib.tracing import tracer
+
+SERIES = [{"metric": "network_health.test", "type": 3, "points": [{"timestamp": 0, "value": 1.0}]}]
+
+
+class FakeClock:
+    """Stands in for time.sleep and time.monotonic, so backoffs and cool downs take no real time."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def use_policy(client, clock, **kwargs):
+    client.retry_policy = RetryPolicy(sleep=clock.sleep, clock=clock, **kwargs)
+    return client.retry_policy
+
+
+def counts(stats, name):
+    return stats[name].total if name in stats else 0
+
+
+def test_retry_after_is_waited_for(fake_datadog, datadog_client, clock):
+    use_policy(datadog_client, clock)
+    fake_datadog.respond(429, {"Retry-After": "3"})
+    datadog_client.submit_series(SERIES)
+    assert clock.sleeps == [3.0]
+    assert len(fake_datadog.posts()) == 2
+
+
+def test_rate_limit_reset_is_waited_for(fake_datadog, clock):
+    policy = RetryPolicy(sleep=clock.sleep, clock=clock)
+    fake_datadog.respond(429, {"X-RateLimit-Reset": "2"})
+    with requests.Session() as session:
+        response, succeeded = policy.call(lambda: session.post(f"{fake_datadog.url}/v2/series", data=b"{}"))
+    assert succeeded and response.status_code == 202
+    assert clock.sleeps == [2.0]
+
+
+def test_retry_after_longer_than_max_delay_gives_up(fake_datadog, datadog_client, clock):
+    use_policy(datadog_client, clock, max_delay=10.0)
+    fake_datadog.respond(429, {"Retry-After": "60"})
+    with pytest.raises(datadog.DatadogFailedMetricsUpdate):
+        datadog_client.submit_series(SERIES)
+    assert clock.sleeps == []
+    assert len(fake_datadog.posts()) == 1
+
+
+def test_server_errors_back_off_exponentially(fake_datadog, datadog_client, clock):
+    use_policy(datadog_client, clock, base_delay=1.0, max_delay=30.0)
+    for _ in range(3):
+        fake_datadog.respond(503)
+    tracer.drain()
+    datadog_client.submit_series(SERIES)
+    assert len(fake_datadog.posts()) == 4
+    assert len(clock.sleeps) == 3
+    for attempt, delay in enumerate(clock.sleeps, start=1):
+        assert 0 <= delay <= 2 ** (attempt - 1)
+    assert counts(tracer.drain(), "retry.retries") == 3
+    assert datadog_client.retry_policy.state == CIRCUIT_CLOSED
+
+
+def test_forbidden_is_not_retried(fake_datadog, datadog_client, clock):
+    policy = use_policy(datadog_client, clock)
+    fake_datadog.respond(403)
+    with pytest.raises(datadog.DatadogAuthenticationError):
+        datadog_client.submit_series(SERIES)
+    assert len(fake_datadog.posts()) == 1
+    assert clock.sleeps == []
+    assert policy.consecutive_failures == 0
+
+
+@pytest.mark.parametrize("status", [400, 404, 413])
+def test_client_errors_are_not_retried(fake_datadog, datadog_client, clock, status):
+    policy = use_policy(datadog_client, clock)
+    fake_datadog.respond(status)
+    with pytest.raises(datadog.DatadogFailedMetricsUpdate):
+        datadog_client.submit_series(SERIES)
+    assert len(fake_datadog.posts()) == 1
+    assert clock.sleeps == []
+    # A rejected payload says nothing about the health of the server
+    assert policy.consecutive_failures == 0
+
+
+def test_retry_budget_is_shared_across_a_cycle(fake_datadog, clock):
+    policy = RetryPolicy(retry_budget=3, failure_threshold=100, sleep=clock.sleep, clock=clock)
+    fake_datadog.default_status = 503
+    tracer.drain()
+    with requests.Session() as session:
+        send = lambda: session.post(f"{fake_datadog.url}/v2/series", data=b"{}")  # noqa: E731
+        response, succeeded = policy.call(send)
+        assert not succeeded and response.status_code == 503
+        response, succeeded = policy.call(send)
+        assert not succeeded
+        assert len(fake_datadog.posts()) == 5  # 1 + 3 retries, then 1 with the budget exhausted
+        assert counts(tracer.drain(), "retry.budget_exhausted") == 2
+
+        policy.start_cycle()
+        policy.call(send)
+    assert len(fake_datadog.posts()) == 9
+
+
+def test_retry_budget_exhaustion_fails_the_submission(fake_datadog, datadog_client, clock):
+    use_policy(datadog_client, clock, retry_budget=2, failure_threshold=100)
+    fake_datadog.default_status = 503
+    with pytest.raises(datadog.DatadogFailedMetricsUpdate, match="1/1"):
+        datadog_client.submit_series(SERIES)
+    assert len(fake_datadog.posts()) == 3
+    assert len(clock.sleeps) == 2
+
+
+def test_circuit_opens_and_recovers_after_a_trial_request(fake_datadog, datadog_client, clock):
+    policy = use_policy(datadog_client, clock, max_attempts=1, failure_threshold=2, reset_timeout=60.0)
+    fake_datadog.default_status = 503
+    with pytest.raises(datadog.DatadogFailedMetricsUpdate):
+        datadog_client.submit_series(SERIES)
+    assert policy.state == CIRCUIT_OPEN
+    assert len(fake_datadog.posts()) == 2
+
+    # While open, nothing is sent
+    tracer.drain()
+    with pytest.raises(datadog.DatadogFailedMetricsUpdate):
+        datadog_client.submit_series(SERIES)
+    assert len(fake_datadog.posts()) == 2
+    assert counts(tracer.drain(), "retry.circuit_rejected") == 1
+
+    # After the cool down a single trial request is let through, and its success closes the circuit
+    clock.now += 60.0
+    fake_datadog.default_status = 202
+    assert policy.allow_request()
+    assert policy.state == CIRCUIT_HALF_OPEN
+    datadog_client.submit_series(SERIES)
+    assert policy.state == CIRCUIT_CLOSED
+    assert policy.consecutive_failures == 0
+    assert len(fake_datadog.posts()) == 3
+
+
+def test_failed_trial_request_reopens_the_circuit(fake_datadog, datadog_client, clock):
+    policy = use_policy(datadog_client, clock, failure_threshold=2, reset_timeout=60.0)
+    fake_datadog.default_status = 503
+    with pytest.raises(datadog.DatadogFailedMetricsUpdate):
+        datadog_client.submit_series(SERIES)
+    assert policy.state == CIRCUIT_OPEN
+    posts = len(fake_datadog.posts())
+
+    clock.now += 60.0
+    trial_at = clock.now
+    with pytest.raises(datadog.DatadogFailedMetricsUpdate):
+        datadog_client.submit_series(SERIES)
+    # The trial fails and the circuit opens again at once, so its retry is refused without being sent
+    assert policy.state == CIRCUIT_OPEN
+    assert len(fake_datadog.posts()) == posts + 1
+    assert policy.opened_at == trial_at
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from lib import runner
+
+
+class Recorder:
+    """Records when each test ran, so overlaps between phases can be checked."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def test(self, name: str, phase: str, seconds: float):
+        def func():
+            start = time.monotonic()
+            time.sleep(seconds)
+            with self.lock:
+                self.spans.append((phase, start, time.monotonic()))
+            return name
+        return runner.NetworkTest(name, func, phase=phase)
+
+
+def overlaps(first, second):
+    return first[1] < second[2] and second[1] < first[2]
+
+
+def run_in_threads(*runs):
+    threads = [threading.Thread(target=run) for run in runs]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)  # Start in order
+    for thread in threads:
+        thread.join(10)
+
+
+def test_phases_run_in_order():
+    recorder = Recorder()
+    tests = [recorder.test("iperf", runner.PHASE_BANDWIDTH, 0.05), recorder.test("ping a", runner.PHASE_LATENCY, 0.1),
+             recorder.test("ping b", runner.PHASE_LATENCY, 0.1)]
+    results, errors = runner.run_tests_concurrently(tests)
+    assert errors == {} and sorted(results) == ["iperf", "ping a", "ping b"]
+    latency = [span for span in recorder.spans if span[0] == runner.PHASE_LATENCY]
+    bandwidth = [span for span in recorder.spans if span[0] == runner.PHASE_BANDWIDTH]
+    assert overlaps(latency[0], latency[1])
+    assert all(span[2] <= bandwidth[0][1] for span in latency)
+
+
+def test_gate_keeps_overlapping_runs_apart():
+    recorder = Recorder()
+    gate = runner.PhaseGate()
+    run_in_threads(
+        lambda: runner.run_tests_concurrently([recorder.test("ping", runner.PHASE_LATENCY, 0.3)], gate=gate),
+        lambda: runner.run_tests_concurrently([recorder.test("iperf", runner.PHASE_BANDWIDTH, 0.3)], gate=gate),
+        # Due while the bandwidth phase waits, so it is held back until that phase is done
+        lambda: runner.run_tests_concurrently([recorder.test("late ping", runner.PHASE_LATENCY, 0.1)], gate=gate))
+    assert len(recorder.spans) == 3
+    for index, span in enumerate(recorder.spans):
+        for other in recorder.spans[index + 1:]:
+            if runner.PHASE_BANDWIDTH in (span[0], other[0]):
+                assert not overlaps(span, other)
+    assert [span[0] for span in recorder.spans] == [runner.PHASE_LATENCY, runner.PHASE_BANDWIDTH,
+                                                    runner.PHASE_LATENCY]
+
+
+def test_latency_runs_share_the_gate():
+    recorder = Recorder()
+    gate = runner.PhaseGate()
+    run_in_threads(
+        lambda: runner.run_tests_concurrently([recorder.test("ping a", runner.PHASE_LATENCY, 0.3)], gate=gate),
+        lambda: runner.run_tests_concurrently([recorder.test("ping b", runner.PHASE_LATENCY, 0.3)], gate=gate))
+    assert overlaps(recorder.spans[0], recorder.spans[1])
@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+
+from lib import scheduler
+
+
+class FakeClock:
+    """Stands in for time.monotonic, so the schedule only moves when a test advances it."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def job_scheduler(clock):
+    job_scheduler = scheduler.Scheduler(clock=clock)
+    yield job_scheduler
+    job_scheduler.executor.shutdown(wait=True)
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_jobs_run_on_their_interval(job_scheduler, clock):
+    job = job_scheduler.add_job("test", lambda: None, interval=60)
+    assert job_scheduler.run_pending() == clock.now + 60
+    wait_for(lambda: job.runs == 1)
+
+    clock.now += 59
+    job_scheduler.run_pending()
+    clock.now += 1
+    job_scheduler.run_pending()
+    wait_for(lambda: job.runs == 2)
+    assert job.skipped == 0
+
+
+def test_run_immediately(job_scheduler, clock):
+    job = job_scheduler.add_job("test", lambda: None, interval=60, run_immediately=False)
+    assert job.next_run == clock.now + 60
+    assert job_scheduler.run_pending() == clock.now + 60
+    assert job.runs == 0 and not job.running
+
+
+def test_running_job_skips_its_slot(job_scheduler, clock):
+    release = threading.Event()
+    job = job_scheduler.add_job("slow", release.wait, interval=60)
+    job_scheduler.run_pending()
+    assert job.running
+
+    # Two slots pass while the first run is still going; neither starts a second run
+    clock.now += 60
+    job_scheduler.run_pending()
+    clock.now += 60
+    assert job_scheduler.run_pending() == clock.now + 60
+    assert job.skipped == 2
+    assert job.runs == 0
+
+    release.set()
+    wait_for(lambda: job.runs == 1)
+    clock.now += 60
+    job_scheduler.run_pending()
+    wait_for(lambda: job.runs == 2)
+    assert job.skipped == 2
+
+
+def test_slots_missed_while_running_are_not_made_up(job_scheduler, clock):
+    job = job_scheduler.add_job("test", lambda: None, interval=60)
+    job_scheduler.run_pending()
+    wait_for(lambda: job.runs == 1)
+    # The scheduler was held up for three and a half intervals: the job runs once and stays on its cadence
+    clock.now += 210
+    assert job_scheduler.run_pending() == clock.now + 30
+    wait_for(lambda: job.runs == 2)
+
+
+def test_jitter_delays_runs_without_drifting(job_scheduler, clock, monkeypatch):
+    monkeypatch.setattr(scheduler.random, "uniform", lambda low, high: high)
+    start = clock.now
+    job = job_scheduler.add_job("test", lambda: None, interval=60, jitter=5)
+    assert job.next_run == start + 5
+    for run in range(1, 4):
+        clock.now = job.next_run
+        job_scheduler.run_pending()
+        # Every run is jittered from its own slot, so the delays do not add up
+        assert job.next_run == start + 60 * run + 5
+        wait_for(lambda: job.runs == run)
+
+
+def test_jitter_is_bounded(job_scheduler, clock):
+    jobs = [job_scheduler.add_job(f"test {index}", lambda: None, interval=60, jitter=5) for index in range(50)]
+    assert all(clock.now <= job.next_run <= clock.now + 5 for job in jobs)
+
+
+def test_remove_job(job_scheduler, clock):
+    calls = []
+    kept = job_scheduler.add_job("kept", lambda: calls.append("kept"), interval=30)
+    removed = job_scheduler.add_job("removed", lambda: calls.append("removed"), interval=10)
+    job_scheduler.remove_job(removed)
+    assert job_scheduler.run_pending() == clock.now + 30
+    wait_for(lambda: kept.runs == 1)
+    assert calls == ["kept"]
+
+    job_scheduler.remove_job(kept)
+    job_scheduler.remove_job(kept)  # Removing a job twice is harmless
+    assert job_scheduler.run_pending() is None
+
+
+def test_failing_job_keeps_its_schedule(job_scheduler, clock):
+    def fail():
+        raise RuntimeError("boom")
+
+    job = job_scheduler.add_job("failing", fail, interval=60)
+    job_scheduler.run_pending()
+    wait_for(lambda: job.runs == 1)
+    assert not job.running
+    clock.now += 60
+    job_scheduler.run_pending()
+    wait_for(lambda: job.runs == 2)
+
+
+def test_run_forever_until_stopped():
+    job_scheduler = scheduler.Scheduler()
+    ran = threading.Event()
+    job_scheduler.add_job("test", ran.set, interval=3600)
+    thread = threading.Thread(target=job_scheduler.run_forever)
+    thread.start()
+    assert ran.wait(5)
+    job_scheduler.stop()
+    thread.join(5)
+    assert not thread.is_alive()
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+from lib import sender, spool
+
+
+class BlockedClient:
+    """Stands in for DatadogClient. Every delivery waits until the test releases it, so the queue fills up."""
+
+    class RetryPolicy:
+        def start_cycle(self):
+            pass
+
+    def __init__(self, metric_spool=None):
+        self.spool = metric_spool
+        self.retry_policy = self.RetryPolicy()
+        self.release = threading.Event()
+        self.delivered = []
+
+    def deliver_series(self, series):
+        self.release.wait(10)
+        self.delivered.append(series)
+        return len(series)
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def start_sender(client, policy, max_queue_size=2):
+    background_sender = sender.BackgroundSender(client, max_queue_size=max_queue_size, policy=policy)
+    # The first batch is taken off the queue and held up in its delivery
+    background_sender.enqueue([b"first"])
+    wait_for(lambda: background_sender.busy)
+    return background_sender
+
+
+def test_drop_oldest():
+    client = BlockedClient()
+    background_sender = start_sender(client, sender.POLICY_DROP_OLDEST)
+    for batch in [[b"a1", b"a2"], [b"b"], [b"c"]]:
+        background_sender.enqueue(batch)
+    assert list(background_sender.queue) == [[b"b"], [b"c"]]
+    assert background_sender.dropped == 2
+
+    client.release.set()
+    assert background_sender.close(timeout=5)
+    assert client.delivered == [[b"first"], [b"b"], [b"c"]]
+
+
+def test_block():
+    client = BlockedClient()
+    background_sender = start_sender(client, sender.POLICY_BLOCK)
+    background_sender.enqueue([b"a"])
+    background_sender.enqueue([b"b"])
+    blocked = threading.Thread(target=background_sender.enqueue, args=([b"c"],))
+    blocked.start()
+    time.sleep(0.2)
+    assert blocked.is_alive()
+    assert list(background_sender.queue) == [[b"a"], [b"b"]]
+
+    # Once a delivery finishes there is room, and the caller gets through without anything being dropped
+    client.release.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    assert background_sender.close(timeout=5)
+    assert client.delivered == [[b"first"], [b"a"], [b"b"], [b"c"]]
+    assert background_sender.dropped == 0
+
+
+def test_spill(tmp_path):
+    client = BlockedClient(spool.MetricSpool(str(tmp_path)))
+    background_sender = start_sender(client, sender.POLICY_SPILL)
+    background_sender.enqueue([b"a"])
+    background_sender.enqueue([b"b"])
+    background_sender.enqueue([b"c1", b"c2"])
+    assert list(background_sender.queue) == [[b"a"], [b"b"]]
+    client.spool.seal()
+    assert [spool.MetricSpool.read_segment(path) for path in client.spool.segments()] == [[b"c1", b"c2"]]
+
+    client.release.set()
+    assert background_sender.close(timeout=5)
+    assert client.delivered == [[b"first"], [b"a"], [b"b"]]
+    assert background_sender.dropped == 0
+
+
+def test_spill_needs_a_spool():
+    with pytest.raises(ValueError):
+        sender.BackgroundSender(BlockedClient(), policy=sender.POLICY_SPILL)
+
+
+@pytest.mark.parametrize("with_spool", [True, False])
+def test_close_deadline_keeps_or_drops_what_is_left(tmp_path, with_spool):
+    client = BlockedClient(spool.MetricSpool(str(tmp_path)) if with_spool else None)
+    background_sender = start_sender(client, sender.POLICY_DROP_OLDEST)
+    background_sender.enqueue([b"a"])
+    assert not background_sender.close(timeout=0.2)
+    if with_spool:
+        client.spool.seal()
+        assert [spool.MetricSpool.read_segment(path) for path in client.spool.segments()] == [[b"a"]]
+        assert background_sender.dropped == 0
+    else:
+        assert background_sender.dropped == 1
+    with pytest.raises(RuntimeError):
+        background_sender.enqueue([b"b"])
+    client.release.set()
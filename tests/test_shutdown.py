@@ -0,0 +1,42 @@
+import argparse
+import json
+
+import network_health
+from lib import sink
+from lib.results import PingResult
+from lib.tracing import tracer
+
+
+def series_names(fake_datadog):
+    names = []
+    for _, _, _, body in fake_datadog.posts():
+        names.extend(series["metric"] for series in json.loads(body)["series"])
+    return names
+
+
+def test_final_send_is_reported_before_exit(fake_datadog, datadog_client):
+    # A one-shot run: results go out through the background sender, and there is no next cycle to report its timings
+    tracer.drain()
+    datadog_client.batch = True
+    datadog_client.start_background_sender()
+    datadog_sink = sink.DatadogSink(datadog_client)
+    args = argparse.Namespace(shutdown_timeout=5.0, disable_self_metrics=False)
+    datadog_sink.submit_ping(PingResult(packet_loss=0.0, average_latency=1.0))
+    assert network_health.flush_sinks([datadog_sink]) == {}
+
+    assert network_health.shut_down(args, [datadog_sink]) == {}
+    names = series_names(fake_datadog)
+    assert "network_health.ping_local.average_latency" in names
+    assert "network_health.self.datadog.request.avg" in names
+    assert "network_health.self.datadog.submit.count" in names
+    assert len(fake_datadog.posts()) == 2
+
+
+def test_self_metrics_can_be_disabled(fake_datadog, datadog_client):
+    tracer.drain()
+    datadog_client.start_background_sender()
+    datadog_sink = sink.DatadogSink(datadog_client)
+    args = argparse.Namespace(shutdown_timeout=5.0, disable_self_metrics=True)
+    datadog_sink.submit_ping(PingResult(packet_loss=0.0, average_latency=1.0))
+    assert network_health.shut_down(args, [datadog_sink]) == {}
+    assert not any(name.startswith("network_health.self.") for name in series_names(fake_datadog))
@@ -0,0 +1,36 @@
+import pytest
+
+from lib import sink
+
+
+def test_sink_is_abstract():
+    with pytest.raises(TypeError):
+        sink.Sink()
+
+
+def test_submit_methods_must_be_implemented():
+    class PingOnly(sink.Sink):
+        def submit_ping(self, data, local: bool = True, tags: list = None):
+            pass
+
+    with pytest.raises(TypeError, match="submit_bandwidth"):
+        PingOnly()
+
+
+def test_optional_methods_default_to_nothing():
+    class Minimal(sink.Sink):
+        def submit_ping(self, data, local: bool = True, tags: list = None):
+            pass
+
+        def submit_ping_fleet(self, results_by_target: dict, local: bool = True, tags_by_target: dict = None):
+            pass
+
+        def submit_bandwidth(self, data, local: bool = True, target: str = None, tags: list = None):
+            pass
+
+    minimal = Minimal()
+    minimal.submit_path({})
+    minimal.submit_dns({})
+    minimal.submit_self_metrics({})
+    minimal.flush()
+    assert minimal.drain(timeout=0) and minimal.close(timeout=0)
@@ -0,0 +1,97 @@
+import json
+import os
+
+import pytest
+
+from lib import datadog, spool
+
+
+def active_segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(spool.ACTIVE_SUFFIX))
+
+
+def test_append_seal_and_replay(tmp_path):
+    metric_spool = spool.MetricSpool(str(tmp_path))
+    metric_spool.append([b'{"a":1}', {"b": 2}])
+    assert len(active_segments(tmp_path)) == 1
+    metric_spool.seal()
+    assert active_segments(tmp_path) == []
+    batches = []
+    assert metric_spool.replay(batches.append) == 2
+    assert batches == [[b'{"a":1}', b'{"b":2}']]
+    assert metric_spool.segments() == []
+
+
+def test_segment_of_a_live_process_is_not_recovered(tmp_path):
+    # A second spool on the same directory stands in for an overlapping run; the writer's lock is held per open file
+    writer = spool.MetricSpool(str(tmp_path))
+    writer.append([b'{"a":1}'])
+    active = active_segments(tmp_path)
+    spool.MetricSpool(str(tmp_path))
+    assert active_segments(tmp_path) == active
+    writer.append([b'{"b":2}'])
+    writer.seal()
+    assert [spool.MetricSpool.read_segment(path) for path in writer.segments()] == [[b'{"a":1}', b'{"b":2}']]
+
+
+def test_segment_of_a_dead_process_is_recovered(tmp_path):
+    abandoned = tmp_path / f"{1:020d}{spool.SEGMENT_SUFFIX}{spool.ACTIVE_SUFFIX}"
+    abandoned.write_bytes(b'{"a":1}\n{"b":')
+    metric_spool = spool.MetricSpool(str(tmp_path))
+    assert active_segments(tmp_path) == []
+    batches = []
+    assert metric_spool.replay(batches.append) == 1
+    assert batches == [[b'{"a":1}']]
+
+
+def test_only_one_replay_across_processes(tmp_path):
+    first = spool.MetricSpool(str(tmp_path))
+    second = spool.MetricSpool(str(tmp_path))
+    first.append([b'{"a":1}'])
+    first.seal()
+    nested = []
+
+    def send(series):
+        nested.append(second.replay(lambda batch: None))
+
+    assert first.replay(send) == 1
+    assert nested == [0]
+    assert second.replay(lambda batch: None) == 0
+
+
+class PartlySent(Exception):
+    def __init__(self, sent):
+        super().__init__(f"sent {sent}")
+        self.sent = sent
+
+
+def test_partly_sent_segment_keeps_only_the_unsent_tail(tmp_path):
+    metric_spool = spool.MetricSpool(str(tmp_path))
+    metric_spool.append([b'{"a":1}', b'{"b":2}', b'{"c":3}'])
+    metric_spool.seal()
+
+    def fail_after_first(series):
+        raise PartlySent(1)
+
+    with pytest.raises(PartlySent):
+        metric_spool.replay(fail_after_first)
+    batches = []
+    assert metric_spool.replay(batches.append) == 2
+    assert batches == [[b'{"b":2}', b'{"c":3}']]
+    assert os.listdir(tmp_path) == [spool.REPLAY_LOCK_NAME]
+
+
+def test_failed_request_is_the_only_one_replayed(tmp_path, fake_datadog, datadog_client):
+    # Each series fills a request of its own, and the second request is rejected
+    datadog_client.max_payload_bytes = 20
+    datadog_client.spool = spool.MetricSpool(str(tmp_path))
+    fake_datadog.respond(202)
+    fake_datadog.respond(400)
+    with pytest.raises(datadog.DatadogFailedMetricsUpdate) as failure:
+        datadog_client.deliver_series([b'{"a":1}', b'{"b":2}', b'{"c":3}'])
+    assert failure.value.sent == 1
+    assert len(fake_datadog.posts()) == 2
+
+    assert datadog_client.deliver_series([]) == 2
+    bodies = [json.loads(body) for _, _, _, body in fake_datadog.posts()]
+    assert bodies[2:] == [{"series": [{"b": 2}]}, {"series": [{"c": 3}]}]
@@ -0,0 +1,121 @@
+import math
+
+import pytest
+
+from lib import stats
+from lib.results import PingResult
+
+
+@pytest.mark.parametrize("values, fraction, expected", [
+    ([1, 2, 3, 4, 5], 0.50, 3.0),
+    ([1, 2, 3, 4, 5], 0.95, 4.8),
+    ([1, 2, 3, 4, 5], 0.99, 4.96),
+    ([1, 2, 3, 4], 0.50, 2.5),
+    ([1, 2, 3, 4, 5], 0.0, 1.0),
+    ([1, 2, 3, 4, 5], 1.0, 5.0),
+    ([7], 0.99, 7.0),
+    (list(range(1, 101)), 0.99, 99.01),
+])
+def test_percentile(values, fraction, expected):
+    assert stats.percentile(values, fraction) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("rtts, expected", [
+    ([], 0.0),
+    ([10.0], 0.0),
+    ([10.0, 10.0, 10.0], 0.0),
+    ([10.0, 26.0], 1.0),  # J = 0 + (16 - 0) / 16
+    ([10.0, 20.0, 10.0, 20.0], 1.76025390625),  # 0.625, then 1.2109375, then 1.76025390625
+    ([20.0, 10.0, 20.0, 10.0], 1.76025390625),  # Only the size of each change counts, not its direction
+])
+def test_jitter(rtts, expected):
+    assert stats.jitter(rtts) == pytest.approx(expected)
+
+
+def test_jitter_converges_to_the_mean_difference():
+    # With a constant difference between consecutive replies the estimate approaches it, as RFC 3550 intends
+    rtts = [10.0 + 4.0 * (index % 2) for index in range(1000)]
+    assert stats.jitter(rtts) == pytest.approx(4.0)
+
+
+@pytest.mark.parametrize("received, expected", [
+    (b"", 0),
+    (b"\x01\x01\x01", 0),
+    (b"\x00\x00\x00", 3),
+    (b"\x01\x00\x01\x00\x00\x01", 2),
+    (b"\x00\x00\x01\x00\x00\x00", 3),
+    (b"\x01\x02\x00\xff", 1),  # Any non-zero byte is an answer
+])
+def test_max_loss_burst(received, expected):
+    assert stats.max_loss_burst(bytearray(received)) == expected
+
+
+@pytest.mark.parametrize("rtts, expected", [
+    ([], 0.0),
+    ([5.0], 0.0),
+    ([2.0, 4.0, 4.0, 4.0, 5.0, 5.0, 7.0, 9.0], 2.0),
+])
+def test_standard_deviation(rtts, expected):
+    assert stats.standard_deviation(rtts) == pytest.approx(expected)
+
+
+def samples_of(replies: dict, number_of_packets: int):
+    samples = stats.RttSamples(number_of_packets)
+    for index, rtt in replies.items():
+        samples.add_reply(index, rtt)
+    return samples
+
+
+def test_rtt_samples_snapshot():
+    # Ten packets, of which the fourth and fifth are lost
+    rtts = [2.0, 4.0, 4.0, 4.0, 5.0, 5.0, 7.0, 9.0]
+    samples = samples_of(dict(zip([0, 1, 2, 5, 6, 7, 8, 9], rtts)), 10)
+    assert len(samples) == 8
+    result = samples.snapshot()
+    assert isinstance(result, PingResult)
+    assert result.packet_loss == 20.0
+    assert (result.minimum_latency, result.average_latency, result.max_latency) == (2.0, 5.0, 9.0)
+    assert result.standard_deviation_latency == 2.0
+    assert result.p50_latency == 4.5
+    assert result.p95_latency == 8.3
+    assert result.p99_latency == 8.86
+    assert result.max_loss_burst == 2
+    assert result.jitter == round(stats.jitter(rtts), 3)
+    assert list(result.rtts) == rtts
+
+
+def test_rtt_samples_without_replies():
+    samples = stats.RttSamples(5)
+    samples.add_loss(0)
+    assert samples.snapshot() is None
+    assert stats.summarize_samples(samples) == {"max_loss_burst": 5}
+
+
+def test_rtt_samples_partial_snapshot():
+    # A run of 100 packets cut short after 4: the packets never sent are not counted as lost
+    samples = samples_of({0: 1.0, 1: 1.0, 3: 1.0}, 100)
+    samples.add_loss(2)
+    assert samples.snapshot().packet_loss == 97.0
+    assert samples.snapshot().max_loss_burst == 96
+    partial = samples.snapshot(partial=True)
+    assert partial.packet_loss == 25.0
+    assert partial.max_loss_burst == 1
+
+
+def test_rtt_samples_grow_past_the_expected_count():
+    # Output that reports more packets than asked for, or a run whose size was not known up front
+    samples = samples_of({0: 1.0, 4: 3.0}, 0)
+    assert samples.sent == 5
+    result = samples.snapshot()
+    assert result.packet_loss == 60.0
+    assert result.max_loss_burst == 3
+
+
+def test_rtt_samples_aggregates_match_a_direct_computation():
+    rtts = [12.3, 15.9, 11.1, 30.4, 12.0, 13.7, 12.2, 19.8, 11.6, 14.4]
+    result = samples_of(dict(enumerate(rtts)), len(rtts)).snapshot()
+    assert result.average_latency == round(sum(rtts) / len(rtts), 3)
+    assert result.standard_deviation_latency == round(stats.standard_deviation(rtts), 3)
+    assert result.minimum_latency == min(rtts) and result.max_latency == max(rtts)
+    assert result.p50_latency == round(stats.percentile(sorted(rtts), 0.5), 3)
+    assert not any(math.isnan(value) for _, value in result.items())
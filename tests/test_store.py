@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from lib import store
+from lib.results import PingResult
+
+HOUR = 1_700_000_000 - 1_700_000_000 % 3600  # The start of an hour, so bucket boundaries are easy to reason about
+
+
+@pytest.fixture
+def time_series(tmp_path):
+    return store.TimeSeriesStore(str(tmp_path), raw_retention=3600, minute_retention=86400)
+
+
+def raw_timestamps(time_series, key):
+    with store._Column(time_series.path(key), store.RAW_RECORD) as column:
+        return [timestamp for timestamp, _ in column.records()]
+
+
+def test_append_and_query(time_series):
+    for offset, value in enumerate([10.0, 20.0, 30.0, 40.0]):
+        time_series.append("ping_local.average_latency", value, timestamp=HOUR + offset)
+    summary = time_series.query("ping_local.average_latency", start=HOUR, end=HOUR + 4)
+    assert summary["count"] == 4
+    assert summary["minimum"] == 10.0 and summary["maximum"] == 40.0
+    assert summary["average"] == 25.0
+    assert summary["p50"] == 25.0
+    # The end of the range is exclusive, and an empty range has no summary
+    assert time_series.query("ping_local.average_latency", start=HOUR + 1, end=HOUR + 3)["count"] == 2
+    assert time_series.query("ping_local.average_latency", start=HOUR + 10, end=HOUR + 20) is None
+    assert time_series.query("unknown", start=HOUR) is None
+
+
+def test_record_and_keys(time_series):
+    time_series.record_ping_fleet({"8.8.8.8": PingResult(packet_loss=0.0, average_latency=12.0),
+                                   "1.1.1.1": PingResult(packet_loss=1.0, average_latency=9.0)}, local=False)
+    assert time_series.keys("ping_remote.average_latency*") == [
+        "ping_remote.average_latency{target:1.1.1.1}", "ping_remote.average_latency{target:8.8.8.8}"]
+    assert time_series.query(store.series_key("ping_remote", "packet_loss", "1.1.1.1"))["maximum"] == 1.0
+
+
+def test_out_of_order_samples_keep_the_column_sorted(time_series):
+    time_series.append("metric", 1.0, timestamp=HOUR + 100)
+    time_series.append("metric", 2.0, timestamp=HOUR + 50)  # e.g. after the clock was stepped back
+    time_series.append("metric", 3.0, timestamp=HOUR + 200)
+    assert raw_timestamps(time_series, "metric") == [HOUR + 100, HOUR + 100, HOUR + 200]
+    assert time_series.query("metric", start=HOUR + 100, end=HOUR + 101)["count"] == 2
+
+
+def test_concurrent_appends_stay_sorted(time_series):
+    def append():
+        for value in range(200):
+            time_series.append_many([("a", value), ("b", value)])
+
+    threads = [threading.Thread(target=append) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for key in ["a", "b"]:
+        timestamps = raw_timestamps(time_series, key)
+        assert len(timestamps) == 800
+        assert timestamps == sorted(timestamps)
+
+
+def test_torn_record_is_dropped(time_series):
+    time_series.append("metric", 1.0, timestamp=HOUR)
+    with open(time_series.path("metric"), "ab") as column_file:
+        column_file.write(b"\x01\x02\x03")  # A crash in the middle of a write
+    assert time_series.query("metric", start=HOUR)["count"] == 1
+    time_series.append("metric", 2.0, timestamp=HOUR + 1)
+    assert os.path.getsize(time_series.path("metric")) == 2 * store.RAW_RECORD.size
+    assert time_series.query("metric", start=HOUR)["maximum"] == 2.0
+
+
+def test_rollup(time_series):
+    # Two samples in each of the first three minutes of the hour, and one in the current, incomplete minute
+    for minute in range(3):
+        for second, value in [(10, 1.0 + minute), (40, 3.0 + minute)]:
+            time_series.append("metric", value, timestamp=HOUR + minute * 60 + second)
+    time_series.append("metric", 100.0, timestamp=HOUR + 3 * 60 + 5)
+    assert time_series.rollup(now=HOUR + 3 * 60 + 30) == 3
+
+    minutes = time_series.query("metric", start=HOUR, end=HOUR + 3600, resolution=store.RESOLUTION_MINUTE)
+    assert minutes["count"] == 6
+    assert minutes["minimum"] == 1.0 and minutes["maximum"] == 5.0
+    assert minutes["average"] == 3.0
+    assert minutes["p50"] is None
+    # Only what is new is rolled up, so a second rollup writes nothing
+    assert time_series.rollup(now=HOUR + 3 * 60 + 30) == 0
+
+    # Once the hour is over, the minute buckets are rolled up into an hour bucket
+    assert time_series.rollup(now=HOUR + 3600) == 2
+    hours = time_series.query("metric", start=HOUR, end=HOUR + 3600, resolution=store.RESOLUTION_HOUR)
+    assert hours["count"] == 7
+    assert hours["maximum"] == 100.0
+
+
+def test_expiry_keeps_rollups(time_series):
+    for minute in range(5):
+        time_series.append("metric", float(minute), timestamp=HOUR + minute * 60)
+    time_series.append("metric", 9.0, timestamp=HOUR + 2 * 3600)
+    time_series.rollup(now=HOUR + 2 * 3600 + 60)
+
+    # Raw samples older than the retention of an hour are dropped...
+    assert raw_timestamps(time_series, "metric") == [HOUR + 2 * 3600]
+    assert time_series.query("metric", start=HOUR, end=HOUR + 3600) is None
+    # ...but stay in the rollups
+    assert time_series.query("metric", start=HOUR, end=HOUR + 3600, resolution=store.RESOLUTION_MINUTE)["count"] == 5
+    assert time_series.query("metric", start=HOUR, end=HOUR + 3600, resolution=store.RESOLUTION_HOUR)["count"] == 5
+
+    # Minute buckets go once they are older than their retention
+    time_series.rollup(now=HOUR + 2 * 86400)
+    assert time_series.query("metric", start=HOUR, end=HOUR + 3600, resolution=store.RESOLUTION_MINUTE) is None
+    assert time_series.query("metric", start=HOUR, end=HOUR + 3600, resolution=store.RESOLUTION_HOUR)["count"] == 5
+
+
+def test_writers_sharing_a_directory_take_turns(tmp_path):
+    # Two stores on one directory stand in for two processes: the lock file is taken through separate opens
+    first = store.TimeSeriesStore(str(tmp_path))
+    second = store.TimeSeriesStore(str(tmp_path))
+    first.append("metric", 1.0, timestamp=HOUR)
+    with first._locked():
+        writer = threading.Thread(target=second.append, args=("metric", 2.0, HOUR + 1))
+        writer.start()
+        time.sleep(0.2)
+        assert writer.is_alive()
+        assert first.query("metric", start=HOUR)["count"] == 1
+    writer.join(5)
+    assert first.query("metric", start=HOUR)["count"] == 2
+
+
+def test_unknown_resolution(time_series):
+    with pytest.raises(ValueError):
+        time_series.query("metric", resolution="5m")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("90s", 1_000_000 - 90),
+    ("-15m", 1_000_000 - 900),
+    ("6h", 1_000_000 - 6 * 3600),
+    ("2d", 1_000_000 - 2 * 86400),
+    ("1.5h", 1_000_000 - 5400),
+    ("1700000000", 1_700_000_000),
+    ("1700000000.9", 1_700_000_000),
+    ("2026-10-01T12:30:00", int(datetime(2026, 10, 1, 12, 30).timestamp())),
+    ("2026-10-01T12:30:00+00:00", 1_790_857_800),
+])
+def test_parse_time(text, expected):
+    assert store.parse_time(text, now=1_000_000) == expected
+
+
+@pytest.mark.parametrize("text", ["yesterday", "5w", "", "h"])
+def test_parse_time_rejects(text):
+    with pytest.raises(ValueError):
+        store.parse_time(text, now=1_000_000)
@@ -0,0 +1,38 @@
+import socket
+import time
+
+import pytest
+
+from conftest import free_port
+from lib import throughput
+from lib.iperf import IperfExecutionFailed
+
+
+@pytest.mark.parametrize("use_sendfile", [False, True])
+def test_loopback(server_port, use_sendfile):
+    result = throughput.run_throughput("127.0.0.1", port=server_port, duration=0.5, streams=2,
+                                       report_interval=0.1, use_sendfile=use_sendfile)
+    assert result.transfer_value > 0
+    assert result.bandwidth_value > 0
+    assert 0.4 < result.interval_value < 2
+    assert len(result.intervals) >= 3
+    assert result.intervals[0].start == 0
+
+
+def test_stalled_server_does_not_hang(monkeypatch):
+    monkeypatch.setattr(throughput, "RESULT_TIMEOUT", 0.5)
+    monkeypatch.setattr(throughput, "JOIN_GRACE", 0.5)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        # Connections are never accepted or read, so the send window fills up and stays full
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(4)
+        start = time.monotonic()
+        with pytest.raises(IperfExecutionFailed):
+            throughput.run_throughput("127.0.0.1", port=listener.getsockname()[1], duration=0.5, streams=2)
+        assert time.monotonic() - start < 3
+
+
+def test_connection_refused():
+    with pytest.raises(IperfExecutionFailed):
+        throughput.run_throughput("127.0.0.1", port=free_port(), duration=0.5)
@@ -0,0 +1,51 @@
+import pstats
+import sys
+import threading
+
+import pytest
+
+from lib import tracing
+
+
+def busy_worker(results):
+    results.append(sum(value * value for value in range(20000)))
+
+
+def run_workers(results):
+    workers = [threading.Thread(target=busy_worker, args=(results,)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+@pytest.mark.parametrize("per_thread", [True, False])
+def test_profiler_covers_worker_threads(tmp_path, monkeypatch, per_thread):
+    # Both ways of profiling threads are run on every Python: the one that does not apply must degrade, not crash
+    monkeypatch.setattr(tracing, "PER_THREAD_PROFILERS", per_thread)
+    path = str(tmp_path / "profile.out")
+    profiler = tracing.Profiler(path)
+    results = []
+    profiler.start()
+    try:
+        run_workers(results)
+    finally:
+        profiler.stop()
+    assert len(results) == 4
+    functions = {function for _, _, function in pstats.Stats(path).stats}
+    assert "run_workers" in functions
+    if per_thread == (sys.version_info < (3, 12)):
+        assert "busy_worker" in functions
+
+
+def test_tracer_stats():
+    tracer = tracing.Tracer()
+    with tracer.span("stage"):
+        pass
+    tracer.count("event", 2)
+    tracer.observe("payload", 100)
+    stats = tracer.drain()
+    assert stats["stage"].count == 1
+    assert stats["event"].total == 2
+    assert stats["payload"].maximum == 100
+    assert tracer.drain() == {}